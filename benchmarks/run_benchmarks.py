@@ -0,0 +1,194 @@
+"""
+Benchmarks for the compute hot paths of panpipes.funcs
+
+Generates synthetic sparse count MuData (rna, prot with isotypes, atac) at the requested
+sizes, times each function over a number of repeats and records the peak memory
+allocated by a single call (tracemalloc, which includes numpy buffers).
+Results are written as JSON so that runs of different releases can be compared:
+
+    python benchmarks/run_benchmarks.py --n_cells 10000,100000 --output bench_0.5.0.json
+    python benchmarks/run_benchmarks.py --n_cells 10000 --output new.json --compare bench_0.5.0.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from anndata import AnnData
+from muon import MuData
+from scipy import sparse
+
+import panpipes
+import panpipes.funcs as pnp
+from panpipes.funcs.harmony import run_harmony
+from panpipes.version import __version__
+
+
+def synthetic_counts(n_obs, n_vars, density, rng, lam=3):
+    X = sparse.random(n_obs, n_vars, density=density, format="csr", random_state=rng, dtype=np.float32)
+    X.data = rng.poisson(lam, X.nnz).astype(np.float32) + 1
+    return X
+
+
+def synthetic_mudata(n_cells, n_genes=2000, n_prot=50, n_isotypes=3, n_peaks=5000,
+                     n_samples=4, n_clusters=10, seed=0):
+    rng = np.random.default_rng(seed)
+    obs = pd.DataFrame(index=["cell%i" % i for i in range(n_cells)],
+                       data={"sample_id": pd.Categorical(rng.choice(["sample%i" % i for i in range(n_samples)], n_cells)),
+                             "clusters": pd.Categorical(rng.integers(0, n_clusters, n_cells).astype(str))})
+    rna = AnnData(synthetic_counts(n_cells, n_genes, 0.05, rng), obs=obs.copy(),
+                  var=pd.DataFrame(index=["gene%i" % i for i in range(n_genes)],
+                                   data={"gene_ids": ["ENSG%i" % i for i in range(n_genes)],
+                                         "feature_types": "Gene Expression"}))
+    rna.layers["raw_counts"] = rna.X.copy()
+    prot_names = ["prot%i" % i for i in range(n_prot - n_isotypes)] + ["isotype%i" % i for i in range(n_isotypes)]
+    prot = AnnData(synthetic_counts(n_cells, n_prot, 0.8, rng, lam=20), obs=obs.copy(),
+                   var=pd.DataFrame(index=prot_names))
+    atac = AnnData(synthetic_counts(n_cells, n_peaks, 0.02, rng, lam=1), obs=obs.copy(),
+                   var=pd.DataFrame(index=["chr1:%i-%i" % (i * 1000, i * 1000 + 500) for i in range(n_peaks)]))
+    atac.layers["raw_counts"] = atac.X.copy()
+    return MuData({"rna": rna, "prot": prot, "atac": atac})
+
+
+def log_normalised(adata):
+    adata = adata.copy()
+    adata.X = adata.X.copy()
+    adata.X.data = np.log1p(adata.X.data)
+    adata.uns["log1p"] = {"base": None}
+    return adata
+
+
+def benchmarks(mdata, tmp_dir):
+    """
+    name -> (setup, func); setup returns the arguments of func and is not timed
+    """
+    rna_log = log_normalised(mdata["rna"])
+    isotypes = [x for x in mdata["prot"].var_names if x.startswith("isotype")]
+    top_background = mdata["rna"].var_names[:20].tolist()
+
+    def pseudo_seurat_setup():
+        adata = rna_log.copy()
+        adata.obs["idents"] = np.where(adata.obs["clusters"] == "0", "1", "0")
+        return (adata,)
+
+    return {
+        "pseudo_seurat": (pseudo_seurat_setup, lambda adata: pnp.scmethods.pseudo_seurat(adata)),
+        "find_all_markers_pseudo_seurat": (
+            lambda: (rna_log,),
+            lambda adata: pnp.scmethods.find_all_markers_pseudo_seurat(
+                adata, groups="all", groupby="clusters", method="wilcoxon")),
+        "X_is_raw": (lambda: (mdata["rna"],), lambda adata: pnp.scmethods.X_is_raw(adata, use_cache=False)),
+        "identify_isotype_outliers": (
+            lambda: (mdata["prot"].copy(),),
+            lambda prot: pnp.scmethods.identify_isotype_outliers(prot, isotypes, groupby="sample_id")),
+        "downsample_mudata": (
+            lambda: (mdata.copy(),),
+            lambda md: pnp.pp.downsample_mudata(md, nn=mdata.n_obs // 4, mods=["rna", "prot", "atac"])),
+        "concat_mdatas": (
+            lambda: ([MuData({"rna": mdata["rna"][mdata["rna"].obs["sample_id"] == s].copy()})
+                      for s in mdata["rna"].obs["sample_id"].cat.categories],),
+            lambda mdatas: pnp.pp.concat_mdatas(mdatas, batch_key="sample_id")),
+        "kde_densities": (
+            lambda: (mdata["prot"].copy(),),
+            lambda prot: pnp.plotting.kde_densities(prot, bandwidth=0.1)),
+        "compute_lisi": (
+            lambda: (np.random.default_rng(0).normal(size=(mdata.n_obs, 2)), mdata["rna"].obs),
+            lambda X, obs: pnp.scmethods.compute_lisi(X, obs, ["sample_id", "clusters"])),
+        "run_harmony": (
+            lambda: (np.random.default_rng(0).normal(size=(mdata.n_obs, 30)), mdata["rna"].obs),
+            lambda X, obs: run_harmony(X, obs, ["sample_id"])),
+        "lsi": (lambda: (log_normalised(mdata["atac"]),), lambda adata: pnp.scmethods.lsi(adata, num_components=30)),
+        "findTopFeatures_pseudo_signac": (
+            lambda: (mdata["atac"].copy(),),
+            lambda adata: pnp.scmethods.findTopFeatures_pseudo_signac(adata, min_cutoff="q5")),
+        "get_mean_background_fraction": (
+            lambda: (mdata["rna"],),
+            lambda adata: pnp.scmethods.get_mean_background_fraction(adata, top_background, group_by="sample_id")),
+        "write_10x_counts": (
+            lambda: (mdata["rna"],),
+            lambda adata: pnp.io.write_10x_counts(adata, os.path.join(tmp_dir, "counts"))),
+    }
+
+
+def run_one(setup, func, repeats):
+    times = []
+    peak = None
+    for ii in range(repeats):
+        args = setup()
+        gc.collect()
+        if ii == 0:
+            # memory is profiled on a separate call, tracemalloc slows down the timed ones
+            tracemalloc.start()
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            args = setup()
+            gc.collect()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {"times_s": times, "median_s": float(np.median(times)), "peak_mem_mb": peak / 1024**2}
+
+
+def compare(results, previous):
+    prev = {(r["name"], r["n_cells"]): r for r in previous["results"]}
+    print("\n%-32s %10s %12s %12s" % ("benchmark", "n_cells", "time ratio", "mem ratio"))
+    for r in results:
+        p = prev.get((r["name"], r["n_cells"]))
+        if p is None or "error" in r or "error" in p:
+            continue
+        print("%-32s %10i %12.2f %12.2f" % (r["name"], r["n_cells"],
+                                            r["median_s"] / p["median_s"],
+                                            r["peak_mem_mb"] / max(p["peak_mem_mb"], 1e-9)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_cells", default="10000,100000,1000000",
+                        help="comma separated numbers of cells of the synthetic MuData")
+    parser.add_argument("--benchmarks", default=None,
+                        help="comma separated benchmarks to run, default all")
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--output", default="benchmarks.json", help="JSON file for the results")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    results = []
+    for n_cells in [int(x) for x in args.n_cells.split(",")]:
+        print("generating synthetic MuData with %i cells" % n_cells)
+        mdata = synthetic_mudata(n_cells)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, (setup, func) in benchmarks(mdata, tmp_dir).items():
+                if args.benchmarks is not None and name not in args.benchmarks.split(","):
+                    continue
+                try:
+                    res = run_one(setup, func, args.repeats)
+                except Exception as e:
+                    # keep going, a failing benchmark is recorded rather than losing the run
+                    res = {"error": repr(e)}
+                res = {"name": name, "n_cells": n_cells, **res}
+                print(res)
+                results.append(res)
+        del mdata
+    out = {"panpipes_version": __version__,
+           "panpipes_path": os.path.dirname(panpipes.__file__),
+           "python": sys.version,
+           "platform": platform.platform(),
+           "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "results": results}
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
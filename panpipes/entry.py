@@ -43,6 +43,13 @@ def main(argv=None):
         print(*pipelines_list, sep="\n")
         return
     command = argv[1]
+    if len(argv) > 2 and argv[2] == "report-resources":
+        # summarise the resources recorded by the tasks of this workflow in the working directory,
+        # for the latest run, the run id given or all runs
+        from panpipes.telemetry import report
+        run_id = argv[3] if len(argv) > 3 else "latest"
+        print(report(workflow=re.sub("-", "_", command), run_id=run_id).round(2).to_string())
+        return
     if command != 'install_r_dependencies':
         command = re.sub("-", "_", command)
         pipeline = "pipeline_{}".format(command)
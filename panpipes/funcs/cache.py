@@ -0,0 +1,194 @@
+import glob
+import hashlib
+import importlib.metadata
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+
+
+def _file_hash(fname, cache_dir, block_size=1 << 20):
+    """
+    sha256 of a file, memoised in cache_dir/hashes on (path, size, mtime)
+    so unchanged inputs are only hashed once
+    """
+    st = os.stat(fname)
+    memo_key = hashlib.sha1(
+        ("%s:%i:%i" % (os.path.abspath(fname), st.st_size, st.st_mtime_ns)).encode()
+    ).hexdigest()
+    memo = os.path.join(cache_dir, "hashes", memo_key)
+    if os.path.exists(memo):
+        with open(memo) as f:
+            return f.read().strip()
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    os.makedirs(os.path.dirname(memo), exist_ok=True)
+    tmp = "%s.%i" % (memo, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(digest)
+    os.replace(tmp, memo)
+    return digest
+
+
+def _code_files(statement):
+    """
+    the scripts invoked by statement and the modules of panpipes.funcs they import
+    """
+    scripts = [f for f in re.findall(r"\S+\.py\b", statement) if os.path.isfile(f)]
+    funcs_dir = os.path.dirname(os.path.abspath(__file__))
+    return scripts + sorted(glob.glob(os.path.join(funcs_dir, "*.py")))
+
+
+def _panpipes_version():
+    try:
+        return importlib.metadata.version("panpipes")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def cache_key(statement, inputs, cache_dir, params=None):
+    """
+    content address of a task: hashes of the input files, the resolved command line
+    (whitespace normalised), the parameter subtree the task depends on and the
+    panpipes version and code the command runs, so an upgrade does not reuse old entries
+    """
+    h = hashlib.sha256()
+    h.update(" ".join(statement.split()).encode())
+    for fname in inputs:
+        h.update(_file_hash(fname, cache_dir).encode())
+    if params is not None:
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    h.update(_panpipes_version().encode())
+    for fname in _code_files(statement):
+        h.update(_file_hash(fname, cache_dir).encode())
+    return h.hexdigest()
+
+
+def _copy(src, dst):
+    # outputs and cache entries are copies rather than hard links,
+    # so rewriting an output in place cannot change the cache
+    if os.path.lexists(dst):
+        os.remove(dst)
+    shutil.copy2(src, dst)
+
+
+def restore_from_cache(key, outputs, cache_dir):
+    """
+    copy the cached outputs of key to outputs.
+    Returns False if there is no (valid) entry for key.
+    """
+    entry = os.path.join(cache_dir, "entries", key)
+    manifest = os.path.join(entry, "manifest.json")
+    if not os.path.exists(manifest):
+        return False
+    with open(manifest) as f:
+        mtd = json.load(f)
+    cached = [os.path.join(entry, "files", str(i)) for i in range(len(outputs))]
+    # an entry is only valid if it was made for the same outputs and has not been changed since
+    if mtd["outputs"] != list(outputs) or not all(
+        os.path.exists(c) and os.path.getsize(c) == s for c, s in zip(cached, mtd["sizes"])
+    ):
+        logging.warning("dropping invalid cache entry %s" % key)
+        shutil.rmtree(entry, ignore_errors=True)
+        return False
+    for c, out in zip(cached, outputs):
+        if os.path.dirname(out) != "":
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        _copy(c, out)
+        # make the restored output newer than its inputs for ruffus
+        os.utime(out)
+    # the manifest mtime records the last use for the LRU eviction
+    os.utime(manifest)
+    return True
+
+
+def store_in_cache(key, outputs, cache_dir, max_size_gb=None):
+    """
+    copy outputs into the cache entry for key, then evict the least recently
+    used entries until the cache is smaller than max_size_gb
+    """
+    missing = [out for out in outputs if not os.path.exists(out)]
+    if len(missing) > 0:
+        logging.warning("not caching %s, missing outputs: %s" % (key, ", ".join(missing)))
+        return False
+    entries = os.path.join(cache_dir, "entries")
+    tmp = os.path.join(entries, ".%s.%i" % (key, os.getpid()))
+    os.makedirs(os.path.join(tmp, "files"), exist_ok=True)
+    for i, out in enumerate(outputs):
+        _copy(out, os.path.join(tmp, "files", str(i)))
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump({"outputs": list(outputs),
+                   "sizes": [os.path.getsize(out) for out in outputs],
+                   "created": time.time()}, f)
+    try:
+        os.rename(tmp, os.path.join(entries, key))
+    except OSError:
+        # another job stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    if max_size_gb is not None:
+        evict_cache(cache_dir, max_size_gb)
+    return True
+
+
+def evict_cache(cache_dir, max_size_gb):
+    """
+    remove least recently used entries until the cache holds at most max_size_gb
+    """
+    entries = os.path.join(cache_dir, "entries")
+    usage = []
+    for key in os.listdir(entries):
+        manifest = os.path.join(entries, key, "manifest.json")
+        if key.startswith(".") or not os.path.exists(manifest):
+            continue
+        with open(manifest) as f:
+            size = sum(json.load(f)["sizes"])
+        usage.append((os.path.getmtime(manifest), size, key))
+    total = sum(u[1] for u in usage)
+    max_size = max_size_gb * 1024**3
+    for _, size, key in sorted(usage):
+        if total <= max_size:
+            break
+        logging.info("evicting cache entry %s" % key)
+        shutil.rmtree(os.path.join(entries, key), ignore_errors=True)
+        total -= size
+
+
+def cached_run(statement, inputs, outputs, cache_params=None, params=None, **job_kwargs):
+    """
+    P.run through a content-addressed cache of task outputs.
+
+    The key is made of the hashes of inputs, the command line resolved with PARAMS and
+    the caller's locals (as P.run does) and params, a parameter subtree of the task.
+    On a hit the outputs are copied from the cache instead of running the command.
+    outputs must list every file the command writes that downstream tasks use, tasks
+    writing other files (e.g. to a shared store) should not be cached.
+    cache_params is the "cache" section of pipeline.yml, with dir and max_size_gb;
+    the cache is disabled if dir is not set.
+    """
+    from cgatcore import pipeline as P
+    from panpipes.telemetry import run_task
+
+    caller_frame = sys._getframe(1)
+    if cache_params is None or cache_params.get("dir") is None:
+        return run_task(statement, caller_frame=caller_frame, **job_kwargs)
+    caller_locals = {k: v for k, v in caller_frame.f_locals.items()
+                     if k not in ["self", "statement"]}
+    run_kwargs = {**caller_locals, **job_kwargs}
+    cache_dir = cache_params["dir"]
+    try:
+        resolved = statement % {**P.get_params(), **run_kwargs}
+    except (KeyError, ValueError, TypeError):
+        resolved = statement
+    key = cache_key(resolved, inputs, cache_dir, params=params)
+    if restore_from_cache(key, outputs, cache_dir):
+        logging.getLogger("cgatcore.pipeline").info(
+            "restored %s from cache entry %s" % (", ".join(outputs), key))
+        return
+    run_task(statement, caller_frame=caller_frame, **job_kwargs)
+    store_in_cache(key, outputs, cache_dir, max_size_gb=cache_params.get("max_size_gb"))
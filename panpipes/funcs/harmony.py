@@ -0,0 +1,262 @@
+"""
+Harmony integration (Korsunsky et al. 2019) that can start from a saved state
+and process the cells in mini-batches.
+
+The state of a run is made of the centroids Y (K x dims) of the soft clusters, in the
+corrected and cosine normalised space, and the soft cluster assignments R (cells x K).
+It is saved next to the corrected object (harmony_state_path) and a later run, e.g.
+with another theta or sigma or with new samples, starts from it instead of k-means.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def harmony_state_path(fname):
+    """
+    file of the Harmony state next to the h5mu/h5ad fname
+    """
+    return "%s.harmony_state.npz" % os.path.splitext(fname)[0]
+
+
+def save_harmony_state(fname, Y, R, obs_names, Z=None, n_basis=1000):
+    """
+    with Z, the embedding Harmony ran on, the coordinates of up to n_basis evenly
+    spaced cells are saved as well, to check later that a run is on the same basis
+    """
+    obs_names = np.asarray(obs_names, dtype=str)
+    basis = {}
+    if Z is not None:
+        pos = np.unique(np.linspace(0, len(obs_names) - 1, min(n_basis, len(obs_names))).astype(np.int64))
+        basis = {"basis_obs": obs_names[pos], "basis_Z": np.asarray(Z)[pos].astype(np.float32)}
+    tmp = "%s.%i.tmp.npz" % (os.path.splitext(fname)[0], os.getpid())
+    np.savez(tmp, Y=np.asarray(Y, dtype=np.float32), R=np.asarray(R, dtype=np.float32),
+             obs_names=obs_names, **basis)
+    os.replace(tmp, fname)
+
+
+def load_harmony_state(fname):
+    """
+    the state saved with save_harmony_state, as a dict with Y, R and obs_names, or None
+    """
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname) as f:
+        return {k: f[k] for k in f.files}
+
+
+def same_basis(state, Z, obs_names, rtol=1e-3):
+    """
+    whether the embedding Z (cells x dims) of obs_names is in the basis the state was
+    computed in, i.e. the cells saved with the state that are in obs_names have the same
+    coordinates. False if the state has no basis or no cell in common.
+    """
+    if "basis_Z" not in state or state["basis_Z"].shape[1] != Z.shape[1]:
+        return False
+    pos = pd.Index(obs_names).get_indexer(state["basis_obs"])
+    if not (pos >= 0).any():
+        return False
+    saved = state["basis_Z"][pos >= 0]
+    current = np.asarray(Z)[pos[pos >= 0]].astype(np.float32)
+    return np.allclose(current, saved, rtol=rtol, atol=rtol * np.abs(saved).max())
+
+
+def _normalise_rows(X):
+    return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+
+def _xlogx(X):
+    return X * np.log(X, out=np.zeros_like(X), where=X > 0)
+
+
+def _batch_design(meta_data, vars_use):
+    """
+    the level of each cell (cells x batch columns), numbering the levels of all columns
+    from 1 as column 0 of the design is the intercept, and the column of each level
+    """
+    codes, level_col = [], []
+    for ii, col in enumerate(vars_use):
+        cat = pd.Categorical(meta_data[col]).remove_unused_categories()
+        if (cat.codes < 0).any():
+            raise ValueError("batch column %s has missing values" % col)
+        codes.append(cat.codes.astype(np.int64) + len(level_col) + 1)
+        level_col += [ii] * len(cat.categories)
+    return np.column_stack(codes), np.array(level_col)
+
+
+def _soft_assign(Zc, Y, sigma):
+    dist = 2 * (1 - Zc @ Y.T)
+    scale = -dist / sigma
+    scale -= scale.max(axis=1, keepdims=True)
+    np.exp(scale, out=scale)
+    return dist, scale
+
+
+def _init_centroids(Zc, K, batch_size=None, random_state=0):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if batch_size is None:
+        km = KMeans(n_clusters=K, init="k-means++", n_init=10, max_iter=25, random_state=random_state)
+    else:
+        km = MiniBatchKMeans(n_clusters=K, batch_size=batch_size, n_init=3, random_state=random_state)
+    return _normalise_rows(km.fit(Zc).cluster_centers_.astype(Zc.dtype))
+
+
+def _cross_entropy(O, E, theta, sigma):
+    # sum over cells of R * sigma * (theta * log((O + 1) / (E + 1))) @ Phi, written with O = Phi.T @ R
+    return np.sum(theta[:, None] * sigma[None, :] * np.log((O + 1) / (E + 1)) * O)
+
+
+def _assignment_pass(Zc, R, Ynum, O, E, Phi, Pr_b, theta, sigma, blocks, online):
+    """
+    one k-means round: updates the soft assignments R, O and E block by block in place
+    and returns the objective and the sum of the cells of each cluster (Ynum) for the next round.
+    With online, the centroids follow Ynum after each block (mini-batch k-means)
+    """
+    Y = _normalise_rows(Ynum)
+    Ynext = Ynum if online else np.zeros_like(Ynum)
+    objective = 0.0
+    for b in blocks:
+        Zb, Rb_old, Phib = Zc[b], R[b], Phi[b]
+        dist, Rb = _soft_assign(Zb, Y, sigma)
+        # remove the cells of the block from the observed and expected counts
+        O -= Phib.T @ Rb_old
+        E -= np.outer(Pr_b, Rb_old.sum(axis=0))
+        Rb *= Phib @ (((E + 1) / (O + 1)) ** theta[:, None])
+        Rb /= Rb.sum(axis=1, keepdims=True)
+        O += Phib.T @ Rb
+        E += np.outer(Pr_b, Rb.sum(axis=0))
+        R[b] = Rb
+        objective += np.sum(Rb * dist) + np.sum(_xlogx(Rb) * sigma)
+        if online:
+            Ynext += (Rb - Rb_old).T @ Zb
+            Y = _normalise_rows(Ynext)
+        else:
+            Ynext += Rb.T @ Zb
+    return objective + _cross_entropy(O, E, theta, sigma), Ynext
+
+
+def _moe_correct_ridge(Z, R, moe_codes, Phi_moe, lamb_mat, max_block=2**24):
+    """
+    removes the batch effects estimated by a ridge regression in each cluster.
+    moe_codes are the design columns of each cell (intercept and batch levels),
+    Phi_moe the same as a one hot matrix; the (cells x clusters x dims) terms
+    are computed in blocks of max_block values
+    """
+    N, K = R.shape
+    P, d = lamb_mat.shape[0], Z.shape[1]
+    # Phi_moe.T @ diag(R[:, k]) @ Phi_moe of all clusters from the pairs of design columns of each cell
+    pairs = (moe_codes[:, :, None] * P + moe_codes[:, None, :]).reshape(N, -1)
+    M = sparse.csr_matrix((np.ones(pairs.size), (np.repeat(np.arange(N), pairs.shape[1]), pairs.ravel())),
+                          shape=(N, P * P))
+    A = np.asarray(M.T @ R).T.reshape(K, P, P)
+    step = max(1, max_block // (K * d))
+    Bz = np.zeros((P, K * d))
+    for i in range(0, N, step):
+        Bz += Phi_moe[i:i + step].T @ (R[i:i + step, :, None] * Z[i:i + step, None, :]).reshape(-1, K * d)
+    W = np.linalg.solve(A + lamb_mat, Bz.reshape(P, K, d).transpose(1, 0, 2))
+    # the intercept is not removed
+    W = np.ascontiguousarray(W[:, 1:, :].transpose(1, 0, 2)).astype(Z.dtype)
+    Z_corr = Z.copy()
+    for i in range(0, N, step):
+        for p in range(1, moe_codes.shape[1]):
+            Z_corr[i:i + step] -= np.einsum("nk,nkd->nd", R[i:i + step], W[moe_codes[i:i + step, p] - 1])
+    return Z_corr, _normalise_rows(Z_corr)
+
+
+def _converged(objective, window, epsilon):
+    if len(objective) < window + 1:
+        return False
+    old = sum(objective[-window - 1:-1])
+    new = sum(objective[-window:])
+    return abs(old - new) / abs(old) < epsilon
+
+
+def run_harmony(Z, meta_data, vars_use, theta=1.0, sigma=0.1, lamb=1.0, nclust=None,
+                block_size=0.05, batch_size=None, max_iter_harmony=10, max_iter_kmeans=20,
+                epsilon_kmeans=1e-5, epsilon_harmony=1e-4, init_state=None, random_state=0):
+    """
+    Harmony on the embedding Z (cells x dims) with the batch columns vars_use of meta_data,
+    following the harmonypy implementation of the algorithm.
+
+    init_state is a state from load_harmony_state: the cells of meta_data.index found in it
+    start from their saved assignments, the others from their distances to the saved
+    centroids, and the first step is a correction, instead of k-means on Z.
+    With batch_size, the assignments are updated in mini-batches of batch_size cells and
+    the centroids after each mini-batch, otherwise in blocks of block_size of the cells
+    with the centroids updated once per round. theta and lamb are one value, or one per
+    column of vars_use.
+
+    Returns the corrected embedding (cells x dims) and the state, a dict with Y, R and
+    the objective after each iteration.
+    """
+    rng = np.random.default_rng(random_state)
+    Z = np.asarray(Z)
+    Z = Z.astype(np.result_type(Z.dtype, np.float32), copy=False)
+    N = Z.shape[0]
+    codes, level_col = _batch_design(meta_data, vars_use)
+    moe_codes = np.column_stack([np.zeros(N, dtype=np.int64), codes])
+    Phi_moe = sparse.csr_matrix((np.ones(moe_codes.size, dtype=Z.dtype),
+                                 (np.repeat(np.arange(N), moe_codes.shape[1]), moe_codes.ravel())),
+                                shape=(N, len(level_col) + 1))
+    Phi = Phi_moe[:, 1:].tocsr()
+    Pr_b = np.asarray(Phi.sum(axis=0)).ravel() / N
+    theta = np.broadcast_to(theta, (len(vars_use),))[level_col].astype(Z.dtype)
+    lamb_mat = np.diag(np.r_[0, np.broadcast_to(lamb, (len(vars_use),))[level_col]])
+    step = int(batch_size) if batch_size is not None else int(np.ceil(N * block_size))
+
+    Zc = _normalise_rows(Z)
+    if init_state is None:
+        K = nclust if nclust is not None else int(min(np.round(N / 30.0), 100))
+        Y = _init_centroids(Zc, K, batch_size, random_state)
+        R = np.empty((N, K), dtype=Z.dtype)
+        new_cells = np.arange(N)
+    else:
+        Y = init_state["Y"].astype(Z.dtype)
+        K = Y.shape[0]
+        R = np.empty((N, K), dtype=Z.dtype)
+        pos = pd.Index(init_state["obs_names"]).get_indexer(meta_data.index)
+        R[pos >= 0] = init_state["R"][pos[pos >= 0]]
+        new_cells = np.flatnonzero(pos < 0)
+        logging.info("starting Harmony from the saved state of %i of %i cells" % (N - len(new_cells), N))
+    sigma = np.broadcast_to(sigma, (K,)).astype(Z.dtype)
+    for i in range(0, len(new_cells), step):
+        b = new_cells[i:i + step]
+        R[b] = _soft_assign(Zc[b], Y, sigma)[1]
+        R[b] /= R[b].sum(axis=1, keepdims=True)
+    Z_corr = Z
+    if init_state is not None:
+        # bring the cells to the corrected space of the saved centroids
+        Z_corr, Zc = _moe_correct_ridge(Z, R, moe_codes, Phi_moe, lamb_mat)
+    O = np.asarray(Phi.T @ R)
+    E = np.outer(Pr_b, R.sum(axis=0))
+    objective = _cross_entropy(O, E, theta, sigma)
+    for i in range(0, N, step):
+        dist = 2 * (1 - Zc[i:i + step] @ Y.T)
+        objective += np.sum(R[i:i + step] * dist) + np.sum(_xlogx(R[i:i + step]) * sigma)
+    objective_harmony = [objective]
+
+    for it in range(max_iter_harmony):
+        objective_kmeans = []
+        Ynum = R.T @ Zc
+        for i in range(max_iter_kmeans):
+            order = rng.permutation(N)
+            blocks = [order[j:j + step] for j in range(0, N, step)]
+            objective, Ynum = _assignment_pass(Zc, R, Ynum, O, E, Phi, Pr_b, theta, sigma,
+                                               blocks, online=batch_size is not None)
+            objective_kmeans.append(objective)
+            if _converged(objective_kmeans, 3, epsilon_kmeans):
+                break
+        objective_harmony.append(objective_kmeans[-1])
+        Y = _normalise_rows(Ynum)
+        Z_corr, Zc = _moe_correct_ridge(Z, R, moe_codes, Phi_moe, lamb_mat)
+        logging.info("Harmony iteration %i of %i, %i k-means rounds, objective %.4g"
+                     % (it + 1, max_iter_harmony, i + 1, objective_harmony[-1]))
+        old, new = objective_harmony[-2:]
+        if (old - new) / abs(old) < epsilon_harmony:
+            logging.info("Harmony converged after %i iterations" % (it + 1))
+            break
+    return Z_corr, {"Y": Y, "R": R, "objective": np.array(objective_harmony)}
@@ -1,9 +1,11 @@
 import gzip
+import io
 import logging
 import os
 import re
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from os import PathLike
 from pathlib import Path
 from typing import Literal, Optional
@@ -16,10 +18,15 @@ import scirpy as ir
 import yaml
 from anndata import AnnData
 from scanpy import read_10x_h5, read_10x_mtx, read_csv, read_h5ad, read_hdf, read_text
-from scipy.io import mmwrite
+from scipy.sparse import coo_matrix, issparse
 
 from .processing import intersection
 
+try:
+    from anndata.io import read_elem
+except ImportError:
+    from anndata.experimental import read_elem
+
 
 def update_cellranger_col(
     path: str | Path, raw: bool = False, method: str = "count", sample_id: str = ""
@@ -293,11 +300,93 @@ def gen_load_spatial_jobs(
         )
 
 
+def _select_keys(group: h5py.Group, slot: str, keys: bool | list | str | None):
+    """
+    work out which keys of an on-disk slot (obsm, obsp, uns...) should be read
+    True reads everything, False/None reads nothing, otherwise a (list of) key(s)
+    """
+    if keys is None or keys is False or slot not in group:
+        return []
+    if keys is True:
+        return list(group[slot].keys())
+    if isinstance(keys, str):
+        keys = [keys]
+    missing = [k for k in keys if k not in group[slot]]
+    if len(missing) > 0:
+        logging.debug("keys %s not found in .%s, skipping" % (missing, slot))
+    return [k for k in keys if k in group[slot]]
+
+
+def _read_dataframe(elem: h5py.Group, columns: bool | list | str | None = True):
+    """
+    read an on-disk obs/var dataframe, only loading the requested columns
+    the index is always read
+    """
+    if columns is True:
+        return read_elem(elem)
+    if columns is None or columns is False:
+        columns = []
+    elif isinstance(columns, str):
+        columns = [columns]
+    index = pd.Index(read_elem(elem[elem.attrs["_index"]]).astype(str))
+    df = pd.DataFrame(index=index)
+    for col in columns:
+        if col in elem:
+            df[col] = read_elem(elem[col])
+        else:
+            logging.warning("column %s not found, skipping" % col)
+    return df
+
+
+def _read_anndata_slots(
+    group: h5py.Group,
+    obs: bool | list = True,
+    obsm: bool | list = False,
+    obsp: bool | list = False,
+    uns: bool | list = False,
+):
+    """
+    build an AnnData from an open h5ad file or h5mu modality group,
+    reading only the requested slots. X and layers are left on disk.
+    Any neighbors entry requested from uns brings its obsp graphs along.
+    """
+    uns_dict = {k: read_elem(group["uns"][k]) for k in _select_keys(group, "uns", uns)}
+    obsp_keys = _select_keys(group, "obsp", obsp)
+    for v in uns_dict.values():
+        if isinstance(v, dict):
+            for graph_key in ["connectivities_key", "distances_key"]:
+                if graph_key in v and v[graph_key] not in obsp_keys and v[graph_key] in group.get("obsp", {}):
+                    obsp_keys.append(v[graph_key])
+
+    adata = AnnData(
+        obs=_read_dataframe(group["obs"], obs),
+        var=_read_dataframe(group["var"], True),
+        obsm={k: read_elem(group["obsm"][k]) for k in _select_keys(group, "obsm", obsm)},
+        obsp={k: read_elem(group["obsp"][k]) for k in obsp_keys},
+        uns=uns_dict,
+    )
+    return adata
+
+
 def read_anndata(
     fname: Optional[str] = None,
     use_muon: Optional[bool] = False,
-    modality: Literal["all", "rna", "prot", "atac", "rep"] = "all",
+    modality: Literal["all", "rna", "prot", "atac", "rep", "spatial"] = "all",
+    lazy: bool = False,
+    obs: bool | list = True,
+    obsm: bool | list = False,
+    obsp: bool | list = False,
+    uns: bool | list = False,
 ):
+    """
+    read an h5ad or (a modality of) an h5mu file.
+
+    With lazy=True only the slots named by obs (columns), obsm, obsp and uns (keys)
+    are loaded, X and layers stay on disk. Each of these can be True (all), False (none)
+    or a list of keys. Neighbors entries requested from uns pull in their obsp graphs.
+    For modality="all" a MuData is returned with the same selection applied to the
+    global slots and to every modality.
+    """
     logging.info("reading %s" % fname)
 
     if fname is None:
@@ -309,6 +398,38 @@ def read_anndata(
     except FileNotFoundError:
         sys.exit(f"anndata file not found: {fname}")
 
+    if lazy:
+        logging.info("reading %s modality lazily" % modality)
+        slots = dict(obs=obs, obsm=obsm, obsp=obsp, uns=uns)
+        with h5py.File(fname, "r", locking=False) as f:
+            if use_muon is False:
+                return _read_anndata_slots(f, **slots)
+            if modality != "all":
+                if modality not in f["mod"]:
+                    sys.exit(
+                        f"modality {modality} not found, must be one of {list(f['mod'].keys())}"
+                    )
+                return _read_anndata_slots(f["mod"][modality], **slots)
+            mod_order = f["mod"].attrs.get("mod-order", list(f["mod"].keys()))
+            mdata = mu.MuData({m: _read_anndata_slots(f["mod"][m], **slots) for m in mod_order})
+            # global slots are stored alongside the modalities
+            glob = _read_anndata_slots(f, **slots)
+            # the rebuilt MuData does not necessarily keep the stored cell order,
+            # the global obsm and obsp rows are taken by name
+            pos = glob.obs_names.get_indexer(mdata.obs_names)
+            if (pos < 0).any() or len(pos) != glob.n_obs:
+                raise ValueError("the global obs of %s do not match the cells of its modalities" % fname)
+            if (pos != np.arange(len(pos))).any():
+                glob = glob[pos].copy()
+            for col in glob.obs.columns.difference(mdata.obs.columns):
+                mdata.obs[col] = glob.obs[col]
+            for k in glob.obsm.keys():
+                mdata.obsm[k] = glob.obsm[k]
+            for k in glob.obsp.keys():
+                mdata.obsp[k] = glob.obsp[k]
+            mdata.uns.update(glob.uns)
+            return mdata
+
     if use_muon is False:
         return read_h5ad(fname)
     else:
@@ -318,19 +439,12 @@ def read_anndata(
             # note this just loads the rna part of the muon object
             return mu.read(fname)
 
-        if modality == "rna":
-            # note this just loads the rna part of the muon object
-            return mu.read(fname + "/rna")
-        elif modality == "prot":
-            return mu.read(fname + "/prot")
-        elif modality == "atac":
-            return mu.read(fname + "/atac")
-        elif modality == "rep":
-            return mu.read(fname + "/rep")
-
+        if modality in ["rna", "prot", "atac", "rep", "spatial"]:
+            # note this just loads the requested modality of the muon object
+            return mu.read(fname + "/" + modality)
         else:
             sys.exit(
-                f"modality {modality} not found, must be one of 'all', 'rna', 'prot','atac', 'rep' "
+                f"modality {modality} not found, must be one of 'all', 'rna', 'prot','atac', 'rep', 'spatial' "
             )
 
 
@@ -493,7 +607,7 @@ def scp_read_10x_h5(
 
         logging.debug("copying %s" % filename)
 
-        h5file = h5py.File(filename, "r")
+        h5file = h5py.File(filename, "r", locking=False)
 
         logging.debug("reading intervals")
 
@@ -662,7 +776,36 @@ def _make_one_rep_modality(data_dict: dict[AnnData]):
         data_dict.pop("bcr", None)
 
 
-def load_mdata_from_multiple_files(all_files_dict):
+def _modality_load_args(nm, all_files_dict):
+    """
+    extra arguments to load_adata_in for modality nm
+    """
+    extra_args = {}
+    if nm == "rna":
+        extra_args["library"] = "Gene Expression"
+        if "atac" in all_files_dict.keys():
+            extra_args["extended"] = True
+        else:
+            extra_args["extended"] = False
+    if nm == "prot":
+        extra_args["gex_only"] = False
+        extra_args["var_names"] = "gene_ids"
+        extra_args["library"] = "Antibody Capture"
+        extra_args["extended"] = False
+    if nm == "atac":
+        extra_args["gex_only"] = False
+        extra_args["library"] = "Peaks"
+        extra_args["extended"] = False
+    if nm == "spatial":
+        extra_args["gex_only"] = (
+            True  # check this for techs other than merfish and visium H&E
+        )
+        # extra_args["counts_file"] =
+        extra_args["extended"] = False
+    return extra_args
+
+
+def load_mdata_from_multiple_files(all_files_dict, n_jobs: int = 1):
     """
     create a mudata object from multiples files
     Parameters
@@ -677,6 +820,9 @@ def load_mdata_from_multiple_files(all_files_dict):
         Filetypes supported for rep: ["cellranger_vdj", "airr", "tracer", "bracer"  ]
         See scirpy documentation for more information of repertoire input formats
         https://scverse.org/scirpy/latest/api.html#module-scirpy.io
+    n_jobs: int
+        number of modalities loaded concurrently (threads). The modalities are
+        merged once all of them are loaded.
     """
     # convert names to match mudata conventions
     # mudata_conventional_names
@@ -685,36 +831,30 @@ def load_mdata_from_multiple_files(all_files_dict):
     # note: scanpy's default function use gex_only as param so we need to leave that in
     logging.debug(all_files_dict.keys())
     # load in separate anndata for each expected modality
-    data_dict = {}
+    load_jobs = {}
     for nm, x in all_files_dict.items():
-        logging.info("loading %s" % nm)
-        extra_args = {}
-        if nm == "rna":
-            extra_args["library"] = "Gene Expression"
-            if "atac" in all_files_dict.keys():
-                extra_args["extended"] = True
-            else:
-                extra_args["extended"] = False
-        if nm == "prot":
-            extra_args["gex_only"] = False
-            extra_args["var_names"] = "gene_ids"
-            extra_args["library"] = "Antibody Capture"
-            extra_args["extended"] = False
-        if nm == "atac":
-            extra_args["gex_only"] = False
-            extra_args["library"] = "Peaks"
-            extra_args["extended"] = False
-        if nm == "spatial":
-            extra_args["gex_only"] = (
-                True  # check this for techs other than merfish and visium H&E
-            )
-            # extra_args["counts_file"] =
-            extra_args["extended"] = False
-
+        extra_args = _modality_load_args(nm, all_files_dict)
         logging.debug("extra args")
         logging.debug(extra_args)
-        data_dict[nm] = load_adata_in(x[0], x[1], **extra_args)  # **
         # x[0] is the path, x[1] is the filetype
+        load_jobs[nm] = (x[0], x[1], extra_args)
+    if n_jobs > 1 and len(load_jobs) > 1:
+        logging.info(
+            "loading %s on %i threads"
+            % (", ".join(load_jobs.keys()), min(n_jobs, len(load_jobs)))
+        )
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(load_jobs))) as executor:
+            futures = {
+                nm: executor.submit(load_adata_in, path, filetype, **extra_args)
+                for nm, (path, filetype, extra_args) in load_jobs.items()
+            }
+            # keep the modality order of all_files_dict
+            data_dict = {nm: fut.result() for nm, fut in futures.items()}
+    else:
+        data_dict = {}
+        for nm, (path, filetype, extra_args) in load_jobs.items():
+            logging.info("loading %s" % nm)
+            data_dict[nm] = load_adata_in(path, filetype, **extra_args)  # **
     logging.debug(data_dict["rna"])
     logging.debug(data_dict.keys())
     # we want unique var names for each assay
@@ -742,24 +882,87 @@ def load_mdata_from_multiple_files(all_files_dict):
     return mdata_
 
 
-def write_10x_counts(adata: AnnData, path: str, layer=None):
+def _mtx_chunk(arr, start, stop, axis, value_fmt):
+    """
+    format the non-zero entries of arr[start:stop] (rows, axis=0) or arr[:, start:stop] (columns, axis=1)
+    as 1-based "feature cell value" Matrix Market lines, i.e. for arr.T
+    """
+    if axis == 0:
+        chunk = coo_matrix(arr[start:stop])
+        cells, features = chunk.row + start, chunk.col
+    else:
+        chunk = coo_matrix(arr[:, start:stop])
+        cells, features = chunk.row, chunk.col + start
+    keep = chunk.data != 0
+    out = io.StringIO()
+    np.savetxt(
+        out,
+        np.column_stack([features[keep] + 1, cells[keep] + 1, chunk.data[keep]]),
+        fmt=["%d", "%d", value_fmt],
+    )
+    return out.getvalue().encode()
+
+
+def write_mtx_gz(arr, fname: str, n_threads: int = 1, chunk_size: int = 10000):
+    """
+    Write arr.T (features x cells) to a gzipped Matrix Market file, streaming the
+    coordinates in chunks of cells (or features for csc input) so that neither an
+    uncompressed temporary file nor a converted copy of arr is created.
+    Each chunk is compressed as its own gzip member, which lets n_threads > 1 compress
+    chunks in parallel; concatenated members are a valid gzip stream.
+    """
+    n_cells, n_features = arr.shape
+    if issparse(arr):
+        if arr.format not in ["csr", "csc"]:
+            arr = arr.tocsr()
+        nnz = np.count_nonzero(arr.data)
+        axis = 1 if arr.format == "csc" else 0
+    else:
+        arr = np.asarray(arr)
+        nnz = np.count_nonzero(arr)
+        axis = 0
+    # same rule as before: store as integers if the counts sum to a whole number
+    if np.issubdtype(arr.dtype, np.integer) or float(arr.sum()).is_integer():
+        field, value_fmt = "integer", "%d"
+    else:
+        field, value_fmt = "real", "%.16g"
+    n_chunks = arr.shape[axis]
+    starts = range(0, n_chunks, chunk_size)
+
+    def _compressed_chunk(start):
+        stop = min(start + chunk_size, n_chunks)
+        return gzip.compress(_mtx_chunk(arr, start, stop, axis, value_fmt))
+
+    header = "%%%%MatrixMarket matrix coordinate %s general\n%%\n%i %i %i\n" % (
+        field,
+        n_features,
+        n_cells,
+        nnz,
+    )
+    with open(fname, "wb") as f_out:
+        f_out.write(gzip.compress(header.encode()))
+        if n_threads > 1:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                # submit a bounded window of chunks so memory stays at ~n_threads chunks
+                for i in range(0, len(starts), n_threads):
+                    for block in executor.map(
+                        _compressed_chunk, starts[i : i + n_threads]
+                    ):
+                        f_out.write(block)
+        else:
+            for start in starts:
+                f_out.write(_compressed_chunk(start))
+
+
+def write_10x_counts(adata: AnnData, path: str, layer=None, n_threads: int = 1):
     if layer is None:
         arr = adata.X
     else:
         arr = adata.layers[layer]
     if os.path.exists(path) is False:
         os.makedirs(path)
-    # convert to integer if appropriate
-    if arr.sum().is_integer():
-        arr = arr.astype(int)
-    # write matrix.mtx
-    mmwrite(os.path.join(path, "matrix.mtx"), arr.T)
-    with (
-        open(os.path.join(path, "matrix.mtx"), "rb") as f_in,
-        gzip.open(os.path.join(path, "matrix.mtx.gz"), "wb") as f_out,
-    ):
-        f_out.writelines(f_in)
-    os.remove(os.path.join(path, "matrix.mtx"))
+    # write matrix.mtx.gz (integer if appropriate)
+    write_mtx_gz(arr, os.path.join(path, "matrix.mtx.gz"), n_threads=n_threads)
     # write barcodes file
     barcodes = adata.obs_names.to_frame()
     barcodes.to_csv(
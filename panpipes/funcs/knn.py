@@ -0,0 +1,382 @@
+'''
+Persistent kNN graphs
+=====================
+
+A kNN store is a folder of kNN graphs (indices and distances of the k nearest neighbors
+of each cell, the cell itself first) saved as .npz, indexed in an SQLite table that
+records how each graph was produced: the modality, correction method, representation
+and number of dimensions, k, metric and neighbors method.
+
+Graphs are looked up by a fingerprint of the embedding they were computed on, so any
+consumer working on the same matrix (batch correction, LISI, scib, clustering) can reuse
+a graph, and a graph with a smaller k is derived from a larger one by taking its first
+columns.
+
+Nearest neighbor indices (exact BLAS search for small data, hnswlib, pynndescent) are
+built with build_ann_index and can be saved next to the h5mu they were built from
+(ann_index_path), to answer later queries of the same cells or of new ones.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+
+KNN_INDEX = "index.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS knn_graphs (
+    fingerprint TEXT, metric TEXT, k INTEGER, nn_method TEXT,
+    modality TEXT, method TEXT, rep TEXT, n_dims INTEGER, n_obs INTEGER,
+    file TEXT, created REAL,
+    PRIMARY KEY (fingerprint, metric, k, nn_method)
+)
+"""
+
+
+def embedding_fingerprint(X):
+    """
+    sha1 of the shape, dtype and values of an embedding
+    """
+    X = np.ascontiguousarray(X)
+    h = hashlib.sha1(("%s:%s" % (X.shape, X.dtype)).encode())
+    h.update(X.data)
+    return h.hexdigest()
+
+
+def _connect(knn_store):
+    os.makedirs(knn_store, exist_ok=True)
+    con = sqlite3.connect(os.path.join(knn_store, KNN_INDEX), timeout=60)
+    con.execute(_SCHEMA)
+    return con
+
+
+def save_knn(knn_store, fingerprint, distances, indices, metric="euclidean", nn_method=None,
+             modality=None, method=None, rep=None, n_dims=None):
+    """
+    save a kNN graph (distances and indices sorted by distance, the cell itself first)
+    in knn_store and record it in the index. Returns the file name
+    """
+    k = indices.shape[1]
+    fname = "%s_%s_k%i_%s.npz" % (fingerprint[:16], metric, k, nn_method)
+    tmp = os.path.join(knn_store, ".%s.%i.npz" % (fname, os.getpid()))
+    os.makedirs(knn_store, exist_ok=True)
+    np.savez(tmp, distances=distances, indices=indices)
+    os.replace(tmp, os.path.join(knn_store, fname))
+    row = (fingerprint, metric, k, str(nn_method), modality, method, rep,
+           n_dims, indices.shape[0], fname, time.time())
+    with _connect(knn_store) as con:
+        con.execute("INSERT OR REPLACE INTO knn_graphs VALUES (%s)" % ",".join("?" * len(row)), row)
+    logging.info("saved %i-NN graph of %s %s %s to %s" % (k, modality, method, rep, fname))
+    return fname
+
+
+def load_knn(knn_store, fingerprint, k, metric="euclidean", nn_method=None):
+    """
+    distances and indices of the k nearest neighbors from the smallest graph of knn_store
+    with at least k neighbors computed on the embedding with this fingerprint,
+    optionally restricted to one nn_method. Returns None if there is none.
+    """
+    if knn_store is None or not os.path.exists(os.path.join(knn_store, KNN_INDEX)):
+        return None
+    query = "SELECT file, k FROM knn_graphs WHERE fingerprint = ? AND metric = ? AND k >= ?"
+    values = [fingerprint, metric, int(k)]
+    if nn_method is not None:
+        query += " AND nn_method = ?"
+        values.append(str(nn_method))
+    with _connect(knn_store) as con:
+        hits = con.execute(query + " ORDER BY k", values).fetchall()
+    for fname, stored_k in hits:
+        try:
+            with np.load(os.path.join(knn_store, fname)) as graph:
+                distances = graph["distances"][:, :k]
+                indices = graph["indices"][:, :k]
+        except (OSError, KeyError, ValueError):
+            logging.warning("could not read kNN graph %s, skipping" % fname)
+            continue
+        logging.info("using the %i-NN graph %s for %i neighbors" % (stored_k, fname, k))
+        return distances, indices
+    return None
+
+
+def graph_to_knn(distances_graph):
+    """
+    dense kNN distances and indices, the cell itself first, from a scanpy distances graph
+    with the same number of neighbors in each row. Returns None if the rows differ.
+    """
+    D = distances_graph.tocsr()
+    n_nb = np.diff(D.indptr)
+    if D.shape[0] == 0 or (n_nb != n_nb[0]).any():
+        return None
+    dists = D.data.reshape(D.shape[0], n_nb[0])
+    idx = D.indices.reshape(D.shape[0], n_nb[0])
+    order = np.argsort(dists, axis=1, kind="stable")
+    dists = np.take_along_axis(dists, order, axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+    self_idx = np.arange(D.shape[0])[:, None]
+    return (np.hstack([np.zeros((D.shape[0], 1), dtype=dists.dtype), dists]),
+            np.hstack([self_idx.astype(idx.dtype), idx]))
+
+
+def knn_to_graph(distances, indices):
+    """
+    scanpy distances and umap connectivities graphs from dense kNN distances and indices
+    """
+    from scipy.sparse import coo_matrix, csr_matrix
+    from umap.umap_ import fuzzy_simplicial_set
+
+    n_obs, k = indices.shape
+    rows = np.repeat(np.arange(n_obs), k - 1)
+    D = csr_matrix((distances[:, 1:].ravel(), (rows, indices[:, 1:].ravel())), shape=(n_obs, n_obs))
+    D.eliminate_zeros()
+    connectivities = fuzzy_simplicial_set(
+        coo_matrix(([], ([], [])), shape=(n_obs, 1)), k, None, None,
+        knn_indices=indices, knn_dists=distances,
+        set_op_mix_ratio=1.0, local_connectivity=1.0)
+    if isinstance(connectivities, tuple):
+        # umap-learn >= 0.5 also returns sigmas and rhos
+        connectivities = connectivities[0]
+    return D, connectivities.tocsr()
+
+
+def set_neighbors(adata, distances, indices, metric="euclidean", use_rep=None, n_pcs=None):
+    """
+    store a kNN graph in adata as sc.pp.neighbors does
+    """
+    D, C = knn_to_graph(distances, indices)
+    adata.obsp["distances"] = D
+    adata.obsp["connectivities"] = C
+    params = {"n_neighbors": indices.shape[1], "method": "umap", "random_state": 0, "metric": metric}
+    if use_rep is not None:
+        params["use_rep"] = use_rep
+    if n_pcs is not None:
+        params["n_pcs"] = n_pcs
+    adata.uns["neighbors"] = {"connectivities_key": "connectivities",
+                              "distances_key": "distances",
+                              "params": params}
+
+
+# approximate nearest neighbor indices
+# a backend is a dict of build(X, metric, n_jobs), query(index, Y, k, n_jobs) -> (distances, indices),
+# save(index, folder) and load(folder, metric, n_obs, dim) functions; new backends are added to ANN_BACKENDS
+def _exact_prepare(X, metric, dtype=None):
+    X = np.asarray(X)
+    X = X.astype(dtype or (np.float32 if X.dtype == np.float32 else np.float64), copy=False)
+    if metric == "cosine":
+        X = X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+    elif metric != "euclidean":
+        raise ValueError("the exact backend supports the euclidean and cosine metrics")
+    return X
+
+
+def _exact_build(X, metric, n_jobs):
+    X = _exact_prepare(X, metric)
+    return {"X": X, "sq_norms": (X ** 2).sum(axis=1), "metric": metric}
+
+
+def _exact_query(index, Y, k, n_jobs, chunk_size=2048):
+    # brute force search with BLAS matrix products, in chunks of query rows
+    from threadpoolctl import threadpool_limits
+
+    X = index["X"]
+    Y = _exact_prepare(Y, index["metric"], dtype=X.dtype)
+    k = min(k, X.shape[0])
+    distances = np.empty((Y.shape[0], k), dtype=X.dtype)
+    indices = np.empty((Y.shape[0], k), dtype=np.int64)
+    with threadpool_limits(limits=int(n_jobs)):
+        for start in range(0, Y.shape[0], chunk_size):
+            yy = Y[start:start + chunk_size]
+            if index["metric"] == "cosine":
+                d = 1 - yy @ X.T
+            else:
+                d = (yy ** 2).sum(axis=1)[:, None] + index["sq_norms"][None, :] - 2 * yy @ X.T
+            np.maximum(d, 0, out=d)
+            part = np.argpartition(d, k - 1, axis=1)[:, :k] if k < X.shape[0] else \
+                np.broadcast_to(np.arange(X.shape[0]), d.shape)
+            dpart = np.take_along_axis(d, part, axis=1)
+            order = np.argsort(dpart, axis=1, kind="stable")
+            distances[start:start + chunk_size] = np.take_along_axis(dpart, order, axis=1)
+            indices[start:start + chunk_size] = np.take_along_axis(part, order, axis=1)
+    if index["metric"] == "euclidean":
+        distances = np.sqrt(distances)
+    return distances, indices
+
+
+def _exact_save(index, folder):
+    np.save(os.path.join(folder, "data.npy"), index["X"])
+
+
+def _exact_load(folder, metric, n_obs, dim):
+    X = np.load(os.path.join(folder, "data.npy"))
+    return {"X": X, "sq_norms": (X ** 2).sum(axis=1), "metric": metric}
+
+
+_HNSW_SPACES = {"euclidean": "l2", "cosine": "cosine", "ip": "ip"}
+
+
+def _hnswlib_build(X, metric, n_jobs, M=20, ef_construction=200):
+    # M and ef_construction as in pegasus, like the hnsw method of run_neighbors_method_choice
+    import hnswlib
+    index = hnswlib.Index(space=_HNSW_SPACES[metric], dim=X.shape[1])
+    index.init_index(max_elements=X.shape[0], ef_construction=ef_construction, M=M, random_seed=0)
+    index.add_items(X, np.arange(X.shape[0]), num_threads=int(n_jobs))
+    return index
+
+
+def _hnswlib_query(index, Y, k, n_jobs, ef=200):
+    index.set_ef(max(ef, k))
+    indices, distances = index.knn_query(Y, k=k, num_threads=int(n_jobs))
+    if index.space == "l2":
+        # hnswlib returns squared euclidean distances
+        distances = np.sqrt(np.maximum(distances, 0))
+    return distances, indices.astype(np.int64)
+
+
+def _hnswlib_save(index, folder):
+    index.save_index(os.path.join(folder, "index.bin"))
+
+
+def _hnswlib_load(folder, metric, n_obs, dim):
+    import hnswlib
+    index = hnswlib.Index(space=_HNSW_SPACES[metric], dim=dim)
+    index.load_index(os.path.join(folder, "index.bin"), max_elements=n_obs)
+    return index
+
+
+def _pynndescent_build(X, metric, n_jobs, n_neighbors=30):
+    from pynndescent import NNDescent
+    return NNDescent(X, metric=metric, n_neighbors=n_neighbors, n_jobs=int(n_jobs), random_state=0)
+
+
+def _pynndescent_query(index, Y, k, n_jobs):
+    index.prepare()
+    indices, distances = index.query(Y, k=k)
+    return distances, indices.astype(np.int64)
+
+
+def _pynndescent_save(index, folder):
+    import pickle
+    with open(os.path.join(folder, "index.pkl"), "wb") as f:
+        pickle.dump(index, f)
+
+
+def _pynndescent_load(folder, metric, n_obs, dim):
+    import pickle
+    with open(os.path.join(folder, "index.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+ANN_BACKENDS = {
+    "exact": dict(build=_exact_build, query=_exact_query, save=_exact_save, load=_exact_load),
+    "hnswlib": dict(build=_hnswlib_build, query=_hnswlib_query, save=_hnswlib_save, load=_hnswlib_load),
+    "pynndescent": dict(build=_pynndescent_build, query=_pynndescent_query,
+                        save=_pynndescent_save, load=_pynndescent_load),
+}
+
+
+def choose_ann_backend(n_obs, exact_max_n=20000):
+    """
+    the exact search for small numbers of cells, then hnswlib if it is installed, otherwise pynndescent
+    """
+    if n_obs <= exact_max_n:
+        return "exact"
+    try:
+        import hnswlib  # noqa: F401
+        return "hnswlib"
+    except ImportError:
+        return "pynndescent"
+
+
+def build_ann_index(X, backend="auto", metric="euclidean", n_jobs=1):
+    """
+    nearest neighbor index of the rows of X, with one of the ANN_BACKENDS or "auto"
+    """
+    X = np.asarray(X)
+    if backend == "auto":
+        backend = choose_ann_backend(X.shape[0])
+    if backend not in ANN_BACKENDS:
+        raise ValueError("unknown ANN backend %s, must be one of %s" % (backend, list(ANN_BACKENDS)))
+    logging.info("building %s index of %i cells" % (backend, X.shape[0]))
+    return {"backend": backend, "metric": metric, "n_obs": X.shape[0], "dim": X.shape[1],
+            "fingerprint": embedding_fingerprint(X),
+            "index": ANN_BACKENDS[backend]["build"](X, metric, n_jobs)}
+
+
+def query_ann_index(index, Y, k, n_jobs=1):
+    """
+    distances and indices of the k nearest indexed cells of each row of Y
+    """
+    return ANN_BACKENDS[index["backend"]]["query"](index["index"], np.asarray(Y), k, n_jobs)
+
+
+def self_knn(index, X, k, n_jobs=1):
+    """
+    the kNN graph of the indexed cells X, with each cell first in its own neighbors
+    as in scanpy and the knn store
+    """
+    distances, indices = query_ann_index(index, X, k, n_jobs)
+    cells = np.arange(indices.shape[0])
+    is_self = indices == cells[:, None]
+    # put the cell first, or in place of the last neighbor if the search missed it (duplicated cells)
+    pos = np.where(is_self.any(axis=1), is_self.argmax(axis=1), k - 1)
+    cols = np.arange(k)[None, :]
+    order = np.where(cols == 0, pos[:, None], np.where(cols <= pos[:, None], cols - 1, cols))
+    indices = np.take_along_axis(indices, order, axis=1)
+    distances = np.take_along_axis(distances, order, axis=1)
+    indices[:, 0] = cells
+    distances[:, 0] = 0
+    return distances, indices
+
+
+def ann_index_path(fname, rep, metric="euclidean"):
+    """
+    folder of the index of the embedding rep, next to the h5mu/h5ad fname
+    """
+    return "%s.%s_%s.ann" % (os.path.splitext(fname)[0], rep, metric)
+
+
+def save_ann_index(index, folder):
+    tmp = "%s.%i.tmp" % (folder.rstrip("/"), os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    ANN_BACKENDS[index["backend"]]["save"](index["index"], tmp)
+    with open(os.path.join(tmp, "index.json"), "w") as f:
+        json.dump({k: v for k, v in index.items() if k != "index"}, f)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp, folder)
+
+
+def load_ann_index(folder, X=None):
+    """
+    load an index saved with save_ann_index. If X is given, returns None unless
+    the index was built on X
+    """
+    if not os.path.exists(os.path.join(folder, "index.json")):
+        return None
+    with open(os.path.join(folder, "index.json")) as f:
+        mtd = json.load(f)
+    if X is not None and mtd["fingerprint"] != embedding_fingerprint(X):
+        logging.info("the index in %s was built on another embedding" % folder)
+        return None
+    backend = ANN_BACKENDS[mtd["backend"]]
+    mtd["index"] = backend["load"](folder, mtd["metric"], mtd["n_obs"], mtd["dim"])
+    return mtd
+
+
+def get_ann_index(X, folder=None, backend="auto", metric="euclidean", n_jobs=1):
+    """
+    the index of X saved in folder, or a new one, which is saved in folder if given
+    """
+    if folder is not None:
+        index = load_ann_index(folder, X)
+        if index is not None and index["metric"] == metric and backend in ["auto", index["backend"]]:
+            logging.info("reusing the %s index in %s" % (index["backend"], folder))
+            return index
+    index = build_ann_index(X, backend=backend, metric=metric, n_jobs=n_jobs)
+    if folder is not None:
+        save_ann_index(index, folder)
+    return index
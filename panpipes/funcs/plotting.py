@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from scanpy.get import obs_df
 from matplotlib.pyplot import get_cmap
+import hashlib
 import itertools
 import logging
 from matplotlib import use
@@ -272,24 +273,102 @@ def scatter_fg_vs_bg(mdata, mdata_raw, x, y, facet_row=None):
 
 
 
-from sklearn.neighbors import KernelDensity
-def _kde_curve(xx, df, bandwidth=0.1):
-    X=df.loc[:,xx].values[:, np.newaxis]
-    kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(X) 
-    x=np.linspace(X.min().min(),X.max().max(),100)[:, np.newaxis]
-    log_density_values=kde.score_samples(x)
-    density=np.exp(log_density_values).ravel()
-    return x.ravel(), density
+def _binned_kde(values, bandwidth=0.1, n_points=100, n_bins=2048):
+    """
+    gaussian kernel densities of each column of values (cells x features) on n_points
+    between the column min and max.
+    The values are binned on a grid of n_bins per feature and convolved with the kernel in
+    Fourier space, all features at once. NaN values are ignored.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_feat = values.shape[1]
+    finite = np.isfinite(values)
+    lo = np.nanmin(np.where(finite, values, np.nan), axis=0)
+    hi = np.nanmax(np.where(finite, values, np.nan), axis=0)
+    # a constant feature gets a range of one bandwidth around its value
+    const = ~(hi > lo)
+    lo = np.where(const, lo - bandwidth / 2, lo)
+    hi = np.where(const, hi + bandwidth / 2, hi)
+    # the grid extends by 4 bandwidths so the densities at the ends are not cut
+    grid_lo = lo - 4 * bandwidth
+    width = (hi - lo + 8 * bandwidth) / n_bins
+    idx = np.floor((values - grid_lo) / width)
+    idx = np.clip(np.nan_to_num(idx, nan=0), 0, n_bins - 1).astype(np.int64)
+    idx = idx + np.arange(n_feat) * n_bins
+    counts = np.bincount(idx[finite], minlength=n_feat * n_bins).reshape(n_feat, n_bins).astype(np.float64)
+    n_obs = finite.sum(axis=0)
+    # zero padding to 2 * n_bins avoids the wrap around of the circular convolution
+    freqs = np.fft.rfftfreq(2 * n_bins)
+    sigma = bandwidth / width
+    kernel_ft = np.exp(-2 * (np.pi * freqs[np.newaxis, :] * sigma[:, np.newaxis]) ** 2)
+    smoothed = np.fft.irfft(np.fft.rfft(counts, n=2 * n_bins, axis=1) * kernel_ft, n=2 * n_bins, axis=1)[:, :n_bins]
+    density = np.clip(smoothed, 0, None) / (np.maximum(n_obs, 1) * width)[:, np.newaxis]
+    xx = np.linspace(lo, hi, n_points).T
+    centers = grid_lo[:, np.newaxis] + (np.arange(n_bins) + 0.5) * width[:, np.newaxis]
+    yy = np.vstack([np.interp(xx[i], centers[i], density[i]) for i in range(n_feat)])
+    return xx, yy
+
+
+def kde_densities(adata, layer=None, bandwidth=0.1, n_points=100, block_size=32):
+    """
+    binned kernel densities of all features of a layer of adata (see _binned_kde).
+    The densities are cached in adata.uns["kde"] keyed by layer and bandwidth, with a checksum
+    of the layer (sum and sum of squares of the values) and of the feature names so that
+    they are recomputed if the layer changes.
+    returns a dict with "features", "x" and "density" (features x n_points)
+    """
+    arr = adata.X if layer is None else adata.layers[layer]
+    values = arr.data if issparse(arr) else np.asarray(arr)
+    # the sum alone does not change with the values of centred layers such as CLR
+    checksum = "%i_%i_%r_%r_%s" % (adata.n_obs, adata.n_vars,
+                                   float(np.nansum(values, dtype=np.float64)),
+                                   float(np.nansum(np.square(values, dtype=np.float64))),
+                                   hashlib.md5("\n".join(adata.var_names).encode()).hexdigest())
+    key = "%s_%s" % ("X" if layer is None else layer, bandwidth)
+    cached = adata.uns.get("kde", {}).get(key)
+    if cached is not None and str(cached["checksum"]) == checksum \
+            and np.asarray(cached["x"]).shape[1] == n_points:
+        return cached
+    # features are densified in blocks to bound the memory
+    curves = []
+    for start in range(0, adata.n_vars, block_size):
+        values = arr[:, start:start + block_size]
+        values = values.toarray() if issparse(values) else values
+        curves.append(_binned_kde(values, bandwidth=bandwidth, n_points=n_points))
+    res = {"features": np.array(adata.var_names, dtype=object),
+           "x": np.vstack([c[0] for c in curves]),
+           "density": np.vstack([c[1] for c in curves]),
+           "checksum": checksum}
+    if adata.is_view:
+        # setting uns would make a copy of the view
+        return res
+    if "kde" not in adata.uns:
+        adata.uns["kde"] = {}
+    adata.uns["kde"][key] = res
+    return res
+
 
 def ridgeplot(adata, features, layer=None, splitplot=3, bandwidth=0.1):
     """
     # code based on https://github.com/rougier/scientific-visualization-book/blob/master/code/anatomy/zorder-plots.py
+    the densities of var features are computed for the whole layer at once and cached in adata.uns["kde"]
     """
     # get data 
-    if layer is not None:
-        df = obs_df(adata, keys=features, layer=layer)
+    if all(f in adata.var_names for f in features):
+        kde = kde_densities(adata, layer=layer, bandwidth=bandwidth)
+        pos = pd.Index(kde["features"]).get_indexer(features)
+        if (pos < 0).any():
+            raise KeyError("features %s not found in the densities of %s"
+                           % (list(np.asarray(features)[pos < 0]), "X" if layer is None else layer))
+        curves = {f: (kde["x"][i], kde["density"][i]) for f, i in zip(features, pos)}
     else:
-        df = obs_df(adata, keys=features)
+        # e.g. obs columns, not cached
+        if layer is not None:
+            df = obs_df(adata, keys=features, layer=layer)
+        else:
+            df = obs_df(adata, keys=features)
+        xx, yy = _binned_kde(df.values, bandwidth=bandwidth)
+        curves = {f: (xx[i], yy[i]) for i, f in enumerate(features)}
 
     ncols = splitplot
     nrows = int(np.ceil(len(features)/ncols))
@@ -308,7 +387,7 @@ def ridgeplot(adata, features, layer=None, splitplot=3, bandwidth=0.1):
         features_sub = features[n*nrows: n*nrows+nrows]
         # print(features_sub)
         for i, feat in enumerate(features_sub):
-            X, Y = _kde_curve(feat, df, bandwidth=bandwidth)
+            X, Y = curves[feat]
             ax.plot(X, 1.5 * Y + i, color="k", linewidth=0.75, zorder=100 - i)
             color = cmap(i / len(features_sub))
             ax.fill_between(X, 1.5 * Y + i, i, color=color, zorder=100 - i)
@@ -4,6 +4,8 @@ import warnings
 import logging
 import os 
 import re
+import tempfile
+import h5py
 import numpy as np
 import pandas as pd
 import muon as mu
@@ -15,10 +17,21 @@ from scanpy.get import obs_df
 from scanpy.pp import subsample
 from muon import MuData
 from anndata import AnnData
+from anndata.utils import make_index_unique
+from scipy.sparse import csr_matrix
 # from muon.pp import intersect_obs
 from random import sample
 from functools import reduce
 
+try:
+    from anndata.io import read_elem, write_elem
+except ImportError:
+    from anndata.experimental import read_elem, write_elem
+try:
+    from anndata.experimental import concat_on_disk
+except ImportError:
+    concat_on_disk = None
+
 
 def is_float_try(string):
     """
@@ -105,6 +118,60 @@ def intersect_obs_by_mod(mdata: MuData, mods:list =None):
     return
 
 
+# filter dictionary rules: keep the values that are <= max, >= min or == bool
+_FILTER_RULES = {
+    "max": (lambda x, n: x <= n, "to less than"),
+    "min": (lambda x, n: x >= n, "to more than"),
+    "bool": (lambda x, n: x == n, "marked"),
+}
+
+
+def filter_masks(adata: AnnData, mod_filters: dict, mod: str = ""):
+    """
+    Compile the rules of a modality of the filter dictionary, e.g.
+    {"obs": {"min": {"n_genes_by_counts": 500}, "max": {...}, "bool": {...}}, "var": {...}},
+    into one boolean mask per axis, evaluated on the obs and var columns.
+    Returns the obs and var masks, adata is not modified.
+    """
+    masks = {}
+    for marg, df, what in [("obs", adata.obs, "cells"), ("var", adata.var, "features")]:
+        mask = np.ones(df.shape[0], dtype=bool)
+        rules = mod_filters.get(marg, {}) if isinstance(mod_filters, dict) else {}
+        for rule, (func, desc) in _FILTER_RULES.items():
+            for col, n in rules.get(rule, {}).items():
+                mask &= np.asarray(func(df[col].values, n), dtype=bool)
+                logging.info("Filtering %s of modality '%s' by '%s' in %s %s %s, remaining %s %d"
+                             % (what, mod, col, marg, desc, n, what, mask.sum()))
+        masks[marg] = mask
+    return masks["obs"], masks["var"]
+
+
+def filter_mudata(mdata: MuData, filter_dict: dict, intersect_mods: list = None):
+    """
+    Filter the modalities of mdata in-place with the filter dictionary (see filter_masks),
+    then intersect the cells of the modalities in intersect_mods (as intersect_obs_by_mod).
+    The rules and the intersection are combined into one mask per modality and axis,
+    so each modality is subset (and copied) once.
+    """
+    masks = {}
+    for mod in mdata.mod.keys():
+        if mod in filter_dict.keys():
+            masks[mod] = filter_masks(mdata[mod], filter_dict[mod], mod=mod)
+        else:
+            masks[mod] = (np.ones(mdata[mod].n_obs, dtype=bool), np.ones(mdata[mod].n_vars, dtype=bool))
+    if intersect_mods is not None:
+        if len(intersect_mods) < 2:
+            raise ValueError("cannot run intersect_obs on one modality")
+        common_obs = reduce(np.intersect1d, [mdata[x].obs_names[masks[x][0]] for x in intersect_mods])
+        for mod in mdata.mod.keys():
+            masks[mod] = (masks[mod][0] & mdata[mod].obs_names.isin(common_obs), masks[mod][1])
+    for mod, (obs_mask, var_mask) in masks.items():
+        if not (obs_mask.all() and var_mask.all()):
+            mdata.mod[mod] = mdata.mod[mod][obs_mask, var_mask].copy()
+        logging.info("Remaining in modality '%s': %d cells and %d features" % (mod, obs_mask.sum(), var_mask.sum()))
+    mdata.update()
+
+
 def setdiff_obs_by_mod(mdata: MuData, x: str, y:str):
     """
     Subset observations (samples or cells) in-place by set difference
@@ -322,19 +389,112 @@ def concat_mdatas(mdata_list, batch_key, join_type="inner"):
         mdata = MuData(concat_adatas)
         # for sf in slots_filled:
         #     mdata[sf].obs[batch_key] ==concat_adatas[sf].obs[batch_key]
-        
-        # make sure sample id is in the top obs (updated to not put extra rep columns in top obs)
-        # changed to deal with circumstances where a category is missing from one modality
-        all_sample_id_df = mdata.obs.iloc[:,mdata.obs.columns.str.endswith(":sample_id")]
-        # first it needs to not be a category for the merge.
-        all_sample_id_df = all_sample_id_df.apply(lambda x: x.astype('object'))
-        mdata.obs['sample_id']  = all_sample_id_df.fillna('').astype(str).apply(lambda x: ' '.join(set(' '.join(x).split())), axis=1)
-        # then turn it back into a category
-        mdata.obs['sample_id'] = mdata.obs['sample_id'].astype('category')
+        _add_top_level_sample_id(mdata)
         return mdata
     else:
         return mdata_list[0]
 
+
+def _add_top_level_sample_id(mdata):
+    # make sure sample id is in the top obs (updated to not put extra rep columns in top obs)
+    # changed to deal with circumstances where a category is missing from one modality
+    all_sample_id_df = mdata.obs.iloc[:,mdata.obs.columns.str.endswith(":sample_id")]
+    # first it needs to not be a category for the merge.
+    all_sample_id_df = all_sample_id_df.apply(lambda x: x.astype('object'))
+    mdata.obs['sample_id']  = all_sample_id_df.fillna('').astype(str).apply(lambda x: ' '.join(set(' '.join(x).split())), axis=1)
+    # then turn it back into a category
+    mdata.obs['sample_id'] = mdata.obs['sample_id'].astype('category')
+
+
+def _link_modality_h5ad(fname, mod, tmp_file):
+    """
+    write an h5ad in tmp_file whose elements are external links to modality mod of the h5mu fname,
+    so that it can be read as an AnnData without copying the data.
+    var names are made unique as in concat_mdatas, in which case var is written instead of linked.
+    returns obs and var of the modality
+    """
+    fname = os.path.abspath(fname)
+    with h5py.File(fname, "r", locking=False) as f, h5py.File(tmp_file, "w") as tmp:
+        grp = f["mod"][mod]
+        for k, v in grp.attrs.items():
+            tmp.attrs[k] = v
+        obs = read_elem(grp["obs"])
+        var = read_elem(grp["var"])
+        var.index = make_index_unique(var.index)
+        for k in grp.keys():
+            if k == "var" and not var.index.equals(read_elem(grp["var"]).index):
+                write_elem(tmp, "var", var)
+            else:
+                tmp[k] = h5py.ExternalLink(fname, "/mod/%s/%s" % (mod, k))
+    return obs, var
+
+
+def concat_mdatas_on_disk(files, out_file, batch_key, join_type="inner", tmp_dir=None,
+                          max_loaded_elems=100_000_000, update_metadata=None):
+    """
+    Out-of-core version of concat_mdatas for a list of h5mu files, writing the result to out_file.
+
+    Each modality is concatenated with anndata's concat_on_disk, reading the samples one at
+    a time in blocks of at most max_loaded_elems non-zero elements. obs, var and the top level
+    sample_id are built from the (small) per sample obs and var with the same
+    AnnData.concatenate call as concat_mdatas, so batch_key, obs names and the inner/outer
+    join_type handling are identical.
+    update_metadata, if given, is called on the MuData with empty matrices before it is
+    written, so obs can be edited without loading the data; it must keep the obs and var names.
+    """
+    if concat_on_disk is None:
+        raise ImportError("concat_mdatas_on_disk requires anndata>=0.10 (anndata.experimental.concat_on_disk)")
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(out_file))
+    mods = {}
+    for fname in files:
+        with h5py.File(fname, "r", locking=False) as f:
+            mods[fname] = list(f["mod"].keys())
+    # modalities in order of appearance (not all samples have all modalities, e.g. rep)
+    slots_filled = list(dict.fromkeys(chain(*mods.values())))
+    logging.debug(slots_filled)
+    concat_adatas = {}
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        for sf in slots_filled:
+            logging.info("concatenating %s on disk" % sf)
+            sf_files = [fname for fname in files if sf in mods[fname]]
+            tmp_files = []
+            light_adatas = []
+            for ii, fname in enumerate(sf_files):
+                tmp_file = os.path.join(tmp, "%s_%i.h5ad" % (sf, ii))
+                obs, var = _link_modality_h5ad(fname, sf, tmp_file)
+                tmp_files.append(tmp_file)
+                light_adatas.append(AnnData(csr_matrix((obs.shape[0], var.shape[0]), dtype=np.float32),
+                                            obs=obs, var=var))
+            batches = [x.obs[batch_key].iloc[0] for x in light_adatas]
+            concat_adatas[sf] = light_adatas[0].concatenate(light_adatas[1:],
+                                    batch_key=batch_key,
+                                    batch_categories=batches,
+                                    join=join_type)
+            concat_on_disk(tmp_files, os.path.join(tmp, "%s.h5ad" % sf),
+                           join=join_type, label=batch_key, keys=batches, index_unique="-",
+                           max_loaded_elems=max_loaded_elems)
+        # write the mudata with empty matrices, then fill in the concatenated matrices
+        mdata = MuData(concat_adatas)
+        _add_top_level_sample_id(mdata)
+        if update_metadata is not None:
+            update_metadata(mdata)
+        names = {sf: (mdata[sf].obs_names, mdata[sf].var_names) for sf in slots_filled}
+        mdata.write(out_file)
+        del mdata
+        with h5py.File(out_file, "r+") as out:
+            for sf in slots_filled:
+                with h5py.File(os.path.join(tmp, "%s.h5ad" % sf), "r", locking=False) as f:
+                    if not pd.Index(read_elem(f["obs"]).index).equals(names[sf][0]) or \
+                            not pd.Index(read_elem(f["var"]).index).equals(names[sf][1]):
+                        raise ValueError("on disk concatenation of %s does not match its obs/var" % sf)
+                    for k in ["X", "layers", "obsm", "raw"]:
+                        if k in out["mod"][sf]:
+                            del out["mod"][sf][k]
+                        if k in f:
+                            f.copy(f[k], out["mod"][sf], name=k)
+
+
 def concat_adata_list(adata_list, use_muon, **kwargs):
     if use_muon:
         out = concat_mdatas(adata_list, **kwargs)
@@ -360,6 +520,30 @@ def remove_unused_categories(df: pd.DataFrame):
             df[c] = df[c].cat.remove_unused_categories()
     
 
+def combine_batch_labels(df: pd.DataFrame, columns: list):
+    """
+    one categorical label per row for the combination of the values in columns,
+    named "a|b|...", built from the categorical codes of each column.
+    Rows with a missing value in any of the columns get a missing label.
+    """
+    codes = []
+    uniques = []
+    for c in columns:
+        cc, uu = pd.factorize(df[c], sort=True)
+        codes.append(cc)
+        uniques.append(uu)
+    codes = np.vstack(codes)
+    missing = (codes < 0).any(axis=0)
+    flat = np.ravel_multi_index(np.where(codes < 0, 0, codes),
+                                [max(len(uu), 1) for uu in uniques])
+    out = np.full(df.shape[0], -1)
+    out[~missing], combs = pd.factorize(flat[~missing], sort=True)
+    comb_codes = np.unravel_index(combs, [max(len(uu), 1) for uu in uniques])
+    categories = ["|".join(str(uu[cc]) for uu, cc in zip(uniques, comb))
+                  for comb in zip(*comb_codes)]
+    return pd.Categorical.from_codes(out, categories=categories)
+
+
 def mu_get_obs(mdata, features=[],modalities=[], layers=None):
     """
     returns pandas dataframe of features, having searched all layers for said features
@@ -1,3 +1,4 @@
+import hashlib
 import pandas as pd
 import numpy as np
 # from scanpy.pp import normalize_total
@@ -14,33 +15,139 @@ from muon import MuData
 from anndata import AnnData
 import os
 from matplotlib.pyplot import savefig
-from statsmodels.distributions.empirical_distribution import ECDF
 
 from .plotting import ridgeplot
 from .io import write_10x_counts
-from .processing import check_for_bool, which_ind
+from .processing import check_for_bool
+from . import knn
 import matplotlib
 import matplotlib.pyplot as plt
 
 
-def lsi(adata, num_components):
+def _row_chunks(X, chunk_size, cols=None):
+    """
+    iterate over (start, chunk) of the rows of X, an in-memory matrix, an h5py dataset
+    or an anndata backed sparse dataset, keeping only cols (column indices) if given
+    """
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = X[start:start + chunk_size]
+        if cols is not None:
+            chunk = chunk[:, cols]
+        yield start, chunk
+
+
+def randomized_svd_chunked(row_chunks, shape, n_comps, n_oversamples=10, n_iter=4, random_state=0):
+    """
+    Truncated SVD by randomised subspace iteration (Halko et al. 2011) of a matrix that is
+    only accessed by row chunks, so it never has to be held in memory (or densified).
+    row_chunks() must return a new iterator over (start, chunk) of the matrix rows.
+    Each power iteration reads the matrix twice, the whole SVD reads it 2 * n_iter + 2 times.
+
+    :param shape: (n_obs, n_vars) of the matrix
+    :param n_oversamples: number of random vectors in addition to n_comps
+    :param n_iter: number of power iterations
+    :return: U (n_obs x n_comps), s (n_comps), Vt (n_comps x n_vars)
+    """
+    n_obs, n_vars = shape
+    rng = np.random.default_rng(random_state)
+    n_rand = min(n_comps + n_oversamples, n_obs, n_vars)
+
+    def mult(B):
+        # X @ B
+        Y = np.empty((n_obs, B.shape[1]))
+        for start, chunk in row_chunks():
+            Y[start:start + chunk.shape[0]] = np.asarray(chunk @ B)
+        return Y
+
+    def rmult(Q):
+        # X.T @ Q
+        Z = np.zeros((n_vars, Q.shape[1]))
+        for start, chunk in row_chunks():
+            Z += np.asarray(chunk.T @ Q[start:start + chunk.shape[0]])
+        return Z
+
+    Q, _ = np.linalg.qr(mult(rng.standard_normal((n_vars, n_rand))))
+    for _ in range(n_iter):
+        # re-orthonormalise after each multiplication to keep the small singular vectors
+        Z, _ = np.linalg.qr(rmult(Q))
+        Q, _ = np.linalg.qr(mult(Z))
+    # B = Q.T @ X is small (n_rand x n_vars)
+    Ub, s, Vt = np.linalg.svd(rmult(Q).T, full_matrices=False)
+    U = Q @ Ub[:, :n_comps]
+    s, Vt = s[:n_comps], Vt[:n_comps]
+    # deterministic signs: the largest loading of each component of U is positive
+    signs = np.sign(U[np.argmax(np.abs(U), axis=0), np.arange(U.shape[1])])
+    signs[signs == 0] = 1
+    return U * signs, s, Vt * signs[:, np.newaxis]
+
+
+def lsi(adata, num_components, svd_solver="arpack", n_oversamples=10, n_iter=4, chunk_size=50000,
+        backed_X=None, random_state=0):
     """
     Runs LSI on adata.X and uses HVFs if adata.var["highly_variable"] is present. Otherwise, runs LSI on all features.
+    The result is stored like muon.atac.tl.lsi does: scaled embeddings in adata.obsm["X_lsi"],
+    loadings in adata.varm["LSI"] (0 for non HVFs) and the stdev in adata.uns["lsi"]["stdev"].
 
     :param adata: anndata to run LSI on
     :param num_components: number of components to compute
+    :param svd_solver: "arpack" runs muon's LSI on the whole matrix, "randomized" runs a randomised
+        SVD reading the matrix in row chunks (see randomized_svd_chunked)
+    :param n_oversamples: randomized only, number of oversampling vectors
+    :param n_iter: randomized only, number of power iterations
+    :param chunk_size: randomized only, number of rows read at a time
+    :param backed_X: randomized only, (h5ad/h5mu file, key) of a matrix to stream from disk instead
+        of adata.X, e.g. ("mdata.h5mu", "/mod/atac/X"). Its rows and columns must match adata.
+    :param random_state: seed of the randomized solver
     """
-
-    if "highly_variable" in adata.var.columns:
-        adata_hvfs = adata[:, adata.var["highly_variable"]]
-        mu.atac.tl.lsi(adata_hvfs, n_comps=num_components)
-        # save output to original anndata
-        adata.obsm["X_lsi"] = adata_hvfs.obsm['X_lsi']
-        adata.uns["lsi"] = adata_hvfs.uns['lsi']
-        adata.varm["LSI"] = np.zeros(shape=(adata.n_vars, adata_hvfs.varm["LSI"].shape[1]))
-        adata.varm["LSI"][adata.var["highly_variable"]] = adata_hvfs.varm['LSI']
+    hvf = adata.var["highly_variable"].values.astype(bool) if "highly_variable" in adata.var.columns else None
+    if svd_solver == "arpack" and backed_X is None:
+        if hvf is not None:
+            adata_hvfs = adata[:, hvf]
+            mu.atac.tl.lsi(adata_hvfs, n_comps=num_components)
+            # save output to original anndata
+            adata.obsm["X_lsi"] = adata_hvfs.obsm['X_lsi']
+            adata.uns["lsi"] = adata_hvfs.uns['lsi']
+            adata.varm["LSI"] = np.zeros(shape=(adata.n_vars, adata_hvfs.varm["LSI"].shape[1]))
+            adata.varm["LSI"][hvf] = adata_hvfs.varm['LSI']
+        else:
+            mu.atac.tl.lsi(adata, n_comps=num_components)
+        return
+    if svd_solver not in ["arpack", "randomized"]:
+        raise ValueError("svd_solver %s not recognised, please choose arpack or randomized" % svd_solver)
+    # the HVFs are selected chunk by chunk, the subset matrix is never made
+    cols = np.where(hvf)[0] if hvf is not None else None
+    n_vars = len(cols) if cols is not None else adata.n_vars
+    n_comps = min(num_components, n_vars)
+    if backed_X is not None:
+        import h5py
+        try:
+            from anndata.io import sparse_dataset
+        except ImportError:
+            from anndata.experimental import sparse_dataset
+        fname, key = backed_X
+        f = h5py.File(fname, "r", locking=False)
+        X = sparse_dataset(f[key]) if isinstance(f[key], h5py.Group) else f[key]
+    else:
+        f = None
+        X = adata.X
+    if X.shape != adata.shape:
+        raise ValueError("the matrix to run LSI on has shape %s, expected %s" % (X.shape, adata.shape))
+    try:
+        U, s, Vt = randomized_svd_chunked(lambda: _row_chunks(X, int(chunk_size), cols),
+                                          shape=(adata.n_obs, n_vars), n_comps=n_comps,
+                                          n_oversamples=int(n_oversamples), n_iter=int(n_iter),
+                                          random_state=random_state)
+    finally:
+        if f is not None:
+            f.close()
+    # same scaling and stdev as muon.atac.tl.lsi
+    adata.obsm["X_lsi"] = (U - U.mean(axis=0)) / U.std(axis=0)
+    adata.uns["lsi"] = {"stdev": s / np.sqrt(adata.n_obs - 1)}
+    if cols is not None:
+        adata.varm["LSI"] = np.zeros(shape=(adata.n_vars, n_comps))
+        adata.varm["LSI"][cols] = Vt.T
     else:
-        mu.atac.tl.lsi(adata, n_comps=num_components)
+        adata.varm["LSI"] = Vt.T
 
 
 def cell2loc_filter_genes(adata, fig_path, cell_count_cutoff=15, cell_percentage_cutoff2=0.05, nonz_mean_cutoff=1.12):
@@ -89,7 +196,36 @@ def cell2loc_filter_genes(adata, fig_path, cell_count_cutoff=15, cell_percentage
 
 
 
-def findTopFeatures_pseudo_signac(adata, min_cutoff):
+def _feature_counts(X, chunk_size=50000):
+    """
+    total counts and number of cells with non zero counts of each feature (column) of X,
+    read from the arrays of a sparse matrix without copying it, or row chunk by row chunk
+    for dense and backed (h5py / anndata sparse dataset) matrices
+    """
+    n_vars = X.shape[1]
+    if issparse(X) and X.format == "csr":
+        nz = X.data != 0
+        return (np.bincount(X.indices, weights=X.data, minlength=n_vars),
+                np.bincount(X.indices[nz], minlength=n_vars))
+    if issparse(X) and X.format == "csc":
+        col = np.repeat(np.arange(n_vars), np.diff(X.indptr))
+        nz = X.data != 0
+        return (np.bincount(col, weights=X.data, minlength=n_vars),
+                np.bincount(col[nz], minlength=n_vars))
+    total_counts = np.zeros(n_vars)
+    n_cells = np.zeros(n_vars, dtype=np.int64)
+    for _, chunk in _row_chunks(X, chunk_size):
+        if issparse(chunk):
+            chunk_total, chunk_cells = _feature_counts(chunk.tocsr())
+        else:
+            chunk = np.asarray(chunk)
+            chunk_total, chunk_cells = chunk.sum(axis=0), np.count_nonzero(chunk, axis=0)
+        total_counts += chunk_total
+        n_cells += chunk_cells
+    return total_counts, n_cells
+
+
+def findTopFeatures_pseudo_signac(adata, min_cutoff, backed_X=None, chunk_size=50000):
     # Adapted from:
     # https://stuartlab.org/signac/reference/findtopfeatures
     """
@@ -100,40 +236,48 @@ def findTopFeatures_pseudo_signac(adata, min_cutoff):
         "tc[x]": "tc" followed by a minimum total count, e.g. tc100 will set features with total counts > 100 as highly variable
         "NULL": All features are assigned as highly variable
         "NA": Highly variable features won't be changed
+    :param backed_X: (h5ad/h5mu file, key) of the raw counts to read in chunks of chunk_size cells
+        instead of adata.layers["raw_counts"], e.g. ("mdata.h5mu", "/mod/atac/layers/raw_counts")
     :return: Percentile rank of each feature stored in "adata.var["percentile"], highly variable features stored in adata.var["highly_variable"].
     "total_counts" and "n_cells_by_counts" also saved, if not present.
     Filtering is done according to the "min_cutoff" parameter. If min_cutoff == NA, adata.var["highly_variable"] won't be changed
     """
-    if "total_counts" not in adata.var:
-        adata.var["total_counts"] = np.ravel(adata.layers["raw_counts"].sum(axis=0))
-    if "n_cells_by_counts" not in adata.var:
-        if issparse(adata.layers["raw_counts"]):
-            adata.var["n_cells_by_counts"] = adata.layers["raw_counts"].getnnz(axis=0)
+    if "total_counts" not in adata.var or "n_cells_by_counts" not in adata.var:
+        # both statistics come from one pass over the counts
+        if backed_X is not None:
+            import h5py
+            try:
+                from anndata.io import sparse_dataset
+            except ImportError:
+                from anndata.experimental import sparse_dataset
+            with h5py.File(backed_X[0], "r", locking=False) as f:
+                X = sparse_dataset(f[backed_X[1]]) if isinstance(f[backed_X[1]], h5py.Group) else f[backed_X[1]]
+                total_counts, n_cells = _feature_counts(X, chunk_size=chunk_size)
         else:
-            adata.var["n_cells_by_counts"] = np.count_nonzero(adata.layers["raw_counts"], axis=0)
-
+            total_counts, n_cells = _feature_counts(adata.layers["raw_counts"], chunk_size=chunk_size)
+        if "total_counts" not in adata.var:
+            adata.var["total_counts"] = total_counts
+        if "n_cells_by_counts" not in adata.var:
+            adata.var["n_cells_by_counts"] = n_cells
 
     if "percentile" not in adata.var:
-        # fit ecdf
-        ecdf = ECDF(adata.var["total_counts"])
-        extracted = adata.var[["total_counts"]]
-        extracted = extracted.sort_values("total_counts", ascending=False)
-        # add decreasingly ordered percentiles to dataframe:
-        extracted["percentile"] = -np.sort(-ecdf.y)[:-1]  # last percentile always corresponds to the percentile of -Inf
-        # merge with adata.var
-        adata.var = pd.merge(adata.var, extracted.drop("total_counts", axis=1), left_index=True, right_index=True)
+        # ecdf of the total counts: the feature with the k-th smallest total count gets k / n_vars
+        total_counts = adata.var["total_counts"].to_numpy()
+        percentile = np.empty(len(total_counts))
+        percentile[np.argsort(total_counts, kind="stable")] = np.arange(1, len(total_counts) + 1) / len(total_counts)
+        adata.var["percentile"] = percentile
 
     if min_cutoff.startswith("q"):  # quantile filtering
         min_cutoff = int(min_cutoff[1:]) / 100
-        adata.var['highly_variable'] = [True if percentile > min_cutoff else False for percentile in adata.var["percentile"]]
+        adata.var['highly_variable'] = adata.var["percentile"].to_numpy() > min_cutoff
         return
     if min_cutoff.startswith("c"):  # filtering by minimum number of cells
         min_cutoff = int(min_cutoff[1:])
-        adata.var['highly_variable'] = [True if ncells > min_cutoff else False for ncells in adata.var["n_cells_by_counts"]]
+        adata.var['highly_variable'] = adata.var["n_cells_by_counts"].to_numpy() > min_cutoff
         return
     if min_cutoff.startswith("tc"):  # filtering by total counts
         min_cutoff = int(min_cutoff[2:])
-        adata.var['highly_variable'] = [True if totalcounts > min_cutoff else False for totalcounts in adata.var["total_counts"]]
+        adata.var['highly_variable'] = adata.var["total_counts"].to_numpy() > min_cutoff
         return
     if min_cutoff == "NA":  # don't change variable features
         return
@@ -192,6 +336,86 @@ def exp_mean_dense(x):
     # convert out of compressed sparse matrix
     return np.log((np.sum(np.exp(x)-1)/x.shape[1]) + 1)
 
+def _group_detection_and_expsum(X, codes, n_groups, chunk_size=20000):
+    """
+    One pass over the cells of X (in row chunks) that sums, per group and feature,
+    the number of cells with a value > 0 and the expm1 of the values.
+    codes gives the group index (0..n_groups-1) of each cell.
+    """
+    from scipy.sparse import csr_matrix
+    n_cells, n_features = X.shape
+    n_detected = np.zeros((n_groups, n_features))
+    exp_sum = np.zeros((n_groups, n_features))
+    for start in range(0, n_cells, chunk_size):
+        block = X[start:start + chunk_size]
+        n_block = block.shape[0]
+        indicator = csr_matrix((np.ones(n_block), (codes[start:start + n_block], np.arange(n_block))),
+                               shape=(n_groups, n_block))
+        if issparse(block):
+            detected = block.copy()
+            detected.data = (detected.data > 0).astype(np.float64)
+            expm1 = block.copy()
+            expm1.data = np.expm1(expm1.data)
+            n_detected += (indicator @ detected).toarray()
+            exp_sum += (indicator @ expm1).toarray()
+        else:
+            block = np.asarray(block)
+            n_detected += indicator @ (block > 0).astype(np.float64)
+            exp_sum += indicator @ np.expm1(block)
+    return n_detected, exp_sum
+
+
+def _pseudo_seurat_stats(var_names, n_cluster, n_other,
+                         detected_cluster, detected_other,
+                         exp_sum_cluster, exp_sum_other,
+                         arg_minpct=0.1,
+                         arg_mindiffpct=-float("inf"),
+                         arg_logfcdiff=0.25):
+    """
+    Derive the pseudo seurat filtering statistics for one cluster vs the other cells
+    from the group totals computed by _group_detection_and_expsum
+    """
+    cluster_pct = detected_cluster / n_cluster
+    other_pct = detected_other / n_other
+    max_pct = np.maximum(cluster_pct, other_pct)
+    min_pct = np.minimum(cluster_pct, other_pct)
+    diff_pct = max_pct - min_pct
+    # log of the mean of the not-logged data
+    cluster_mean = np.log(exp_sum_cluster / n_cluster + 1)
+    other_mean = np.log(exp_sum_other / n_other + 1)
+    diff_mean = np.abs(cluster_mean - other_mean)
+    # take = if a gene passes all the tests then it is to be kept.
+    take = (diff_mean > arg_logfcdiff) & (max_pct > arg_minpct) & (diff_pct > arg_mindiffpct)
+    stats_df = pd.DataFrame({"gene": np.asarray(var_names), "cluster_mean": cluster_mean,
+                             "other_mean": other_mean, "diff_mean": diff_mean,
+                             "cluster_pct": cluster_pct, "other_pct": other_pct,
+                             "max_pct": max_pct, "min_pct": min_pct, "diff_pct": diff_pct,
+                             "background": take})
+    return stats_df
+
+
+def _rank_genes_one_vs_rest(X, obs_names, var_names, in_cluster, background, uns_log1p=None,
+                            method=None, n_genes=float("inf"), corr_method="bonferroni"):
+    """
+    run rank_genes_groups for one cluster vs the other cells on the background genes only,
+    using a minimal AnnData so that the full object is never copied
+    """
+    gene_idx = np.flatnonzero(background)
+    adata_rg = AnnData(X=X[:, gene_idx],
+                       obs=pd.DataFrame({"idents": pd.Categorical(np.where(in_cluster, "1", "0"), categories=["0", "1"])},
+                                        index=obs_names),
+                       var=pd.DataFrame(index=var_names[gene_idx]))
+    if uns_log1p is not None:
+        adata_rg.uns["log1p"] = uns_log1p
+    sc.tl.rank_genes_groups(adata_rg,
+                            groupby="idents", groups=["1"],
+                            reference="0",
+                            method=method,
+                            n_genes=n_genes,
+                            corr_method=corr_method)
+    return sc.get.rank_genes_groups_df(adata_rg, group="1")
+
+
 def find_all_markers_pseudo_seurat(
         adata, 
         groups,
@@ -202,35 +426,56 @@ def find_all_markers_pseudo_seurat(
         corr_method="bonferroni",
         arg_minpct=0.1,
         arg_mindiffpct=-float("inf"), 
-        arg_logfcdiff=0.25):
-    # add replace X with layer
-    if layer is not None:
-        adata.X = adata.layers[layer]
-    # need to check is the assay layer is dense or not
-    assay_is_sparse = issparse(adata.X)
-    use_dense = assay_is_sparse==False 
+        arg_logfcdiff=0.25,
+        n_jobs=1):
+    """
+    pseudo seurat for every cluster in groups vs all the other cells.
+    The detection fractions and exp-means of all clusters are computed in one pass over the matrix,
+    the one-vs-rest statistics are then derived from the group totals.
+    rank_genes_groups is run for each cluster on its background genes, on a pool of n_jobs threads.
+    """
+    X = adata.X if layer is None else adata.layers[layer]
+    group_col = pd.Categorical(adata.obs[groupby])
     if groups == 'all':
         groups = adata.obs[groupby].unique().tolist()
-    markers_dict = {}
+    # cells without a group are always part of the other cells
+    codes = np.where(group_col.codes < 0, len(group_col.categories), group_col.codes)
+    n_detected, exp_sum = _group_detection_and_expsum(X, codes, len(group_col.categories) + 1)
+    n_cells = np.bincount(codes, minlength=len(group_col.categories) + 1)
+    total_detected = n_detected.sum(axis=0)
+    total_exp_sum = exp_sum.sum(axis=0)
+    uns_log1p = adata.uns.get("log1p", None)
+
     filter_dict = {}
     for cv in groups:
-        # \ set up idenst as cv ==1 and everything else = 0
-        adata.obs['idents'] = ['1' if x == cv else '0' for x in adata.obs[groupby]]
-        filter_dict[cv] = pseudo_seurat(adata, use_dense=use_dense,arg_minpct=arg_minpct,
-                  arg_mindiffpct=arg_mindiffpct, 
-                  arg_logfcdiff=arg_logfcdiff )
+        gi = group_col.categories.get_loc(cv)
+        filter_dict[cv] = _pseudo_seurat_stats(adata.var_names,
+                                               n_cluster=n_cells[gi],
+                                               n_other=codes.shape[0] - n_cells[gi],
+                                               detected_cluster=n_detected[gi],
+                                               detected_other=total_detected - n_detected[gi],
+                                               exp_sum_cluster=exp_sum[gi],
+                                               exp_sum_other=total_exp_sum - exp_sum[gi],
+                                               arg_minpct=arg_minpct,
+                                               arg_mindiffpct=arg_mindiffpct,
+                                               arg_logfcdiff=arg_logfcdiff)
         logging.info("number of genes remaining after filtering:  %i\n" % filter_dict[cv]['background'].sum())
-        adata_rg = adata[:, filter_dict[cv]['background'].tolist()].copy()
-        sc.tl.rank_genes_groups(adata_rg, layer=layer,
-                                groupby="idents", groups=["1"],  
-                                reference="0",
-                                method=method, 
-                                n_genes=float("inf"), 
-                                corr_method="bonferroni")
-        markers_dict[cv] = sc.get.rank_genes_groups_df(adata_rg, group="1")
-        # remove adata from mem
-        adata_rg = None
-    markers = pd.concat(markers_dict.values(), keys=markers_dict.keys())
+
+    def _run(cv):
+        return _rank_genes_one_vs_rest(X, adata.obs_names, adata.var_names,
+                                       in_cluster=codes == group_col.categories.get_loc(cv),
+                                       background=filter_dict[cv]['background'].values,
+                                       uns_log1p=uns_log1p,
+                                       method=method,
+                                       n_genes=n_genes,
+                                       corr_method=corr_method)
+    if int(n_jobs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=int(n_jobs)) as pool:
+            markers_list = list(pool.map(_run, groups))
+    else:
+        markers_list = [_run(cv) for cv in groups]
+    markers = pd.concat(markers_list, keys=groups)
     filter_stats = pd.concat(filter_dict.values(), keys=filter_dict.keys())
     return markers, filter_stats
 
@@ -259,68 +504,46 @@ def pseudo_seurat(adata,
     gene: only expressed
     cells: we need to define manually based on above stats.
     10. save results.
-    """
-    # define cells
-    cluster_cells_ind = which_ind(adata.obs["idents"] == "1")
-    other_cells_ind = which_ind(adata.obs["idents"] == "0")
 
-    # compute perecentage expressed
-    # from normnalised but not scaled data
-    # remember cells are rows and genes are columns
-
-    # note: I don't know why norm_counts[cluster_cell_ind:, col_ind] deosn"t work, but it doesn't
-    cluster_pct = (adata.X[cluster_cells_ind, :] > 0).sum(axis=0) / len(cluster_cells_ind)
-    other_pct = (adata.X[other_cells_ind, :] > 0).sum(axis=0) / len(other_cells_ind)
-
-    pcts = pd.DataFrame(np.vstack((cluster_pct,  other_pct)).transpose())
-    max_pct = pcts.max(axis=1)
-    min_pct = pcts.min(axis=1)
-    diff_pct = max_pct - min_pct
-    take_diff_pct = diff_pct > arg_mindiffpct
-    # remove genes that are not expressed higher than 0.1 in one of the groups
-    take_min_pct = max_pct > arg_minpct
-
-    # KEEP IN CASE NP.ARRAY METHOD USES TOO MUCH MEMORY
-    # import time
-    # this has the potential to be very slow. Transposeing it speeds it up a bit.
-    # I need to undertand sparse matrices better to make it work
-    if use_dense:
-        logging.info("using dense matrix")
-        # extract the counts for cluster cells and calculate exp means on each row
-        nct = adata.X.T[:, cluster_cells_ind]
-        cluster_mean = np.apply_along_axis(exp_mean_dense, 1, nct.todense())
-
-        # likewise for non-cluster cells
-        nct = adata.X.T[:, other_cells_ind]
-        other_mean = np.apply_along_axis(exp_mean_dense, 1, nct.todense())
-        diff_mean = abs(cluster_mean - other_mean)
-    else:
-        logging.info("using sparse matrix")
-        cluster_mean = exp_mean_sparse(adata.X.T[:, cluster_cells_ind])
-        other_mean = exp_mean_sparse(adata.X.T[:, other_cells_ind])
-        diff_mean = abs(cluster_mean - other_mean).A1
-
-    # remove genes with less than threshold difference
-    take_thresh = diff_mean > arg_logfcdiff
-    # take = if a cell passes all the tests then it is to be kept.
-    take = [a and b and c for a, b, c in zip(take_thresh, take_min_pct, take_diff_pct)]
+    use_dense is kept for compatibility, sparse and dense matrices are handled in the same single pass
+    """
+    # define cells, idents "1" are the cluster cells and "0" the other cells, anything else is ignored
+    idents = adata.obs["idents"].values
+    codes = np.select([idents == "1", idents == "0"], [1, 0], default=2)
+    n_detected, exp_sum = _group_detection_and_expsum(adata.X, codes, 3)
+    n_cells = np.bincount(codes, minlength=3)
     print("saving universe for fisher test")
-    stats_df = pd.DataFrame(np.vstack((adata.var_names, cluster_mean, other_mean, diff_mean,
-                                       cluster_pct, other_pct, max_pct, min_pct, diff_pct, take)).transpose(),
-                            columns=["gene", "cluster_mean", "other_mean", "diff_mean",
-                                     "cluster_pct", "other_pct",
-                                     "max_pct", "min_pct", "diff_pct", "background"])
-    return stats_df
+    return _pseudo_seurat_stats(adata.var_names,
+                                n_cluster=n_cells[1], n_other=n_cells[0],
+                                detected_cluster=n_detected[1], detected_other=n_detected[0],
+                                exp_sum_cluster=exp_sum[1], exp_sum_other=exp_sum[0],
+                                arg_minpct=arg_minpct,
+                                arg_mindiffpct=arg_mindiffpct,
+                                arg_logfcdiff=arg_logfcdiff)
 
 
-
-def run_neighbors_method_choice(adata, method, n_neighbors, n_pcs, metric, use_rep, nthreads=1):
+def run_neighbors_method_choice(adata, method, n_neighbors, n_pcs, metric, use_rep, nthreads=1,
+                                knn_store=None, modality=None, bc_method=None, ann_index=None):
     # This works with both Anndata and MuData inputs 
     # useful if we are dealing with a MuData object but we want to use single rep, e.g.
     # calculating neighbors on a totalVI latent rep
+    # method is scanpy, hnsw (scvelo) or one of the ANN backends of knn (exact, hnswlib, pynndescent)
+    # or ann to choose one from the number of cells. The ANN index is reused from and saved to
+    # the folder ann_index, see knn.ann_index_path
     if n_pcs > adata.n_vars:
         logging.info("Reducing the number of components from %i to %i" %(n_pcs, adata.n_vars-1))
         n_pcs = adata.n_vars-1
+    # with a knn_store, reuse a graph computed on the same embedding with as many or more neighbors,
+    # modality and bc_method are only recorded in the index of the store
+    fingerprint = None
+    if knn_store is not None and use_rep in adata.obsm.keys():
+        fingerprint = knn.embedding_fingerprint(np.asarray(adata.obsm[use_rep])[:, :n_pcs])
+        stored = knn.load_knn(knn_store, fingerprint, int(n_neighbors), metric=metric, nn_method=method)
+        if stored is not None:
+            logging.info("Using the neighbors graph from the knn store %s" % knn_store)
+            knn.set_neighbors(adata, *stored, metric=metric, use_rep=use_rep, n_pcs=n_pcs)
+            return
+    res = None
     if method == "scanpy":
         logging.info("Computing neighbors using scanpy")
         from scanpy.pp import neighbors
@@ -347,6 +570,323 @@ def run_neighbors_method_choice(adata, method, n_neighbors, n_pcs, metric, use_r
                             "ef": 200,
                             "ef_construction": 200},
                 num_threads=int(nthreads))
+    elif method == "ann" or method in knn.ANN_BACKENDS:
+        if use_rep not in adata.obsm.keys():
+            raise ValueError("the %s neighbors method needs an embedding in obsm, %s not found" % (method, use_rep))
+        logging.info("Computing neighbors using the %s index" % method)
+        X = np.asarray(adata.obsm[use_rep])[:, :n_pcs]
+        index = knn.get_ann_index(X, folder=ann_index, backend="auto" if method == "ann" else method,
+                                  metric=metric, n_jobs=int(nthreads))
+        res = knn.self_knn(index, X, int(n_neighbors), n_jobs=int(nthreads))
+        knn.set_neighbors(adata, *res, metric=metric, use_rep=use_rep, n_pcs=n_pcs)
+    else:
+        raise ValueError("unknown neighbors method %s" % method)
+    if fingerprint is not None:
+        if res is None:
+            res = knn.graph_to_knn(adata.obsp["distances"])
+        if res is None:
+            logging.info("Cells have different numbers of neighbors, not saving the graph to the knn store")
+        else:
+            knn.save_knn(knn_store, fingerprint, *res, metric=metric, nn_method=method,
+                         modality=modality, method=bc_method, rep=use_rep, n_dims=n_pcs)
+
+
+# LISI
+def lisi_knn(X, n_neighbors, knn_method="auto", n_jobs=1, random_state=0):
+    """
+    distances and indices of the n_neighbors nearest neighbors of each row of X,
+    the row itself included. knn_method is "exact" (sklearn, kd-tree or ball tree),
+    "pynndescent", "hnswlib", "ann" (an index of knn.build_ann_index for the number of cells)
+    or "auto", which uses the exact search for low dimensional embeddings such as UMAPs
+    and "ann" otherwise.
+    """
+    if knn_method == "auto":
+        knn_method = "exact" if X.shape[1] <= 10 else "ann"
+    if knn_method == "exact":
+        from sklearn.neighbors import NearestNeighbors
+        nn = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=n_jobs).fit(X)
+        distances, indices = nn.kneighbors(X)
+    elif knn_method == "pynndescent":
+        from pynndescent import NNDescent
+        index = NNDescent(X, n_neighbors=n_neighbors, n_jobs=n_jobs, random_state=random_state)
+        indices, distances = index.neighbor_graph
+    elif knn_method in ["ann", "hnswlib"]:
+        index = knn.build_ann_index(X, backend="auto" if knn_method == "ann" else knn_method, n_jobs=n_jobs)
+        distances, indices = knn.self_knn(index, X, n_neighbors, n_jobs=n_jobs)
+    else:
+        raise ValueError("knn_method must be one of auto, exact, pynndescent, hnswlib or ann")
+    return distances, indices
+
+
+def _lisi_entropy(distances, beta):
+    # normalised gaussian weights of the neighbors and their entropy,
+    # rows with no weight (all distances too large) get H = 0
+    P = np.exp(-distances * beta[:, None])
+    P_sum = P.sum(axis=1)
+    ok = P_sum > 0
+    H = np.zeros(len(beta))
+    H[ok] = np.log(P_sum[ok]) + beta[ok] * (distances[ok] * P[ok]).sum(axis=1) / P_sum[ok]
+    P[ok] /= P_sum[ok, None]
+    P[~ok] = 0
+    return P, H
+
+
+def lisi_weights(distances, perplexity=30, tol=1e-5, n_tries=50):
+    """
+    neighbor weights calibrated to the perplexity, by a binary search on the precision
+    of the gaussian kernel run for all cells at once.
+    This is the search of harmonypy compute_simpson, returns the weights P and the entropy H
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    logU = np.log(perplexity)
+    beta = np.ones(distances.shape[0])
+    betamin = np.full(distances.shape[0], -np.inf)
+    betamax = np.full(distances.shape[0], np.inf)
+    P, H = _lisi_entropy(distances, beta)
+    Hdiff = H - logU
+    active = np.arange(distances.shape[0])
+    for _ in range(n_tries):
+        active = active[np.abs(Hdiff[active]) >= tol]
+        if len(active) == 0:
+            break
+        b = beta[active]
+        up = Hdiff[active] > 0
+        betamin[active[up]] = b[up]
+        betamax[active[~up]] = b[~up]
+        bmin = betamin[active]
+        bmax = betamax[active]
+        beta[active] = np.where(up,
+                                np.where(np.isfinite(bmax), (b + bmax) / 2, b * 2),
+                                np.where(np.isfinite(bmin), (b + bmin) / 2, b / 2))
+        P[active], H[active] = _lisi_entropy(distances[active], beta[active])
+        Hdiff[active] = H[active] - logU
+    return P, H
+
+
+def _simpson_index(P, H, neighbor_codes, n_categories):
+    # sum over the categories of the squared weight of the neighbors in the category,
+    # neighbors with a missing label (code -1) are left out
+    from scipy.sparse import csr_matrix
+    valid = neighbor_codes >= 0
+    rows = np.broadcast_to(np.arange(P.shape[0])[:, None], P.shape)
+    per_cat = csr_matrix((P[valid], (rows[valid], neighbor_codes[valid])),
+                         shape=(P.shape[0], max(n_categories, 1)))
+    return np.where(H == 0, -1, 0) + np.asarray(per_cat.multiply(per_cat).sum(axis=1)).ravel()
+
+
+def compute_lisi(X, metadata, label_colnames, perplexity=30, knn_method="auto", n_jobs=1,
+                 chunk_size=100000, knn_graph=None):
+    """
+    Local Inverse Simpson's Index of each cell for each of the label_colnames in metadata,
+    on the embedding X (UMAP or latent space).
+    One kNN graph of 3 * perplexity neighbors is built per embedding, with n_jobs threads,
+    and the perplexity calibration is shared by all the label columns.
+    knn_graph can pass precomputed (distances, indices) of at least 3 * perplexity neighbors.
+    Gives the same results as harmonypy.compute_lisi for the same neighbors.
+    Returns an array of shape (n_cells, len(label_colnames))
+    """
+    if knn_graph is None:
+        knn_graph = lisi_knn(np.asarray(X), n_neighbors=int(perplexity * 3),
+                             knn_method=knn_method, n_jobs=n_jobs)
+    distances, indices = knn_graph
+    distances = distances[:, :int(perplexity * 3)]
+    indices = indices[:, :int(perplexity * 3)]
+    # drop the cell itself
+    distances = distances[:, 1:]
+    indices = indices[:, 1:]
+    labels = [pd.Categorical(metadata[label]) for label in label_colnames]
+    codes = [(lab.codes.astype(np.int64), len(lab.categories)) for lab in labels]
+    lisi_arr = np.zeros((metadata.shape[0], len(label_colnames)))
+    for start in range(0, metadata.shape[0], chunk_size):
+        rows = slice(start, start + chunk_size)
+        P, H = lisi_weights(distances[rows], perplexity=perplexity)
+        for ii, (cc, n_categories) in enumerate(codes):
+            lisi_arr[rows, ii] = 1 / _simpson_index(P, H, cc[indices[rows]], n_categories)
+    return lisi_arr
+
+
+def incremental_latent(model_cls, adata, model_dir, previous_latent, batch_key="bc_batch",
+                       max_epochs=100, plan_kwargs=None):
+    """
+    latent representation of the cells of adata with the scvi-tools model saved in model_dir,
+    without retraining it.
+    previous_latent is the latent representation (DataFrame indexed by cell) of the cells
+    the model was trained on, which is kept for the cells of adata found in it. The other
+    cells are mapped with scArches surgery (model_cls.load_query_data): the model is extended
+    with their new batches and only the parameters of these batches are fine tuned, on the
+    new cells. adata needs the counts layer, batch_key and obsm fields the model was set up
+    with; its genes are matched to the model's by model_cls.prepare_query_anndata.
+    Returns the latent representation of all the cells of adata and the extended model,
+    or None if there were no new cells.
+    """
+    is_new = ~adata.obs_names.isin(previous_latent.index)
+    latent = previous_latent.reindex(adata.obs_names).to_numpy()
+    if not is_new.any():
+        logging.info("all the cells are in the saved latent representation")
+        return latent, None
+    query = adata[is_new].copy()
+    logging.info("mapping %i new cells with the model in %s" % (query.n_obs, model_dir))
+    model_cls.prepare_query_anndata(query, model_dir)
+    vae_q = model_cls.load_query_data(query, model_dir)
+    registry = model_cls.load_registry(model_dir)
+    known = registry["field_registries"].get("batch", {}).get("state_registry", {}).get("categorical_mapping", [])
+    new_batches = set(query.obs[batch_key]) - set(known) if batch_key in query.obs else set()
+    if len(new_batches) > 0:
+        # the reference weights are frozen by load_query_data, only the new batches are trained
+        logging.info("fine tuning the model on the new batches %s" % ", ".join(sorted(map(str, new_batches))))
+        vae_q.train(max_epochs=max_epochs, plan_kwargs={"weight_decay": 0.0, **(plan_kwargs or {})})
+    else:
+        # without new batches the extended model is the trained reference model,
+        # load_query_data marks it as untrained nonetheless
+        vae_q.is_trained_ = True
+    latent[is_new] = vae_q.get_latent_representation()
+    return latent, vae_q
+
+
+# clustering sweep
+# the graph is stored at module level so forked workers share it instead of
+# receiving a pickled copy for every resolution
+_SWEEP_GRAPH = None
+
+
+def _set_sweep_graph(g):
+    global _SWEEP_GRAPH
+    _SWEEP_GRAPH = g
+
+
+def _cluster_sweep_graph(job):
+    """
+    run one (algorithm, resolution) on the shared igraph,
+    mirroring the defaults of sc.tl.leiden and sc.tl.louvain
+    """
+    algorithm, resolution, random_state = job
+    g = _SWEEP_GRAPH
+    weights = np.array(g.es["weight"]).astype(np.float64)
+    if algorithm == "leiden":
+        import leidenalg
+        part = leidenalg.find_partition(g, leidenalg.RBConfigurationVertexPartition,
+                                        weights=weights,
+                                        n_iterations=-1,
+                                        seed=random_state,
+                                        resolution_parameter=float(resolution))
+    elif algorithm == "louvain":
+        import louvain
+        louvain.set_rng_seed(random_state)
+        part = louvain.find_partition(g, louvain.RBConfigurationVertexPartition,
+                                      weights=weights,
+                                      resolution_parameter=float(resolution))
+    else:
+        raise ValueError("clustering algorithm %s not recognised, please choose louvain or leiden" % algorithm)
+    return np.array(part.membership)
+
+
+def run_clustering_sweep(adata, resolutions, algorithm="leiden", neighbors_key="neighbors", n_jobs=1, random_state=0):
+    """
+    Cluster one neighbors graph at many resolutions.
+    The igraph is built once from adata.obsp and every resolution is run on a pool of n_jobs workers.
+    Works with both AnnData and MuData inputs.
+    Returns a dictionary of resolution: pd.Categorical of clusters, in the format of sc.tl.leiden/louvain
+    """
+    from natsort import natsorted
+    from scanpy._utils import get_igraph_from_adjacency
+    neighbors = adata.uns[neighbors_key]
+    conn_key = neighbors.get("connectivities_key", "connectivities")
+    logging.info("Building graph from .obsp['%s']" % conn_key)
+    g = get_igraph_from_adjacency(adata.obsp[conn_key], directed=True)
+    jobs = [(algorithm, res, random_state) for res in resolutions]
+    if int(n_jobs) > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+        with Pool(min(int(n_jobs), len(jobs)), initializer=_set_sweep_graph, initargs=(g,)) as pool:
+            memberships = pool.map(_cluster_sweep_graph, jobs)
+    else:
+        _set_sweep_graph(g)
+        memberships = [_cluster_sweep_graph(job) for job in jobs]
+    _set_sweep_graph(None)
+    out = {}
+    for res, groups in zip(resolutions, memberships):
+        out[res] = pd.Categorical(values=groups.astype("U"),
+                                  categories=natsorted(map(str, np.unique(groups))))
+    return out
+
+
+# umap sweep
+_UMAP_SWEEP_DATA = None
+
+
+def _set_umap_sweep_data(adata, init_coords, neighbors_key, use_muon):
+    global _UMAP_SWEEP_DATA
+    _UMAP_SWEEP_DATA = (adata, init_coords, neighbors_key, use_muon)
+
+
+def umap_spectral_init(adata, neighbors_key="neighbors", random_state=0):
+    """
+    Compute the spectral initialisation that umap computes inside every fit,
+    so it can be reused across min_dist values.
+    The graph is pruned as umap does with its default number of epochs.
+    Returns None if the graph has several components and no representation is found
+    to lay them out, in which case umap should compute its own initialisation.
+    """
+    from scipy.sparse.csgraph import connected_components
+    from sklearn.utils import check_random_state
+    from umap.spectral import spectral_layout
+    neighbors = adata.uns[neighbors_key]
+    graph = adata.obsp[neighbors.get("connectivities_key", "connectivities")].tocoo()
+    graph.sum_duplicates()
+    default_epochs = 500 if graph.shape[0] <= 10000 else 200
+    graph.data[graph.data < (graph.data.max() / float(default_epochs))] = 0.0
+    graph.eliminate_zeros()
+
+    params = neighbors.get("params", {})
+    use_rep = params.get("use_rep", None)
+    if isinstance(use_rep, str) and use_rep in adata.obsm.keys():
+        data = np.asarray(adata.obsm[use_rep])
+    elif use_rep is None and "X_pca" in adata.obsm.keys():
+        data = np.asarray(adata.obsm["X_pca"])[:, :params.get("n_pcs", None)]
+    else:
+        data = None
+    if data is None and connected_components(graph)[0] > 1:
+        logging.info("graph has several components and no representation was found, not precomputing the initialisation")
+        return None
+    random_state = check_random_state(random_state)
+    init_coords = spectral_layout(data, graph, 2, random_state,
+                                  metric=params.get("metric", "euclidean"),
+                                  metric_kwds=params.get("metric_kwds", {}))
+    # umap adds a little noise to the scaled coordinates to avoid local minima
+    expansion = 10.0 / np.abs(init_coords).max()
+    init_coords = (init_coords * expansion).astype(np.float32) + \
+        random_state.normal(scale=0.0001, size=init_coords.shape).astype(np.float32)
+    return init_coords
+
+
+def _umap_sweep_layout(min_dist):
+    adata, init_coords, neighbors_key, use_muon = _UMAP_SWEEP_DATA
+    init_pos = "spectral" if init_coords is None else init_coords
+    if use_muon:
+        mu.tl.umap(adata, min_dist=float(min_dist), init_pos=init_pos, neighbors_key=neighbors_key)
+    else:
+        sc.tl.umap(adata, min_dist=float(min_dist), init_pos=init_pos, neighbors_key=neighbors_key)
+    return adata.obsm["X_umap"].copy()
+
+
+def run_umap_sweep(adata, min_dists, neighbors_key="neighbors", use_muon=False, n_jobs=1):
+    """
+    Run UMAP for several min_dist values on one neighbors graph.
+    The spectral initialisation is computed once and only the layout optimisation
+    is rerun for each min_dist, on a pool of n_jobs workers.
+    use_muon runs mu.tl.umap (e.g. for wnn graphs) instead of sc.tl.umap.
+    Returns a dictionary of min_dist: umap coordinates
+    """
+    init_coords = umap_spectral_init(adata, neighbors_key=neighbors_key)
+    if int(n_jobs) > 1 and len(min_dists) > 1:
+        from multiprocessing import Pool
+        with Pool(min(int(n_jobs), len(min_dists)), initializer=_set_umap_sweep_data,
+                  initargs=(adata, init_coords, neighbors_key, use_muon)) as pool:
+            coords = pool.map(_umap_sweep_layout, min_dists)
+    else:
+        _set_umap_sweep_data(adata, init_coords, neighbors_key, use_muon)
+        coords = [_umap_sweep_layout(md) for md in min_dists]
+    _set_umap_sweep_data(None, None, None, None)
+    return dict(zip(min_dists, coords))
 
 
 def merge_consensus_clust(adata, consensus_clust, ref_col="rough_ref"):
@@ -362,25 +902,36 @@ def merge_consensus_clust(adata, consensus_clust, ref_col="rough_ref"):
 
 # assessing background
 
+def _group_mean_fractions(X, codes, n_groups, target_sum=100):
+    """
+    mean over the cells of each group of X normalised to target_sum per cell
+    (as normalize_total), as one product of a sparse group indicator matrix weighted by
+    target_sum / (cell total * group size) with X. Cells with code -1 are left out.
+    returns a dense groups x features array
+    """
+    from scipy.sparse import csr_matrix
+    cell_sums = np.ravel(X.sum(axis=1)).astype(np.float64)
+    # like normalize_total, cells without counts stay 0
+    cell_sums[cell_sums == 0] = 1
+    cells = np.where(codes >= 0)[0]
+    n_per_group = np.bincount(codes[cells], minlength=n_groups)
+    weights = target_sum / cell_sums[cells] / n_per_group[codes[cells]]
+    G = csr_matrix((weights, (codes[cells], cells)), shape=(n_groups, X.shape[0]))
+    means = G @ X
+    return means.toarray() if issparse(means) else np.asarray(means)
+
+
+def _top_n_per_row(arr, n_top):
+    # indices of the n_top largest values of each row, in decreasing order
+    n_top = min(n_top, arr.shape[1])
+    part = np.argpartition(-arr, n_top - 1, axis=1)[:, :n_top]
+    order = np.argsort(-np.take_along_axis(arr, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
 def _calc_top_n_genes(adata, n_top=50):
-    norm_dict = normalize_total(adata, target_sum=100, inplace=False)
-    
-    if issparse(norm_dict['X']):
-            mean_percent = norm_dict['X'].mean(axis=0).A1
-            top_idx = np.argsort(mean_percent)[::-1][:n_top]
-            counts_top_genes = norm_dict['X'][:, top_idx].A
-    else:
-        mean_percent = norm_dict['X'].mean(axis=0)
-        top_idx = np.argsort(mean_percent)[::-1][:n_top]
-        counts_top_genes = norm_dict['X'][:, top_idx]
-    columns = (
-        adata.var_names[top_idx]
-    )
-    counts_top_genes = pd.DataFrame(
-        counts_top_genes, index=adata.obs_names, columns=columns
-    )
-    
-    return list(counts_top_genes.columns)
+    mean_percent = _group_mean_fractions(adata.X, np.zeros(adata.n_obs, dtype=np.int64), 1)
+    return list(adata.var_names[_top_n_per_row(mean_percent, n_top)[0]])
 
 def get_top_expressed_features(adata, n_top=50, group_by=None):
     """
@@ -398,10 +949,11 @@ def get_top_expressed_features(adata, n_top=50, group_by=None):
               vars.
     """
     if group_by is not None:
-        groups = adata.obs[group_by].unique()
-        top_genes_list = [_calc_top_n_genes(adata[adata.obs[group_by] == x, :], n_top=n_top) for x in groups]
-        from itertools import chain
-        top_genes = list(set(chain.from_iterable(top_genes_list)))
+        # the mean percentages of all groups in one pass, cells without a group are left out
+        codes, groups = pd.factorize(adata.obs[group_by])
+        mean_percent = _group_mean_fractions(adata.X, codes, len(groups))
+        top_idx = _top_n_per_row(mean_percent, n_top)
+        top_genes = list(adata.var_names[np.unique(top_idx)])
     else:
         top_genes = _calc_top_n_genes(adata, n_top=n_top)
     return(top_genes)
@@ -432,36 +984,213 @@ def get_mean_background_fraction(adata, top_background, group_by=None):
     return means_df
 
 
+def qc_metrics_chunked(X, var_names, qc_vars=None, chunk_size=50000):
+    """
+    The metrics of scanpy.pp.calculate_qc_metrics(qc_vars=..., percent_top=None, log1p=True)
+    computed in one pass over the rows of X, read chunk_size rows at a time, so X can be
+    a backed matrix (h5py dataset or anndata sparse dataset) that is never loaded.
+
+    :param var_names: names of the columns of X
+    :param qc_vars: dict of qc variable name -> boolean mask (or list of feature names)
+    :return: obs metrics (one row per row of X), var metrics (indexed by var_names)
+    """
+    qc_vars = {} if qc_vars is None else qc_vars
+    var_names = pd.Index(var_names)
+    masks = {k: (v if isinstance(v, np.ndarray) and v.dtype == bool else var_names.isin(v))
+             for k, v in qc_vars.items()}
+    # one column per qc variable, so the group totals are one product per chunk
+    M = np.column_stack([m.astype(np.float64) for m in masks.values()]) if len(masks) > 0 \
+        else np.zeros((len(var_names), 0))
+    n_obs = X.shape[0]
+    n_genes = np.zeros(n_obs, dtype=np.int64)
+    total = np.zeros(n_obs)
+    group_total = np.zeros((n_obs, M.shape[1]))
+    var_total = np.zeros(len(var_names))
+    var_n_cells = np.zeros(len(var_names), dtype=np.int64)
+    for start, chunk in _row_chunks(X, chunk_size):
+        stop = start + chunk.shape[0]
+        if issparse(chunk):
+            chunk = chunk.tocsr()
+            # like scanpy, stored entries are counted
+            n_genes[start:stop] = chunk.getnnz(axis=1)
+            var_n_cells += np.bincount(chunk.indices, minlength=len(var_names))
+        else:
+            chunk = np.asarray(chunk)
+            n_genes[start:stop] = np.count_nonzero(chunk, axis=1)
+            var_n_cells += np.count_nonzero(chunk, axis=0)
+        total[start:stop] = np.ravel(chunk.sum(axis=1))
+        var_total += np.ravel(chunk.sum(axis=0))
+        group_total[start:stop] = np.asarray(chunk @ M)
+    obs = pd.DataFrame({"n_genes_by_counts": n_genes,
+                        "log1p_n_genes_by_counts": np.log1p(n_genes),
+                        "total_counts": total,
+                        "log1p_total_counts": np.log1p(total)})
+    for i, qc in enumerate(masks.keys()):
+        obs["total_counts_" + qc] = group_total[:, i]
+        obs["log1p_total_counts_" + qc] = np.log1p(group_total[:, i])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            obs["pct_counts_" + qc] = group_total[:, i] / total * 100
+    var = pd.DataFrame({"n_cells_by_counts": var_n_cells,
+                        "mean_counts": var_total / n_obs,
+                        "log1p_mean_counts": np.log1p(var_total / n_obs),
+                        "pct_dropout_by_counts": (1 - var_n_cells / n_obs) * 100,
+                        "total_counts": var_total,
+                        "log1p_total_counts": np.log1p(var_total)},
+                       index=var_names)
+    return obs, var
+
+
+def _score_control_genes(gene_list, gene_means, ctrl_size=50, n_bins=25, random_state=0):
+    """
+    control genes of scanpy.tl.score_genes: ctrl_size random genes from each expression bin
+    of the genes in gene_list, with bins made on the mean expression of all genes
+    """
+    np.random.seed(random_state)
+    obs_avg = gene_means[np.isfinite(gene_means)]
+    n_items = int(np.round(len(obs_avg) / (n_bins - 1)))
+    obs_cut = obs_avg.rank(method="min") // n_items
+    control_genes = set()
+    for cut in np.unique(obs_cut.loc[list(gene_list)]):
+        r_genes = np.array(obs_cut[obs_cut == cut].index)
+        np.random.shuffle(r_genes)
+        control_genes.update(set(r_genes[:ctrl_size]))
+    return list(control_genes - set(gene_list))
+
+
+def score_genes_chunked(X, var_names, gene_sets, gene_means=None, n_bins=25, random_state=0, chunk_size=50000):
+    """
+    scanpy.tl.score_genes for several gene sets in one pass over the rows of X
+    (chunk_size rows at a time, X can be backed). Whole rows are read, as X is stored
+    by rows, and only the columns of the sets and their control genes are kept.
+    The score of a cell is its mean expression of the genes of a set minus its mean
+    expression of control genes drawn from the same expression bins.
+
+    :param gene_sets: dict of score name -> (list of genes, ctrl_size)
+    :param gene_means: mean expression of each gene over all cells (pd.Series indexed by var_names),
+        e.g. the mean_counts of qc_metrics_chunked; computed with an extra pass if not given
+    :return: DataFrame of scores, one column per gene set
+    """
+    var_names = pd.Index(var_names)
+    if gene_means is None:
+        gene_means = qc_metrics_chunked(X, var_names, chunk_size=chunk_size)[1]["mean_counts"]
+    # per set, weights 1/n of its genes minus 1/n of its control genes
+    W = np.zeros((len(var_names), len(gene_sets)))
+    for i, (name, (genes, ctrl_size)) in enumerate(gene_sets.items()):
+        genes = [g for g in set(genes) if g in var_names]
+        if len(genes) == 0:
+            raise ValueError("no genes of %s are in var_names" % name)
+        control = _score_control_genes(genes, gene_means, ctrl_size=ctrl_size, n_bins=n_bins,
+                                       random_state=random_state)
+        W[var_names.get_indexer(genes), i] += 1 / len(genes)
+        if len(control) > 0:
+            W[var_names.get_indexer(control), i] -= 1 / len(control)
+    # only the columns used by a set are kept from each chunk of rows
+    cols = np.where(np.any(W != 0, axis=1))[0]
+    W = W[cols]
+    scores = np.zeros((X.shape[0], len(gene_sets)))
+    for start, chunk in _row_chunks(X, chunk_size, cols=cols):
+        scores[start:start + chunk.shape[0]] = np.asarray(chunk @ W)
+    return pd.DataFrame(scores, columns=list(gene_sets.keys()))
+
+
+def cell_cycle_phase(scores):
+    """
+    phase of scanpy.tl.score_genes_cell_cycle from a DataFrame with S_score and G2M_score
+    """
+    phase = pd.Series("S", index=scores.index)
+    phase[scores["G2M_score"] > scores["S_score"]] = "G2M"
+    phase[np.all(scores[["S_score", "G2M_score"]] < 0, axis=1)] = "G1"
+    return phase
+
+
 def identify_isotype_outliers(prot, isotypes, quantile_val=0.9, n_isotypes_pass=2, groupby=None,layer=None, inplace=True):
+    """
+    flag cells with more than n_isotypes_pass isotypes above their quantile_val quantile,
+    computed over all cells or within each groupby category.
+    Only the isotype columns are densified; thresholds are broadcast to the cells with the
+    group codes so the comparison is a single vectorised step for any number of groups.
+    """
     # make sure we don't mess
     if inplace is False:
         prot=prot.copy()
+    X = prot.X if layer is None else prot.layers[layer]
+    idx = prot.var_names.get_indexer(isotypes)
+    if (idx < 0).any():
+        raise KeyError("isotypes %s not found in prot.var_names" % list(np.asarray(isotypes)[idx < 0]))
+    X = X[:, idx]
+    isotypes_counts = X.toarray() if issparse(X) else np.asarray(X)
+    isotypes_counts = isotypes_counts.astype(np.float64)
     if groupby is None:
-            isotypes_counts = get_obs_df(prot, isotypes, layer=layer)
-            # get quantile thresholds
-            thres = isotypes_counts.quantile(quantile_val)
-            # for each isotype test whether the threshold is exceeded
-            for iso in isotypes:
-                isotypes_counts['outliers_' + iso]= isotypes_counts[iso] > thres[iso] 
+        # get quantile thresholds
+        thres = np.quantile(isotypes_counts, quantile_val, axis=0)
+        outliers = isotypes_counts > thres
     else:
         # we are grouping by an extra variable
-        isotypes_counts = get_obs_df(prot, [groupby] + isotypes, layer=layer)
-        thres = isotypes_counts.groupby(groupby).quantile(0.9)
-        for iso in isotypes:
-            tmp = pd.merge(isotypes_counts[[groupby, iso]], thres[[iso]], left_on=groupby, right_index=True)
-            isotypes_counts['outliers_' + iso] = tmp.apply(lambda x: x[1] > x[2] , axis=1)
+        codes, groups = pd.factorize(prot.obs[groupby], sort=True)
+        thres = pd.DataFrame(isotypes_counts).groupby(codes).quantile(quantile_val)
+        # cells without a group (code -1) are never outliers
+        thres = np.vstack([thres.reindex(np.arange(len(groups))).values,
+                           np.full((1, len(isotypes)), np.inf)])
+        outliers = isotypes_counts > thres[codes]
     # now work out which ones to exclude
-    isotypes_counts['outliers'] = isotypes_counts.iloc[:,isotypes_counts.columns.str.startswith("outliers")].sum(axis=1)
-    isotypes_counts['exclude'] = isotypes_counts['outliers'] > n_isotypes_pass
+    n_outliers = pd.Series(outliers.sum(axis=1), index=prot.obs_names)
     # add into obs
-    prot.obs['isotype_exclude_outliers'] = isotypes_counts['exclude']
-    prot.obs['n_isotype_in_90_percentile'] = isotypes_counts['outliers'].astype('category')
+    prot.obs['isotype_exclude_outliers'] = n_outliers > n_isotypes_pass
+    prot.obs['n_isotype_in_90_percentile'] = n_outliers.astype('category')
     if inplace is False:
         return prot
 
-def X_is_raw(adata):
-    # we assume if all the rows sums are integers then the matrix is populated by integers
-    return np.array_equal(adata.X.sum(axis=0).astype(int), adata.X.sum(axis=0))
+
+def _X_values(X):
+    # the stored values of X, without a copy for sparse and C-contiguous dense matrices
+    if issparse(X):
+        return X.data
+    return np.asarray(X).ravel()
+
+
+def _X_fingerprint(X, n_sample=1024):
+    """
+    cheap identity of the values of X: shape, number of stored values, dtype
+    and the values at n_sample evenly spaced positions
+    """
+    values = _X_values(X)
+    pos = np.linspace(0, len(values) - 1, min(n_sample, len(values))).astype(np.int64)
+    sample = np.ascontiguousarray(values[pos], dtype=np.float64)
+    h = hashlib.sha1(sample.tobytes())
+    h.update(("%s:%i:%s" % (X.shape, len(values), values.dtype)).encode())
+    return h.hexdigest()
+
+
+def X_is_raw(adata, n_sample=10000, chunk_size=10_000_000, use_cache=False):
+    """
+    Check whether adata.X contains raw counts, i.e. only integers.
+    A random sample of the stored values is checked first, so most normalised matrices are
+    rejected without reading all of X, then all the stored values are checked chunk by chunk,
+    stopping at the first non-integer. Integer dtypes are raw without reading the values.
+    With use_cache, the result is recorded in adata.uns["X_is_raw"] with a fingerprint of X
+    (shape, number and dtype of the stored values and a sample of them), and later calls with
+    use_cache return it while the fingerprint is unchanged: only use it when X is not edited
+    in place between the calls.
+    """
+    X = adata.X
+    fingerprint = _X_fingerprint(X) if use_cache else None
+    cached = adata.uns.get("X_is_raw") if use_cache else None
+    if isinstance(cached, dict) and cached.get("fingerprint") == fingerprint:
+        return bool(cached["raw"])
+    values = _X_values(X)
+    if np.issubdtype(values.dtype, np.integer) or np.issubdtype(values.dtype, np.bool_):
+        is_raw = True
+    else:
+        rng = np.random.default_rng(0)
+        sample = values[rng.integers(0, len(values), min(n_sample, len(values)))] if len(values) > 0 else values
+        is_raw = bool(np.all(np.mod(sample, 1) == 0))
+        for start in range(0, len(values), chunk_size):
+            if not is_raw:
+                break
+            is_raw = bool(np.all(np.mod(values[start:start + chunk_size], 1) == 0))
+    if use_cache and not adata.is_view:
+        adata.uns["X_is_raw"] = {"raw": is_raw, "fingerprint": fingerprint}
+    return is_raw
 
 # run clr 
     
@@ -491,6 +1220,85 @@ def run_prot_normalise(mdata,
         raise ValueError("normalisation method %s not recognised, please choose dsb or clr" % method)
     
 
+
+# per channel protein normalisation
+_CHANNEL_DATA = None
+
+
+def _set_channel_data(prot, mdata_bg, channel_col, norm_methods, clr_margin, isotypes, channel_callback):
+    global _CHANNEL_DATA
+    _CHANNEL_DATA = (prot, mdata_bg, channel_col, norm_methods, clr_margin, isotypes, channel_callback)
+
+
+def _normalise_channel(si):
+    prot, mdata_bg, channel_col, norm_methods, clr_margin, isotypes, channel_callback = _CHANNEL_DATA
+    # only the cells of this channel are copied out of the shared objects
+    mdata = MuData({"prot": prot[prot.obs[channel_col] == si].copy()})
+    layers = {}
+    for method in norm_methods:
+        # make sure to start from raw counts
+        mdata["prot"].X = mdata["prot"].layers["raw_counts"].copy()
+        if method == "dsb":
+            mdata_bg_si = mdata_bg[mdata_bg.obs[channel_col] == si].copy()
+            mdata_bg_si["rna"].obs["log10umi"] = np.array(np.log10(mdata_bg_si["rna"].X.sum(axis=1) + 1)).reshape(-1)
+            run_prot_normalise(mdata=mdata, mdata_bg=mdata_bg_si, method="dsb", isotypes=isotypes)
+        else:
+            run_prot_normalise(mdata=mdata, mdata_bg=None, method=method, clr_margin=int(clr_margin))
+        layers[method] = mdata["prot"].layers[method]
+        if channel_callback is not None:
+            channel_callback(si, method, mdata["prot"])
+    return mdata["prot"].obs_names, layers
+
+
+def _gather_channel_layers(obs_names, blocks):
+    """
+    stack per channel blocks (names, matrix) into one matrix in the order of obs_names.
+    cells that are not in any channel are left as 0 (sparse) or NaN (dense)
+    """
+    rows = np.concatenate([obs_names.get_indexer(names) for names, _ in blocks])
+    mats = [m for _, m in blocks]
+    n_vars = mats[0].shape[1]
+    if all(issparse(m) for m in mats):
+        from scipy.sparse import vstack, csr_matrix
+        stacked = vstack(mats).tocsr()
+        # permutation matrix placing row i of stacked at obs position rows[i]
+        perm = csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(len(obs_names), len(rows)))
+        return (perm @ stacked).tocsr()
+    out = np.full((len(obs_names), n_vars), np.nan)
+    out[rows] = np.vstack([m.toarray() if issparse(m) else np.asarray(m) for m in mats])
+    return out
+
+
+def run_prot_normalise_per_channel(mdata, mdata_bg, channel_col, norm_methods=("clr", "dsb"),
+                                   clr_margin=0, isotypes=None, n_jobs=1, channel_callback=None):
+    """
+    Normalise mdata["prot"] separately for each channel_col category with clr and/or dsb.
+    Channels are distributed over a pool of n_jobs processes, which share the protein and
+    background objects read-only (inherited by fork, not pickled) and each copy out their channel.
+    The normalised layers are gathered back into mdata["prot"].layers[method].
+    mdata["prot"].layers["raw_counts"] must hold the raw counts.
+    channel_callback(channel, method, prot) is called in the worker after each normalisation
+    of a channel, e.g. to plot or save it.
+    """
+    prot = mdata["prot"]
+    channels = list(prot.obs[channel_col].dropna().unique())
+    norm_methods = [m for m in norm_methods if m in ["clr", "dsb"]]
+    initargs = (prot, mdata_bg, channel_col, norm_methods, clr_margin, isotypes, channel_callback)
+    if int(n_jobs) > 1 and len(channels) > 1:
+        from multiprocessing import Pool
+        with Pool(min(int(n_jobs), len(channels)), initializer=_set_channel_data, initargs=initargs) as pool:
+            results = pool.map(_normalise_channel, channels)
+    else:
+        _set_channel_data(*initargs)
+        results = [_normalise_channel(si) for si in channels]
+    _set_channel_data(*[None] * 7)
+    for method in norm_methods:
+        prot.layers[method] = _gather_channel_layers(prot.obs_names,
+                                                     [(names, layers[method]) for names, layers in results])
+    # as for run_prot_normalise, X holds the last normalisation
+    if len(norm_methods) > 0:
+        prot.X = prot.layers[norm_methods[-1]].copy()
+
 from scipy.sparse import issparse
 def quantile_clipping(mdata, modality=None, layer=None,  qmax=0.995, qmin=0.005, inplace=False):
     if isinstance(mdata, MuData):
@@ -16,6 +16,7 @@ from itertools import chain, product
 import glob
 
 from panpipes.funcs.processing import extract_parameter_from_fname
+from panpipes.telemetry import run_task
 
 import logging
 def get_logger():
@@ -67,11 +68,13 @@ def run_neighbors(outfile):
             --neighbor_dict '%(neighbors)s' \
             --n_threads %(resources_threads_high)s
             """
+        if PARAMS.get('knn_store') is not None:
+            cmd += " --knn_store %(knn_store)s"
         cmd += " > %(log_file)s"
         job_kwargs["job_threads"] = PARAMS['resources_threads_high']
         log_msg = f"TASK: 'run_neighbors'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
         get_logger().info(log_msg)        
-        P.run(cmd, **job_kwargs)
+        run_task(cmd, **job_kwargs)
     else:
         P.run('ln -s %(scaled_obj)s %(outfile)s', without_cluster=True)
 
@@ -99,10 +102,59 @@ def gen_umap_jobs():
                 log_file = os.path.join("logs","_".join(["2_run_UMAP", mod + '_md' + str(md) + ".log"]))
                 yield [infile, output_file, mod, md, log_file]
 
+def gen_umap_sweep_jobs():
+    """
+    Generate one UMAP sweep job per modality, covering all mindist values.
+    """
+    if not PARAMS['umap'].get('sweep', False):
+        return
+    infile = PARAMS['mudata_with_knn']
+    mods =  [key for key, value in PARAMS['modalities'].items() if value is True]
+    if PARAMS["multimodal"]["run_clustering"] is True :
+        mods.append("multimodal")
+    for mod in mods:
+        if PARAMS['umap'][mod]['mindist'] is not None:
+            mindists = [str(md) for md in PARAMS['umap'][mod]['mindist']]
+            output_files = [os.path.join(mod,  'md' + md +"_umap.txt.gz") for md in mindists]
+            log_file = os.path.join("logs","_".join(["2_run_UMAP_sweep", mod + ".log"]))
+            yield [infile, output_files, mod, ",".join(mindists), log_file]
+
+
+@follows(run_neighbors)
+@follows(set_up_dirs)
+@files(gen_umap_sweep_jobs)
+def calc_sm_umaps_sweep(infile, outfiles, mod, mindists, log_file):
+    """
+    Computes the spectral initialisation once per modality and runs
+    the layout for every mindist, writing the same files as calc_sm_umaps
+    """
+    cmd = """
+        python %(py_path)s/run_umap.py \
+            --infile %(infile)s \
+            --output_dir %(mod)s \
+            --min_dists %(mindists)s \
+            --n_threads %(resources_threads_high)s
+            """
+    if mod is not None and mod != "multimodal":
+        cmd += " --modality %(mod)s"
+    elif mod=="multimodal":
+        if PARAMS['multimodal_integration_method'].lower() == "wnn":
+            cmd += " --neighbors_key wnn"
+    cmd += " > %(log_file)s"
+    job_kwargs["job_threads"] = PARAMS['resources_threads_high']
+    log_msg = f"TASK: 'run_umap_sweep'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
+    get_logger().info(log_msg)
+    run_task(cmd, **job_kwargs)
+
+
 @follows(run_neighbors)
 @follows(set_up_dirs)
+@follows(calc_sm_umaps_sweep)
 @files(gen_umap_jobs)
 def calc_sm_umaps(infile, outfile, mod, mindist, log_file):
+    if PARAMS['umap'].get('sweep', False) and os.path.exists(outfile):
+        # already written by calc_sm_umaps_sweep
+        return
     prefix = os.path.split(infile)[0]
     cmd = """
         python %(py_path)s/run_umap.py \
@@ -120,7 +172,7 @@ def calc_sm_umaps(infile, outfile, mod, mindist, log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_umap'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 # ------------------------------------
@@ -145,10 +197,60 @@ def gen_cluster_jobs():
                 log_file = os.path.join("logs", "_".join(["3_run_clustering_", mod + '_alg' + alg + '_res' + str(res), ".log"]))
                 yield [infile, output_file, mod, res, alg, log_file]
 
+def gen_cluster_sweep_jobs():
+    """
+    Generate one clustering sweep job per modality, covering all resolutions.
+    """
+    if not PARAMS['clusterspecs'].get('sweep', False):
+        return
+    infile = PARAMS['mudata_with_knn']
+    mods =  [key for key, value in PARAMS['modalities'].items() if value is True]
+    if PARAMS['multimodal']['run_clustering'] is True:
+        mods.append("multimodal")
+    for mod in mods:
+        if PARAMS['clusterspecs'][mod]['resolutions'] is not None:
+            alg = PARAMS['clusterspecs'][mod]['algorithm']
+            resolutions = [str(res) for res in PARAMS['clusterspecs'][mod]['resolutions']]
+            output_files = [os.path.join(mod, 'alg' + alg + '_res' + res, "clusters.txt.gz") for res in resolutions]
+            log_file = os.path.join("logs", "_".join(["3_run_clustering_sweep", mod + '_alg' + alg + ".log"]))
+            yield [infile, output_files, mod, ",".join(resolutions), alg, log_file]
+
+
+@follows(set_up_dirs)
+@follows(run_neighbors)
+@files(gen_cluster_sweep_jobs)
+def calc_cluster_sweep(infile, outfiles, mod, resolutions, alg, log_file):
+    """
+    Reads the neighbors graph once and clusters it at every resolution,
+    writing the same files as calc_cluster
+    """
+    cmd = """python %(py_path)s/run_clustering.py 
+            --infile %(infile)s 
+            --output_dir %(mod)s 
+            --resolutions %(resolutions)s 
+            --algorithm %(alg)s
+            --n_threads %(resources_threads_high)s
+    """ 
+    if mod is not None and mod != "multimodal":
+        cmd += " --modality %(mod)s"
+    elif mod=="multimodal":
+        if PARAMS['multimodal_integration_method'].lower() == "wnn":
+            cmd += " --neighbors_key wnn"
+    cmd += " > %(log_file)s"
+    job_kwargs["job_threads"] = PARAMS['resources_threads_high']
+    log_msg = f"TASK: 'run_clustering_sweep'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
+    get_logger().info(log_msg)
+    run_task(cmd, **job_kwargs)
+
+
 @follows(set_up_dirs)
+@follows(calc_cluster_sweep)
 @files(gen_cluster_jobs)
 @follows(run_neighbors)
 def calc_cluster(infile, outfile,  mod, res, alg, log_file):
+    if PARAMS['clusterspecs'].get('sweep', False) and os.path.exists(outfile):
+        # already written by calc_cluster_sweep
+        return
     cmd = """python %(py_path)s/run_clustering.py 
             --infile %(infile)s 
             --outfile %(outfile)s 
@@ -165,7 +267,7 @@ def calc_cluster(infile, outfile,  mod, res, alg, log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'run_clustering'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @collate(calc_cluster,
@@ -182,7 +284,7 @@ def aggregate_clusters(infiles, outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_low'] 
     log_msg = f"TASK: 'aggregate_clusters'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     get_logger().info(log_msg)          
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @collate([[calc_cluster], [calc_sm_umaps]], formatter(), PARAMS['sample_prefix'] + "_clustered.h5mu")
@@ -216,7 +318,7 @@ def collate_mdata(infiles,outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'collate_mdata'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     get_logger().info(log_msg)  
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @transform(collate_mdata, 
@@ -236,7 +338,7 @@ def plot_cluster_umaps(infile, log_file,):
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'plot_cluster_umaps'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)  
-    P.run(cmd, jobs_limit=1, **job_kwargs)
+    run_task(cmd, jobs_limit=1, **job_kwargs)
 
 
 @transform(aggregate_clusters, regex("(.*)/all_res_clusters_list.txt.gz"),
@@ -254,7 +356,7 @@ def plot_clustree(infile, log_file, outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'clustree'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)  
-    P.run(cmd,  **job_kwargs)
+    run_task(cmd,  **job_kwargs)
 
 
 
@@ -307,6 +409,7 @@ def find_markers(infile, log_file, outfile_prefix, base_mod, cluster_dir, data_m
     cmd += " --layer '%(layer_choice)s'"
     testuse = PARAMS["markerspecs"][data_mod]["method"]
     cmd += " --testuse '%(testuse)s'"
+    cmd += " --n_threads %(resources_threads_high)s"
     if PARAMS['markerspecs'][data_mod]['pseudo_seurat'] is True:
         min_pct =  PARAMS["markerspecs"][data_mod]["minpct"]
         threshuse =  PARAMS["markerspecs"][data_mod]["threshuse"]
@@ -318,7 +421,7 @@ def find_markers(infile, log_file, outfile_prefix, base_mod, cluster_dir, data_m
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'find_markers'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)  
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -382,7 +485,7 @@ def plot_marker_dotplots(marker_file, log_file, outfile,
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'plot_markers'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)  
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -5,6 +5,8 @@ from cgatcore import pipeline as P
 import glob
 import logging
 
+from panpipes.telemetry import run_task
+
 def get_logger():
     return logging.getLogger("cgatcore.pipeline")
 
@@ -108,7 +110,7 @@ def run_cell2location(input_spatial, outfile_spatial, sample_prefix, input_singl
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'run_cell2location'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -157,7 +159,7 @@ def run_tangram(input_spatial, outfile_spatial, sample_prefix, input_singlecell)
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'run_tangram'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @follows(run_cell2location, run_tangram)
@@ -18,9 +18,11 @@ from ruffus import (
     transform,
     regex,
     formatter,
+    merge,
 )
 
 from panpipes.funcs.io import gen_load_anndata_jobs
+from panpipes.telemetry import run_task
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -82,7 +84,7 @@ def aggregate_tenx_metrics_multi(outfile):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{outfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @follows(aggregate_tenx_metrics_multi)
@@ -186,16 +188,19 @@ def load_mudatas(
     if bcr_path is not None and pd.notna(bcr_path):
         cmd += " --bcr_filtered_contigs %(bcr_path)s"
         cmd += " --bcr_filetype %(bcr_filetype)s"
+    # load the modalities concurrently
+    load_n_jobs = PARAMS.get("load_n_jobs") or 1
+    cmd += " --n_jobs %(load_n_jobs)s"
     logfile = f"logs/1_load_mudatas_{sample_id}.log"
     cmd += f" > {logfile}"
     # print(cmd)
-    job_kwargs["job_threads"] = PARAMS["resources_threads_medium"]
+    job_kwargs["job_threads"] = max(PARAMS["resources_threads_medium"], load_n_jobs)
     log_msg = (
         "TASK: 'load_mudatas'"
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @active_if(PARAMS["use_existing_h5mu"] is False)
@@ -213,6 +218,8 @@ def concat_filtered_mudatas(infiles, outfile):
         --sampleprefix %(sample_prefix)s
         --join_type %(concat_join_type)s
         """
+    if PARAMS.get("concat_streaming"):
+        cmd += " --streaming True"
     if PARAMS["metadatacols"] is not None and PARAMS["metadatacols"] != "":
         cmd += " --metadatacols  %(metadatacols)s"
     if PARAMS["barcode_mtd_include"] is True:
@@ -230,7 +237,7 @@ def concat_filtered_mudatas(infiles, outfile):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
     # P.run("rm tmp/*", job_threads=PARAMS['resources_threads_low'])
 
 
@@ -338,7 +345,7 @@ def load_bg_mudatas(
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @active_if(PARAMS["bg_required"])
@@ -356,7 +363,7 @@ def downsample_bg_mudatas(infile, outfile):
     """
     job_kwargs["job_threads"] = PARAMS["resources_threads_medium"]
     # TODO: add log file?
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @active_if(PARAMS["bg_required"])
@@ -379,6 +386,8 @@ def concat_bg_mudatas(infiles, outfile):
         --sampleprefix %(sample_prefix)s
         --join_type %(concat_join_type)s
         """
+    if PARAMS.get("concat_streaming"):
+        cmd += " --streaming True"
     if PARAMS["metadatacols"] is not None and PARAMS["metadatacols"] != "":
         cmd += " --metadatacols  %(metadatacols)s"
     #  if PARAMS["barcode_mtd_include"] is True:
@@ -392,7 +401,7 @@ def concat_bg_mudatas(infiles, outfile):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
     # P.run("rm tmp/*", job_threads=PARAMS['resources_threads_low'])
 
 
@@ -405,21 +414,8 @@ def orfile():
     return PARAMS["sample_prefix"] + "_cell_metadata.tsv"
 
 
-@active_if(PARAMS["scr_run"])
-@active_if(PARAMS["modalities_rna"])
-@active_if(PARAMS["use_existing_h5mu"] is False)
-@follows(mkdir("scrublet"))
-@transform(
-    load_mudatas, regex(r"./tmp/(.*).h5(.*)"), r"scrublet/\1_scrublet_scores.txt", r"\1"
-)
-def run_scrublet(infile, outfile, sample_id):
-    outdir = "./scrublet"
-
-    cmd = """python %(py_path)s/run_scrublet_scores.py
-        --sample_id %(sample_id)s
-        --inputpath %(infile)s
-        --outdir %(outdir)s
-        """
+def scrublet_options():
+    cmd = ""
     if PARAMS["scr_expected_doublet_rate"] is not None:
         cmd += " --expected_doublet_rate %(scr_expected_doublet_rate)s"
     if PARAMS["scr_sim_doublet_ratio"] is not None:
@@ -438,6 +434,26 @@ def run_scrublet(infile, outfile, sample_id):
         cmd += " --use_thr %(scr_use_thr)s"
     if PARAMS["scr_call_doublets_thr"] is not None:
         cmd += " --call_doublets_thr %(scr_call_doublets_thr)s"
+    return cmd
+
+
+@active_if(PARAMS["scr_run"])
+@active_if(PARAMS["modalities_rna"])
+@active_if(PARAMS["use_existing_h5mu"] is False)
+@active_if(PARAMS.get("scr_batch") is not True)
+@follows(mkdir("scrublet"))
+@transform(
+    load_mudatas, regex(r"./tmp/(.*).h5(.*)"), r"scrublet/\1_scrublet_scores.txt", r"\1"
+)
+def run_scrublet(infile, outfile, sample_id):
+    outdir = "./scrublet"
+
+    cmd = """python %(py_path)s/run_scrublet_scores.py
+        --sample_id %(sample_id)s
+        --inputpath %(infile)s
+        --outdir %(outdir)s
+        """
+    cmd += scrublet_options()
     logfile = "logs/2_run_scrublet_" + sample_id + ".log"
     cmd += f" > {logfile}"
     job_kwargs["job_threads"] = PARAMS["resources_threads_medium"]
@@ -446,14 +462,47 @@ def run_scrublet(infile, outfile, sample_id):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
     IOTools.touch_file(outfile)
 
 
+@active_if(PARAMS["scr_run"])
+@active_if(PARAMS["modalities_rna"])
+@active_if(PARAMS["use_existing_h5mu"] is False)
+@active_if(PARAMS.get("scr_batch") is True)
+@follows(mkdir("scrublet"))
+@merge(load_mudatas, "logs/2_run_scrublet_batch.log")
+def run_scrublet_batch(infiles, logfile):
+    # all the samples are scored in one job, by a pool of workers
+    outdir = "./scrublet"
+    samples_file = "scrublet/scrublet_samples.tsv"
+    samples = pd.DataFrame({"inputpath": infiles})
+    samples["sample_id"] = samples["inputpath"].str.extract(r"./tmp/(.*).h5(?:.*)", expand=False)
+    samples[["sample_id", "inputpath"]].to_csv(samples_file, sep="\t", index=False)
+    n_threads = PARAMS["resources_threads_high"]
+    n_jobs = PARAMS.get("scr_n_jobs") or n_threads
+
+    cmd = """python %(py_path)s/run_scrublet_scores.py
+        --samples_file %(samples_file)s
+        --n_jobs %(n_jobs)s
+        --n_threads %(n_threads)s
+        --outdir %(outdir)s
+        """
+    cmd += scrublet_options()
+    cmd += " > %(logfile)s"
+    job_kwargs["job_threads"] = n_threads
+    log_msg = (
+        "TASK: 'run_scrublet_batch'"
+        + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
+    )
+    get_logger().info(log_msg)
+    run_task(cmd, **job_kwargs)
+
+
 @active_if(PARAMS["modalities_rna"])
 @follows(mkdir("figures"))
 @follows(mkdir("figures/rna"))
-@follows(concat_filtered_mudatas, run_scrublet)
+@follows(concat_filtered_mudatas, run_scrublet, run_scrublet_batch)
 @originate("logs/3_run_scanpy_qc_rna.log", orfile(), unfilt_file())
 def run_rna_qc(log_file, outfile, unfilt_file):
     # infile = submission file
@@ -491,6 +540,9 @@ def run_rna_qc(log_file, outfile, unfilt_file):
 
     cmd += " --channel_col %(channel_col)s"  # is this needed?
 
+    if PARAMS.get("qc_chunk_size") is not None:
+        cmd += " --chunk_size %(qc_chunk_size)s"
+
     # if PARAMS['isotype_upper_quantile'] is not None:
     #     cmd += " --isotype_upper_quantile %(isotype_upper_quantile)s"
     # if PARAMS['isotype_n_pass'] is not None:
@@ -505,7 +557,7 @@ def run_rna_qc(log_file, outfile, unfilt_file):
     )
     get_logger().info(log_msg)
 
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
     if os.path.exists("cache"):
         P.run("rm -r cache")
@@ -559,7 +611,7 @@ def run_scanpy_prot_qc(log_file, outfile, unfilt_file):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
     pass
 
 
@@ -576,7 +628,9 @@ def run_dsb_clr(outfile, unfilt_file, bg_file):
         --figpath ./figures/prot
         """
     if PARAMS["channel_col"] is not None:
+        # the channels are normalised in parallel
         cmd += " --channel_col %(channel_col)s"
+        cmd += " --n_jobs %(resources_threads_high)s"
     if PARAMS["normalisation_methods"] is not None:
         cmd += " --normalisation_methods %(normalisation_methods)s"
     if PARAMS["quantile_clipping"] is not None:
@@ -595,7 +649,7 @@ def run_dsb_clr(outfile, unfilt_file, bg_file):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{outfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @follows(run_scanpy_prot_qc, run_dsb_clr)
@@ -627,7 +681,7 @@ def run_repertoire_qc(logfile, unfilt_file):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 # -----------------------------------------------------------------------------------------------
@@ -677,7 +731,7 @@ def run_atac_qc(log_file, outfile, unfilt_file):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @follows(run_rna_qc, run_prot_qc, run_repertoire_qc, run_atac_qc)
@@ -719,7 +773,7 @@ def plot_qc(log_file, cell_file):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 # ------
@@ -747,7 +801,7 @@ def run_assess_background(log_file, unfilt_file, bg_file):
         + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     )
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 # # ------------
@@ -10,6 +10,9 @@ from itertools import chain
 import glob
 import logging
 
+from panpipes.funcs.cache import cached_run
+from panpipes.telemetry import run_task
+
 def get_logger():
     return logging.getLogger("cgatcore.pipeline")
 
@@ -30,6 +33,21 @@ if PARAMS['condaenv'] is not None:
     job_kwargs["job_condaenv"] =PARAMS['condaenv']
 
 
+def knn_store_option():
+    # the kNN graphs are shared by the batch corrections, lisi and scib through the knn store
+    if PARAMS.get('knn_store') is None:
+        return ""
+    return " --knn_store %s" % os.path.abspath(PARAMS['knn_store'])
+
+
+def task_cache(cmd):
+    # the knn store and the ANN indexes are written outside of the cached outputs,
+    # tasks writing them are not cached
+    if "--knn_store" in cmd or re.search(r"--neighbors_method (exact|hnswlib|pynndescent|ann)\b", cmd):
+        return None
+    return PARAMS.get('cache')
+
+
 preprocessed_file = PARAMS['preprocessed_file']
 
 @originate("logs/setup_dirs.sentinel")
@@ -74,6 +92,7 @@ def run_no_batch_umap(outfile):
      --input_anndata %(preprocessed_obj)s
      --output_csv %(outfile)s
      --integration_col %(rna_column)s
+     --n_threads %(resources_threads_high)s
      """
     # cannot use the normal method for importing params from yaml, because it only works up to depth 2
     neighbor_params = PARAMS['rna']['neighbors']
@@ -85,6 +104,7 @@ def run_no_batch_umap(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
     cmd += " > logs/1_rna_no_correct.log"
     
     if PARAMS['queues_long'] is not None:
@@ -92,7 +112,9 @@ def run_no_batch_umap(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']  
     log_msg = f"TASK: 'run_no_batch_correct_rna'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/1_rna_no_correct.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)  
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/no_correction_scaled_adata_rna.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['rna']['neighbors'], **job_kwargs)
 
 
 
@@ -120,7 +142,9 @@ def run_bbknn_rna(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_bbknn_rna'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/1_rna_bbknn.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)  
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/bbknn_scaled_adata_rna.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['rna']['bbknn'], **job_kwargs)
 
 
 # rna COMBAT
@@ -146,6 +170,7 @@ def run_combat(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
     cmd += " > logs/1_rna_combat.log "
     
     if PARAMS['queues_long'] is not None:
@@ -154,7 +179,9 @@ def run_combat(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_combat_rna'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/1_rna_combat.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/combat_scaled_adata_rna.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['rna']['neighbors'], **job_kwargs)
 
 # rna HARMONY
 @follows(set_up_dirs)
@@ -177,6 +204,10 @@ def run_harmony(outfile):
         cmd += " --sigma_val %s" % harmony_params['sigma'] 
     if harmony_params['theta'] is not None:
         cmd += " --theta_val %s" % harmony_params['theta']       
+    if harmony_params.get('warm_start'):
+        cmd += " --warm_start True"
+    if harmony_params.get('batch_size') is not None:
+        cmd += " --harmony_batch_size %s" % harmony_params['batch_size']
     neighbor_params = PARAMS['rna']['neighbors']
     if neighbor_params['method'] is not None:
         cmd += " --neighbors_method %s" % neighbor_params['method']
@@ -186,6 +217,7 @@ def run_harmony(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
     cmd += " > logs/1_rna_harmony.log " 
      #job arguments
     
@@ -194,7 +226,11 @@ def run_harmony(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_harmony_rna'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/1_rna_harmony.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/harmony_scaled_adata_rna.h5ad", "tmp/harmony_scaled_adata_rna.harmony_state.npz"],
+               # a warm start reads the state the task rewrites, it is not cached
+               cache_params=None if harmony_params.get('warm_start') else task_cache(cmd),
+               params=PARAMS['rna']['harmony'], **job_kwargs)
 
 # rna SCANORAMA
 @follows(set_up_dirs)
@@ -219,6 +255,7 @@ def run_scanorama(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
     cmd += " > logs/1_rna_scanorama.log " 
     #job arguments
     
@@ -227,7 +264,9 @@ def run_scanorama(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_scanorama_rna'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/1_rna_scanorama.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/scanorama_scaled_adata.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['rna']['neighbors'], **job_kwargs)
 
 # rna scvi
 @follows(set_up_dirs)
@@ -254,6 +293,8 @@ def run_scvi(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
+    cmd += " --n_threads %(job_threads)s"
     cmd += " > logs/1_rna_scvi.log "
     job_kwargs = {}
     if PARAMS['queues_gpu'] is not None:
@@ -266,7 +307,7 @@ def run_scvi(outfile):
         job_kwargs["job_threads"] = int(PARAMS['resources_threads_high'])
     log_msg = f"TASK: 'run_scvi_rna'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/1_rna_scvi.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 # rna scib
 # @transform([run_scvi, run_scanorama, run_bbknn, run_harmony, run_combat],
@@ -315,6 +356,7 @@ def run_no_batch_umap_prot(outfile):
      --input_anndata %(preprocessed_obj)s
      --output_csv %(outfile)s
      --integration_col %(prot_column)s
+     --n_threads %(resources_threads_high)s
      """
     cmd += " --modality prot"
     # cannot use the normal method for importing params from yaml, because it only works up to depth 2
@@ -327,6 +369,7 @@ def run_no_batch_umap_prot(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
     cmd += " > logs/2_prot_no_correct.log"
     
     if PARAMS['queues_long'] is not None:
@@ -334,7 +377,9 @@ def run_no_batch_umap_prot(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_no_batch_correct_prot'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/2_prot_no_correct.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/no_correction_scaled_adata_prot.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['prot']['neighbors'], **job_kwargs)
 
 # prot HARMONY
 @follows(set_up_dirs)
@@ -356,6 +401,10 @@ def run_harmony_prot( outfile):
         cmd += " --sigma_val %s" % harmony_params['sigma'] 
     if harmony_params['theta'] is not None:
         cmd += " --theta_val %s" % harmony_params['theta']   
+    if harmony_params.get('warm_start'):
+        cmd += " --warm_start True"
+    if harmony_params.get('batch_size') is not None:
+        cmd += " --harmony_batch_size %s" % harmony_params['batch_size']
     neighbor_params = PARAMS['prot']['neighbors']
     if neighbor_params['method'] is not None:
         cmd += " --neighbors_method %s" % neighbor_params['method']
@@ -365,6 +414,7 @@ def run_harmony_prot( outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
     cmd += " > logs/2_prot_harmony.log " 
      #job arguments
     
@@ -373,7 +423,11 @@ def run_harmony_prot( outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_harmony_prot'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/2_prot_harmony.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/harmony_scaled_adata_prot.h5ad", "tmp/harmony_scaled_adata_prot.harmony_state.npz"],
+               # a warm start reads the state the task rewrites, it is not cached
+               cache_params=None if harmony_params.get('warm_start') else task_cache(cmd),
+               params=PARAMS['prot']['harmony'], **job_kwargs)
 
 
 
@@ -401,7 +455,9 @@ def run_bbknn_prot(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_bbknn_prot'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/2_prot_bbknn.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/bbknn_scaled_adata_prot.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['prot']['bbknn'], **job_kwargs)
 
 
 # prot COMBAT
@@ -427,6 +483,7 @@ def run_combat_prot(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
     cmd += " > logs/2_prot_combat.log "
     
     if PARAMS['queues_long'] is not None:
@@ -435,7 +492,9 @@ def run_combat_prot(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_combat_prot'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/2_prot_combat.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/combat_scaled_adata_prot.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['prot']['neighbors'], **job_kwargs)
     
 
 @active_if(PARAMS['prot_run'])
@@ -458,6 +517,7 @@ def run_no_batch_umap_atac(outfile):
      --input_anndata %(preprocessed_obj)s
      --output_csv %(outfile)s
      --integration_col %(atac_column)s
+     --n_threads %(resources_threads_high)s
      """
     cmd += " --modality atac"
     neighbor_params = PARAMS['atac']['neighbors']
@@ -474,6 +534,7 @@ def run_no_batch_umap_atac(outfile):
         cmd += " --dimred %s" % atac_dimred
     else:
         cmd += " --dimred PCA"
+    cmd += knn_store_option()
     cmd += " > logs/3_atac_no_correct.log"
     
     if PARAMS['queues_long'] is not None:
@@ -481,7 +542,9 @@ def run_no_batch_umap_atac(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_no_batch_correct_atac'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/3_atac_no_correct.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/no_correction_scaled_adata_atac.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['atac']['neighbors'], **job_kwargs)
 
 # atac HARMONY
 @follows(set_up_dirs)
@@ -504,6 +567,10 @@ def run_harmony_atac( outfile):
         cmd += " --sigma_val %s" % harmony_params['sigma'] 
     if harmony_params['theta'] is not None:
         cmd += " --theta_val %s" % harmony_params['theta']   
+    if harmony_params.get('warm_start'):
+        cmd += " --warm_start True"
+    if harmony_params.get('batch_size') is not None:
+        cmd += " --harmony_batch_size %s" % harmony_params['batch_size']
     neighbor_params = PARAMS['atac']['neighbors']
     if neighbor_params['method'] is not None:
         cmd += " --neighbors_method %s" % neighbor_params['method']
@@ -518,6 +585,7 @@ def run_harmony_atac( outfile):
         cmd += " --dimred %s" % atac_dimred
     else:
         cmd += " --dimred PCA"
+    cmd += knn_store_option()
     cmd += " > logs/3_atac_harmony.log " 
      #job arguments
     
@@ -526,7 +594,11 @@ def run_harmony_atac( outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_harmony_atac'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/3_atac_harmony.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/harmony_scaled_adata_atac.h5ad", "tmp/harmony_scaled_adata_atac.harmony_state.npz"],
+               # a warm start reads the state the task rewrites, it is not cached
+               cache_params=None if harmony_params.get('warm_start') else task_cache(cmd),
+               params=PARAMS['atac']['harmony'], **job_kwargs)
 
 # atac BBKNN
 @follows(set_up_dirs)
@@ -552,7 +624,9 @@ def run_bbknn_atac(outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_bbknn_atac'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/3_atac_bbknn.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs) 
+    cached_run(cmd, inputs=[PARAMS['preprocessed_obj']],
+               outputs=[outfile, "tmp/bbknn_scaled_adata_atac.h5ad"],
+               cache_params=task_cache(cmd), params=PARAMS['atac']['bbknn'], **job_kwargs)
 
 
 @active_if(PARAMS['atac_run'])
@@ -597,6 +671,8 @@ def run_totalvi(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
+    cmd += " --n_threads %(job_threads)s"
     cmd += " > logs/4_multimodal_totalvi.log "
     
     if PARAMS['queues_gpu'] is not None:
@@ -608,7 +684,7 @@ def run_totalvi(outfile):
         job_kwargs["job_threads"] = int(PARAMS['resources_threads_high'])
     log_msg = f"TASK: 'run_totalvi'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/4_multimodal_totalvi.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 # Run MultiVI
 
@@ -644,6 +720,8 @@ def run_multivi(outfile):
         cmd += " --neighbors_n_pcs %s"  % neighbor_params['npcs']
     if neighbor_params['k'] is not None:
         cmd += " --neighbors_k %s" % neighbor_params['k']
+    cmd += knn_store_option()
+    cmd += " --n_threads %(job_threads)s"
     cmd += " > logs/4_multimodal_multivi.log "
     
     if PARAMS['queues_gpu'] is not None:
@@ -655,7 +733,7 @@ def run_multivi(outfile):
         job_kwargs["job_threads"] = int(PARAMS['resources_threads_high'])
     log_msg = f"TASK: 'run_multivi'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/4_multimodal_multivi.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -702,10 +780,12 @@ def run_mofa(outfile):
         if PARAMS['queues_long'] is not None:
             job_kwargs["job_queue"] = job_queue=PARAMS['queues_long']
         job_kwargs["job_threads"] = int(PARAMS['resources_threads_high'])
+    cmd += knn_store_option()
+    cmd += " --n_threads %(job_threads)s"
     cmd += " > logs/4_multimodal_mofa.log "
     log_msg = f"TASK: 'run_mofa'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/4_multimodal_mofa.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 # Run WNN
 
@@ -734,6 +814,8 @@ def run_wnn(outfile):
        cmd += " --metric %s" % wnn_params['metric']
     if wnn_params['low_memory'] is not None:
        cmd += " --low_memory %s" % wnn_params['low_memory']
+    cmd += knn_store_option()
+    cmd += " --n_threads %(job_threads)s"
     cmd += " > logs/4_multimodal_wnn.log"
 
     
@@ -746,7 +828,7 @@ def run_wnn(outfile):
         job_kwargs["job_threads"] = int(PARAMS['resources_threads_high'])
     log_msg = f"TASK: 'run_wnn'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/4_multimodal_wnn.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 # end of multimodal
 @follows(run_mofa, run_wnn, run_totalvi, run_multivi)
@@ -789,7 +871,7 @@ def collate_integration_outputs(infiles,outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'collate_integration_outputs'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/5_collate_mtd.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)  
+    run_task(cmd, **job_kwargs)  
 
 
 # this COLLATE job will become the big final collate job across all possible combinations you may have run
@@ -812,7 +894,7 @@ def plot_umaps(infile, outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'plot_umaps'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{outfile}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd,**job_kwargs)
+    run_task(cmd,**job_kwargs)
 
 
 #this can follow now any mtd generation, but it will collate only RNA jobs for lisi
@@ -826,15 +908,21 @@ def run_lisi(infile, outfile):
     --combined_umaps_df %(infile)s 
     --cell_meta_df %(cell_mtd_file)s
     --integration_dict batch_correction/batch_dict.yml
-    --fig_dir figures/  > %(outfile)s 
-    """ 
-    job_kwargs["job_threads"] = PARAMS['resources_threads_low']
+    --n_threads %(resources_threads_medium)s
+    --fig_dir figures/
+    """
+    if PARAMS.get('lisi_embeddings') is not None:
+        cmd += " --embeddings %(lisi_embeddings)s --corrected_dir tmp"
+    cmd += knn_store_option()
+    cmd += " > %(outfile)s"
+    job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'run_lisi'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{outfile}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd,**job_kwargs)
+    run_task(cmd,**job_kwargs)
 
 
-@follows(collate_integration_outputs)
+# after lisi, to reuse its kNN graphs of the UMAPs
+@follows(collate_integration_outputs, run_lisi)
 @active_if(PARAMS['scib_run'])
 @transform(collate_integration_outputs, formatter(),  'logs/scib.log')
 def run_scib_metrics(infile, outfile):
@@ -853,11 +941,12 @@ def run_scib_metrics(infile, outfile):
         cmd += " --prot_cell_type %(scib_prot)s"
     if PARAMS['scib_atac']:
         cmd += " --atac_cell_type %(scib_atac)s"
+    cmd += knn_store_option()
 
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'run_scib_metrics'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{outfile}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @follows(run_unimodal_integration, run_multimodal_integration, run_lisi, run_scib_metrics, plot_umaps)
@@ -908,7 +997,7 @@ def merge_integration(output_mudata):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'merge_integration'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/8_merge_final_obj.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd,**job_kwargs)
+    run_task(cmd,**job_kwargs)
     # clear up tmp since it is no longer required
     # P.run("rm -r tmp")
 
@@ -10,6 +10,7 @@ import glob
 import warnings
 import logging
 from panpipes.funcs.io import dictionary_stripper
+from panpipes.telemetry import run_task
 # from itertools import chain
 # import glob
 
@@ -62,7 +63,7 @@ def filter_mudata(outfile):
         job_kwargs["job_threads"] = PARAMS['resources_threads_low']
         log_msg = f"TASK: 'filter_mudata'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
         get_logger().info(log_msg)
-        P.run(cmd, **job_kwargs)
+        run_task(cmd, **job_kwargs)
     else:
         try:
             f = open(outfile)
@@ -105,7 +106,7 @@ def postfilterplot(log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'postfilterplot'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -128,7 +129,7 @@ def downsample(log_file, filt_obj):
         job_kwargs["job_threads"] = PARAMS['resources_threads_low']
         log_msg = f"TASK: 'downsample'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
         get_logger().info(log_msg)
-        P.run(cmd, **job_kwargs)
+        run_task(cmd, **job_kwargs)
     IOTools.touch_file(log_file)
     pass
 
@@ -186,7 +187,7 @@ def rna_preprocess(adata_obj, log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'rna_preprocess'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @active_if(mode_dictionary['prot'] is True)
@@ -200,6 +201,7 @@ def prot_preprocess( log_file, scaled_file, ):
         --filtered_mudata %(scaled_file)s
         --figpath ./figures/prot
         --save_mudata_path %(scaled_file)s
+        --n_jobs %(resources_threads_high)s
         """
     if PARAMS['normalisation_methods'] is not None:
         cmd += " --normalisation_methods %(prot_normalisation_methods)s"
@@ -228,7 +230,7 @@ def prot_preprocess( log_file, scaled_file, ):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'prot_preprocess'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @active_if(mode_dictionary['atac'] is True)
@@ -276,6 +278,9 @@ def atac_preprocess(log_file, scaled_file):
             cmd += " --solver arpack"
         else:    
             cmd += " --solver %(atac_solver)s"
+    for lsi_param in ["lsi_n_oversamples", "lsi_n_iter", "lsi_chunk_size"]:
+        if PARAMS.get("atac_" + lsi_param) is not None:
+            cmd += " --%s %s" % (lsi_param, PARAMS["atac_" + lsi_param])
     if PARAMS['atac_dim_remove'] is not None:
         cmd += " --dim_remove %(atac_dim_remove)s"
     if PARAMS['atac_feature_selection_flavour'] is not None:
@@ -287,7 +292,7 @@ def atac_preprocess(log_file, scaled_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'atac_preprocess'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -5,6 +5,7 @@ from cgatcore import pipeline as P
 import glob
 import logging
 from panpipes.funcs.io import dictionary_stripper
+from panpipes.telemetry import run_task
 
 def get_logger():
     return logging.getLogger("cgatcore.pipeline")
@@ -71,7 +72,7 @@ def filter_mudata(infile_path,outfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'filter_mudata'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
     
 
 
@@ -105,7 +106,7 @@ def postfilterplot_spatial(filt_file,log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'postfilterplot'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @transform(filter_mudata,
@@ -152,7 +153,7 @@ def spatial_preprocess(filt_file,log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'spatial_preprocess'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 @follows(filter_mudata, postfilterplot_spatial, spatial_preprocess)
 @originate("cleanup_done.txt")
@@ -8,6 +8,7 @@ from cgatcore import pipeline as P
 import pandas as pd
 import cgatcore.iotools as IOTools
 from panpipes.funcs.io import gen_load_spatial_jobs
+from panpipes.telemetry import run_task
 # from scpipelines.funcs.processing import intersection
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -115,7 +116,7 @@ def load_mudatas(spatial_path, outfile,
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'load_mudatas'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/1_make_mudatas_{sample_id}.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -158,7 +159,7 @@ def spatialQC(infile,log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_medium']
     log_msg = f"TASK: 'spatialQC'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 def run_plotqc_query(pqc_dict):
@@ -192,7 +193,7 @@ def plotQC_spatial(unfilt_file,log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'plotQC_spatial'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
     
 #----- end
@@ -10,6 +10,8 @@ from itertools import chain
 import glob
 import logging
 
+from panpipes.telemetry import run_task
+
 def get_logger():
     return logging.getLogger("cgatcore.pipeline")
 
@@ -106,7 +108,7 @@ def run_refmap_scvi(infile, outfile, log_file, ref_architecture ):
        cmd += "  --impute_proteins %(impute_proteins)s"
     if PARAMS['run_randomforest'] is not None:
         cmd += " --predict_rf %(run_randomforest)s"
-       
+    cmd += " --n_threads %(job_threads)s"
     cmd += " > %(log_file)s"
 
     if PARAMS['queues_gpu'] is not None:
@@ -120,7 +122,7 @@ def run_refmap_scvi(infile, outfile, log_file, ref_architecture ):
 
     log_msg = f"TASK: 'run_refmap_scvi'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 ##TODO remove this collate job cause plotting is now in the script
@@ -168,7 +170,7 @@ def run_scib_refmap(infile,logfile):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'run_scib_refmap'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{logfile}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)  
+    run_task(cmd, **job_kwargs)  
 
 
 @follows(run_scib_refmap)
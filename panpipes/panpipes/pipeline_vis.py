@@ -9,6 +9,7 @@ import re
 from itertools import chain, product
 import glob
 from panpipes.funcs.io import dictionary_stripper 
+from panpipes.telemetry import run_task
 import logging
 
 def get_logger():
@@ -80,7 +81,7 @@ def plot_custom_markers_per_group(marker_file, log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'plot_custom_markers_per_group'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 plot_embeddings = any([True if val['run'] is True else False for val in PARAMS["embedding"].values() ])
@@ -108,7 +109,7 @@ def plot_custom_markers_umap(marker_file, log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'plot_custom_markers_umap'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 
@@ -144,7 +145,7 @@ def plot_categorical_umaps(log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'plot_categorical_umaps'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 @active_if(plot_embeddings)
@@ -178,7 +179,7 @@ def plot_continuous_umaps(log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'plot_continuous_umaps'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 do_plot_metrics = any([PARAMS['do_plots_categorical_barplots'],
@@ -196,7 +197,7 @@ def write_obs(cmtd):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'write_obs'" + f" IN CASE OF ERROR, PLEASE REFER TO : 'logs/5_write_obs.log' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
   
 
 # Plot cluster metrics
@@ -212,7 +213,7 @@ def plot_metrics(mtd, log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_low']
     log_msg = f"TASK: 'plot_metrics'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)
+    run_task(cmd, **job_kwargs)
 
 
 # parse the scatter files
@@ -236,7 +237,7 @@ def plot_scatters(infile, log_file):
     job_kwargs["job_threads"] = PARAMS['resources_threads_high']
     log_msg = f"TASK: 'plot_scatters'" + f" IN CASE OF ERROR, PLEASE REFER TO : '{log_file}' FOR MORE INFORMATION."
     get_logger().info(log_msg)
-    P.run(cmd, **job_kwargs)    
+    run_task(cmd, **job_kwargs)    
 
 
 @follows(plot_custom_markers_per_group, plot_custom_markers_umap,
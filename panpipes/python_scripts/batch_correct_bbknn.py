@@ -47,10 +47,8 @@ args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
 
-#adata = read_anndata(args.input_anndata, use_muon=use_muon, modality="rna")
-L.info("Reading in MuData from '%s'" % args.input_anndata)
-mdata = mu.read(args.input_anndata)
-adata = mdata.mod[args.modality] 
+L.info("Reading in modality '%s' from '%s'" % (args.modality, args.input_anndata))
+adata = read_anndata(args.input_anndata, use_muon=True, modality=args.modality)
 
 nnb = int(args.neighbors_within_batch)
 # bbknn can't integrate on 2+ variables, so create a fake column with combined information
@@ -8,9 +8,8 @@ import os
 from panpipes.funcs.processing import check_for_bool
 from panpipes.funcs.io import read_anndata, write_anndata
 from panpipes.funcs.scmethods import run_neighbors_method_choice
+from panpipes.funcs.knn import ann_index_path
 
-import multiprocessing 
-threads_available = multiprocessing.cpu_count()
 
 import sys
 import logging
@@ -43,16 +42,16 @@ parser.add_argument('--modality',
                     help="")
 
 
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 
 L.info("Running with params: %s", args)
 
 # this should be an object that contains the full log normalised data (adata_log1p.h5ad)
 # prior to hvgs and filtering
-#adata = read_anndata(args.input_anndata, use_muon=use_muon, modality="rna")
-L.info("Reading in MuData from '%s'" % args.input_anndata)
-mdata = mu.read(args.input_anndata)
-adata = mdata.mod[args.modality] 
+L.info("Reading in modality '%s' from '%s'" % (args.modality, args.input_anndata))
+adata = read_anndata(args.input_anndata, use_muon=True, modality=args.modality)
 
 # combat can't integrate on 2+ variables, so create a fake column with combined information
 columns = [x.strip() for x in args.integration_col.split(",")]
@@ -83,7 +82,9 @@ run_neighbors_method_choice(adata,
     n_pcs=int(args.neighbors_n_pcs), 
     metric=args.neighbors_metric, 
     use_rep='X_pca',
-    nthreads=max([threads_available, 6]))
+    nthreads=int(args.n_threads),
+    knn_store=args.knn_store, modality=args.modality, bc_method="combat",
+    ann_index=ann_index_path("tmp/combat_scaled_adata_" + args.modality + ".h5ad", 'X_pca', args.neighbors_metric))
 
 
 L.info("Computing UMAP")
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import scanpy as sc
 import argparse
@@ -7,9 +8,9 @@ import muon as mu
 from panpipes.funcs.processing import check_for_bool
 from panpipes.funcs.io import read_anndata, write_anndata
 from panpipes.funcs.scmethods import run_neighbors_method_choice
+from panpipes.funcs.knn import ann_index_path
+from panpipes.funcs.harmony import harmony_state_path, load_harmony_state, run_harmony, same_basis, save_harmony_state
 
-import multiprocessing 
-threads_available = multiprocessing.cpu_count()
 
 import sys
 import logging
@@ -44,6 +45,10 @@ parser.add_argument('--sigma_val', default=0.1,
                     help="sigma")
 parser.add_argument('--theta_val', default=1.0,
                     help="theta")                   
+parser.add_argument('--warm_start', default=False,
+                    help="start from the Harmony state saved by a previous run, if there is one")
+parser.add_argument('--harmony_batch_size', default=None,
+                    help="update the Harmony clusters in mini-batches of this number of cells")
 parser.add_argument('--neighbors_n_pcs', default=30,
                     help="n_pcs")
 parser.add_argument('--neighbors_method',
@@ -54,16 +59,17 @@ parser.add_argument('--neighbors_metric',
                     help="neighbor metric, e.g. euclidean or cosine")
 
 
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
+args.warm_start = check_for_bool(args.warm_start)
 
 L.info("Running with params: %s", args)
 
 # this should be an object that contains the full log normalised data (adata_log1p.h5ad)
 # prior to hvgs and filtering
-#adata = read_anndata(args.input_anndata, use_muon=use_muon, modality=args.modality)
-L.info("Reading in MuData from '%s'" % args.input_anndata)
-mdata = mu.read(args.input_anndata)
-adata = mdata.mod[args.modality] 
+L.info("Reading in modality '%s' from '%s'" % (args.modality, args.input_anndata))
+adata = read_anndata(args.input_anndata, use_muon=True, modality=args.modality)
 
 # Harmony can integrate on 2+ variables,
 # but for consistency with other approaches create a fake column with combined information
@@ -94,32 +100,64 @@ if len(columns)>1:
     L.info("Using 2 columns to integrate on more variables")
     #comb_columns = "_".join(columns)
     adata.obs["comb_columns"] = adata.obs[columns].apply(lambda x: '|'.join(x), axis=1)
-
-    # make sure that batch is a categorical
-    adata.obs["comb_columns"] = adata.obs["comb_columns"].astype("category")
-    # run harmony
-    L.info("Running Harmony")
-    ho = hm.run_harmony(adata.obsm[dimred][:,0:int(args.harmony_npcs)], adata.obs, ["comb_columns"], 
-                                       sigma = float(args.sigma_val),theta = float(args.theta_val),verbose=True,max_iter_kmeans=30, 
-                                       max_iter_harmony=40)
-
+    batch_col = "comb_columns"
 else:
-    # make sure that batch is a categorical
-    adata.obs[args.integration_col] = adata.obs[args.integration_col].astype("category")
-    # run harmony
+    batch_col = args.integration_col
+# make sure that batch is a categorical
+adata.obs[batch_col] = adata.obs[batch_col].astype("category")
+
+outfiletmp = ("tmp/harmony_scaled_adata_" + args.modality + ".h5ad" )
+state_file = harmony_state_path(outfiletmp)
+pcs = adata.obsm[dimred][:,0:int(args.harmony_npcs)]
+init_state = None
+if args.warm_start:
+    init_state = load_harmony_state(state_file)
+    if init_state is None:
+        L.warning("No Harmony state found in '%s', starting from scratch" % state_file)
+    elif init_state["Y"].shape[1] != pcs.shape[1]:
+        L.warning("The Harmony state in '%s' has %i dimensions instead of %i, starting from scratch" 
+                  % (state_file, init_state["Y"].shape[1], pcs.shape[1]))
+        init_state = None
+    elif not same_basis(init_state, pcs, adata.obs_names):
+        L.warning("The Harmony state in '%s' was computed on another %s, starting from scratch"
+                  % (state_file, dimred))
+        init_state = None
+
+# run harmony
+if init_state is None and args.harmony_batch_size is None:
     L.info("Running Harmony")
-    ho = hm.run_harmony(adata.obsm[dimred][:,0:int(args.harmony_npcs)],
+    ho = hm.run_harmony(pcs,
                         adata.obs,
-                        [args.integration_col],
+                        [batch_col],
                         sigma=float(args.sigma_val),
                         theta = float(args.theta_val),
                         verbose=True,max_iter_kmeans=30,
                         max_iter_harmony=40)
-
+    # harmonypy < 2 returns dims x cells, dims x clusters and clusters x cells
+    Z_corr, R, Y = np.asarray(ho.Z_corr), np.asarray(ho.R), np.asarray(ho.Y)
+    dims_first = Z_corr.shape[0] != adata.n_obs
+    Z_corr = Z_corr.T if dims_first else Z_corr
+    # the state holds clusters x dims centroids, with as many clusters as dims Y follows Z_corr
+    if Y.shape[1] != pcs.shape[1] or (Y.shape[0] == pcs.shape[1] and dims_first):
+        Y = Y.T
+    state = {"Y": Y, "R": R if R.shape[0] == adata.n_obs else R.T}
+else:
+    L.info("Running Harmony%s%s" % (" from the state in '%s'" % state_file if init_state is not None else "",
+                                     " in mini-batches of %s cells" % args.harmony_batch_size
+                                     if args.harmony_batch_size is not None else ""))
+    Z_corr, state = run_harmony(pcs, adata.obs, [batch_col],
+                                sigma=float(args.sigma_val),
+                                theta=float(args.theta_val),
+                                batch_size=int(args.harmony_batch_size) if args.harmony_batch_size is not None else None,
+                                max_iter_kmeans=30,
+                                max_iter_harmony=40,
+                                init_state=init_state)
+
+L.info("Saving the Harmony state to '%s'" % state_file)
+save_harmony_state(state_file, state["Y"], state["R"], adata.obs_names, Z=pcs)
 
 L.info("Saving harmony co-ords to .obsm['X_harmony']")
-adjusted_pcs = pd.DataFrame(ho.Z_corr).T
-adata.obsm['X_harmony']=adjusted_pcs.values
+adata.obsm['X_harmony'] = Z_corr
 
 if int(args.neighbors_n_pcs) >adata.obsm['X_harmony'].shape[1]:
     L.warn(f"N PCs is larger than X_harmony dimensions, reducing n PCs to  {adata.obsm['X_harmony'].shape[1] -1}")
@@ -134,7 +172,9 @@ run_neighbors_method_choice(adata,
     n_pcs=n_pcs, 
     metric=args.neighbors_metric, 
     use_rep='X_harmony',
-    nthreads=max([threads_available, 6]))
+    nthreads=int(args.n_threads),
+    knn_store=args.knn_store, modality=args.modality, bc_method="harmony",
+    ann_index=ann_index_path(outfiletmp, 'X_harmony', args.neighbors_metric))
 
 
 L.info("Computing UMAP")
@@ -149,7 +189,6 @@ umap.to_csv(args.output_csv)
 #adata.write("tmp/harmony_scaled_adata_" + args.modality + ".h5ad")
 
 
-outfiletmp = ("tmp/harmony_scaled_adata_" + args.modality + ".h5ad" )
 L.info("Saving AnnData to '%s'" % outfiletmp)
 write_anndata(adata, outfiletmp, use_muon=False, modality=args.modality)
 
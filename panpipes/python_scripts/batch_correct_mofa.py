@@ -1,4 +1,3 @@
-import multiprocessing 
 
 import scanpy as sc
 import pandas as pd
@@ -12,6 +11,7 @@ import panpipes.funcs as pp
 from panpipes.funcs.processing import check_for_bool
 from panpipes.funcs.io import read_anndata, write_anndata
 from panpipes.funcs.scmethods import run_neighbors_method_choice, X_is_raw
+from panpipes.funcs.knn import ann_index_path
 
 import sys
 import logging
@@ -54,6 +54,10 @@ parser.add_argument('--neighbors_k', default=30,
 parser.add_argument('--neighbors_metric',default="euclidean",
                     help="neighbor metric, e.g. euclidean or cosine")
 
+parser.add_argument('--n_threads', default=1,
+                    help="num threads to use for neighbor computations")
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 
 L.info("Running with params: %s", args)
@@ -65,7 +69,6 @@ sc.settings.figdir = args.figdir
 
 # load parameters
 
-threads_available = multiprocessing.cpu_count()
 params = pp.io.read_yaml("pipeline.yml")
 
 L.info("Reading in MuData from '%s'" % args.scaled_anndata)
@@ -167,7 +170,9 @@ run_neighbors_method_choice(mdata,
     n_pcs=n_pcs, #this should be the # rows of var, not obs ???????
     metric=args.neighbors_metric, 
     use_rep='X_mofa',
-    nthreads=max([threads_available, 6]))
+    nthreads=int(args.n_threads),
+    knn_store=args.knn_store, modality="multimodal", bc_method="mofa",
+    ann_index=ann_index_path("tmp/mofa_scaled_adata.h5mu", 'X_mofa', args.neighbors_metric))
 
 L.info("Computing UMAP")
 sc.tl.umap(mdata, min_dist=0.4)
@@ -1,4 +1,3 @@
-import multiprocessing 
 
 import scanpy as sc
 import pandas as pd
@@ -15,6 +14,7 @@ import gc
 from panpipes.funcs.processing import check_for_bool
 from panpipes.funcs.io import read_anndata, write_anndata
 from panpipes.funcs.scmethods import run_neighbors_method_choice, X_is_raw
+from panpipes.funcs.knn import ann_index_path
 
 import sys
 import logging
@@ -52,6 +52,10 @@ parser.add_argument('--scvi_seed',default=None,
 
 
 
+parser.add_argument('--n_threads', default=1,
+                    help="num threads to use for neighbor computations")
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
@@ -66,7 +70,6 @@ else:
     scvi.settings.seed = 1492
 # load parameters
 
-threads_available = multiprocessing.cpu_count()
 params = pp.io.read_yaml("pipeline.yml")
 
 test_script=False
@@ -290,7 +293,9 @@ run_neighbors_method_choice(mdata,
     n_pcs=n_pcs, 
     metric=args.neighbors_metric, 
     use_rep='X_MultiVI',
-    nthreads=max([threads_available, 6]))
+    nthreads=int(args.n_threads),
+    knn_store=args.knn_store, modality="multimodal", bc_method="multivi",
+    ann_index=ann_index_path("tmp/multivi_scaled_adata.h5mu", 'X_MultiVI', args.neighbors_metric))
 L.info("Computing UMAP")
 sc.tl.umap(mdata, min_dist=0.4)
 L.info("Computing Leiden clustering")
@@ -1,6 +1,4 @@
 # check for threads number
-import multiprocessing 
-threads_available = multiprocessing.cpu_count()
 
 # import numpy as np
 import pandas as pd
@@ -11,6 +9,7 @@ from muon import MuData
 from panpipes.funcs.processing import check_for_bool
 from panpipes.funcs.io import read_anndata, write_anndata
 from panpipes.funcs.scmethods import run_neighbors_method_choice
+from panpipes.funcs.knn import ann_index_path
 import muon as mu
 import sys
 import logging
@@ -47,6 +46,8 @@ parser.add_argument('--neighbors_k',
 parser.add_argument('--neighbors_metric',
                     help="neighbor metric, e.g. euclidean or cosine")
 
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
@@ -112,7 +113,9 @@ run_neighbors_method_choice(adata,
     method=args.neighbors_method, 
     n_neighbors=int(args.neighbors_k), 
     metric=args.neighbors_metric, 
-    nthreads=max([threads_available, 6]), **pc_kwargs)
+    nthreads=int(args.n_threads), **pc_kwargs,
+    knn_store=args.knn_store, modality=args.modality, bc_method="none",
+    ann_index=ann_index_path("tmp/no_correction_scaled_adata_" + args.modality + ".h5ad", pc_kwargs['use_rep'], args.neighbors_metric))
 
 
 L.info("Computing UMAP")
@@ -14,6 +14,7 @@ import muon as mu
 from panpipes.funcs.processing import check_for_bool
 from panpipes.funcs.io import read_anndata, write_anndata
 from panpipes.funcs.scmethods import run_neighbors_method_choice
+from panpipes.funcs.knn import ann_index_path
 
 import sys
 import logging
@@ -25,8 +26,6 @@ log_handler.setFormatter(formatter)
 L.addHandler(log_handler)
 
 # check for threads number
-import multiprocessing 
-threads_available = multiprocessing.cpu_count()
 
 # parse arguments
 parser = argparse.ArgumentParser()
@@ -55,16 +54,16 @@ parser.add_argument('--modality',
 
 
 
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 
 L.info("Running with params: %s", args)
 
 # Scanorama is designed to be used in scRNA-seq pipelines downstream of noise-reduction methods,
 # including those for imputation and highly-variable gene filtering.
-#adata = read_anndata(args.input_anndata, use_muon=use_muon, modality="rna")
-L.info("Reading in MuData from '%s'" % args.input_anndata)
-mdata = mu.read(args.input_anndata)
-adata = mdata.mod[args.modality] 
+L.info("Reading in modality '%s' from '%s'" % (args.modality, args.input_anndata))
+adata = read_anndata(args.input_anndata, use_muon=True, modality=args.modality)
 bcs = adata.obs_names.tolist()
 
 # scanorama can't integrate on 2+ variables, so create a fake column with combined information
@@ -136,7 +135,9 @@ run_neighbors_method_choice(adata,
     n_pcs=n_pcs, 
     metric=args.neighbors_metric, 
     use_rep='X_scanorama',
-    nthreads=max([threads_available, 6]))
+    nthreads=int(args.n_threads),
+    knn_store=args.knn_store, modality=args.modality, bc_method="scanorama",
+    ann_index=ann_index_path("tmp/scanorama_scaled_adata.h5ad", 'X_scanorama', args.neighbors_metric))
 
 L.info("Computing UMAP")
 sc.tl.umap(adata)
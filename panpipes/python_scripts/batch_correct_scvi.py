@@ -1,4 +1,3 @@
-import multiprocessing 
 
 
 import scanpy as sc
@@ -11,7 +10,9 @@ import muon as mu
 
 import panpipes.funcs as pp
 from panpipes.funcs.io import read_anndata, read_yaml
-from panpipes.funcs.scmethods import run_neighbors_method_choice, X_is_raw
+from panpipes.funcs.scmethods import run_neighbors_method_choice, X_is_raw, incremental_latent
+from panpipes.funcs.processing import check_for_bool
+from panpipes.funcs.knn import ann_index_path
 
 import sys
 import logging
@@ -49,10 +50,13 @@ parser.add_argument('--scvi_seed',default=None,
 
 
 
+parser.add_argument('--n_threads', default=1,
+                    help="num threads to use for neighbor computations")
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
-threads_available = multiprocessing.cpu_count()
 
 # load parameters
 params = read_yaml("pipeline.yml")
@@ -123,6 +127,10 @@ else:
     rna.layers["raw_counts"] = sc_raw.X.copy()
 
 
+# all the genes of the new cells are kept for an incremental run,
+# they are matched to the genes of the saved model
+rna_all = rna
+
 # filter out mitochondria
 if params['rna']['scvi']['exclude_mt_genes']:
     L.info("Filtering out mitochondrial genes")
@@ -141,44 +149,67 @@ if test_script:
 rna = rna.copy()
 
 
-L.info("Setting up AnnData")
-scvi.model.SCVI.setup_anndata(
-    rna,
-    layer="raw_counts",
-    batch_key='bc_batch'
-)
+model_dir = os.path.join("batch_correction", "scvi_model")
+previous_file = os.path.join("tmp", "scvi_scaled_adata_rna.h5ad")
+incremental = check_for_bool(params['rna']['scvi'].get('incremental', False))
+if incremental and not (os.path.exists(model_dir) and os.path.exists(previous_file)):
+    L.warning("No saved model in '%s' or latent representation in '%s', training a new model" 
+              % (model_dir, previous_file))
+    incremental = False
+
+if incremental:
+    L.info("Reading the latent representation of the previous run from '%s'" % previous_file)
+    previous = sc.read_h5ad(previous_file, backed="r")
+    previous_latent = pd.DataFrame(previous.obsm["X_scVI"], index=previous.obs_names)
+    previous.file.close()
+    L.info("Mapping the new cells with the model in '%s'" % model_dir)
+    # only the cells kept in rna, which is subsampled in a test run
+    latent, vae_q = incremental_latent(scvi.model.SCVI, rna_all[rna.obs_names], model_dir, previous_latent,
+                                       batch_key="bc_batch",
+                                       max_epochs=params['rna']['scvi'].get('incremental_max_epochs') or 100)
+    if vae_q is not None:
+        L.info("Saving the model extended to the new batches")
+        vae_q.save(model_dir, anndata=False, overwrite=True)
+else:
+    L.info("Setting up AnnData")
+    scvi.model.SCVI.setup_anndata(
+        rna,
+        layer="raw_counts",
+        batch_key='bc_batch'
+    )
+
+    scvi_model_args =  {k: v for k, v in params['rna']['scvi']['model_args'].items() if v is not None}
+    print(scvi_model_args)
+    scvi_training_args =  {k: v for k, v in params['rna']['scvi']['training_args'].items() if v is not None}
+    print(scvi_training_args)
+    scvi_training_plan =  {k: v for k, v in params['rna']['scvi']['training_plan'].items() if v is not None}
+    print(scvi_training_plan)
+
+    L.info("Defining model")
+    vae = scvi.model.SCVI(rna, **scvi_model_args) 
+    L.info("Running scVI")
+    vae.train(**scvi_training_args, plan_kwargs=scvi_training_plan) 
+    L.info("Finished Training now saving model")
+    vae.save(model_dir, 
+                      anndata=False, overwrite=True)
+
+    # no early stopping?
+    L.info("Plotting ELBO")
+    vae.history["elbo_train"].plot()
+    plt.savefig(os.path.join(args.figdir, "scvi_elbo_train.png"))
+
+    fig, axs = plt.subplots(nrows=4, ncols=4, figsize=(16,10))
+    axs = axs.ravel()
+    for i, kk in enumerate(vae.history.keys()):
+        vae.history[kk].plot(ax=axs[i])
+        
+    fig.tight_layout()
+    plt.savefig(os.path.join(args.figdir, "scvi_metrics.png"))
+
+    # vae.history['elbo_train']['elbo_train'].to_list()
+    L.info("Extracting latent space")
+    latent = vae.get_latent_representation()
 
-scvi_model_args =  {k: v for k, v in params['rna']['scvi']['model_args'].items() if v is not None}
-print(scvi_model_args)
-scvi_training_args =  {k: v for k, v in params['rna']['scvi']['training_args'].items() if v is not None}
-print(scvi_training_args)
-scvi_training_plan =  {k: v for k, v in params['rna']['scvi']['training_plan'].items() if v is not None}
-print(scvi_training_plan)
-
-L.info("Defining model")
-vae = scvi.model.SCVI(rna, **scvi_model_args) 
-L.info("Running scVI")
-vae.train(**scvi_training_args, plan_kwargs=scvi_training_plan) 
-L.info("Finished Training now saving model")
-vae.save(os.path.join("batch_correction", "scvi_model"), 
-                  anndata=False)
-
-# no early stopping?
-L.info("Plotting ELBO")
-vae.history["elbo_train"].plot()
-plt.savefig(os.path.join(args.figdir, "scvi_elbo_train.png"))
-
-fig, axs = plt.subplots(nrows=4, ncols=4, figsize=(16,10))
-axs = axs.ravel()
-for i, kk in enumerate(vae.history.keys()):
-    vae.history[kk].plot(ax=axs[i])
-    
-fig.tight_layout()
-plt.savefig(os.path.join(args.figdir, "scvi_metrics.png"))
-
-# vae.history['elbo_train']['elbo_train'].to_list()
-L.info("Extracting latent space")
-latent = vae.get_latent_representation()
 L.info("Saving latent to X_scVI")
 rna.obsm["X_scVI"] = latent
 rna.obs['bc_batch'] = rna.obs['bc_batch']
@@ -203,7 +234,9 @@ run_neighbors_method_choice(rna,
     n_pcs=n_pcs, 
     metric=args.neighbors_metric, 
     use_rep='X_scVI',
-    nthreads=max([threads_available, 6]))
+    nthreads=int(args.n_threads),
+    knn_store=args.knn_store, modality="rna", bc_method="scvi",
+    ann_index=ann_index_path("tmp/scvi_scaled_adata_rna.h5ad", 'X_scVI', args.neighbors_metric))
 
 L.info("Computing UMAP")
 sc.tl.umap(rna)
@@ -1,4 +1,3 @@
-import multiprocessing 
 
 import scanpy as sc
 import pandas as pd
@@ -10,8 +9,9 @@ import gc
 import muon as mu
 
 from panpipes.funcs.io import read_anndata, read_yaml
-from panpipes.funcs.scmethods import run_neighbors_method_choice, X_is_raw
-from panpipes.funcs.processing import intersect_obs_by_mod
+from panpipes.funcs.scmethods import run_neighbors_method_choice, X_is_raw, incremental_latent
+from panpipes.funcs.knn import ann_index_path
+from panpipes.funcs.processing import intersect_obs_by_mod, check_for_bool
 
 import sys
 import logging
@@ -52,6 +52,10 @@ parser.add_argument('--scvi_seed',default=None,
     
 
 
+parser.add_argument('--n_threads', default=1,
+                    help="num threads to use for neighbor computations")
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 # scanpy settings
@@ -67,7 +71,6 @@ else:
 
 # load parameters
 
-threads_available = multiprocessing.cpu_count()
 
 params = read_yaml("pipeline.yml")
 params['sample_prefix']
@@ -149,19 +152,6 @@ if 'isotype' in prot.var.columns:
     L.info("Excluding isotypes")
     prot = prot[:, ~prot.var.isotype]
 
-# filter out mitochondria
-if params['multimodal']['totalvi']['exclude_mt_genes']:
-    L.info("Filtering out mitochondrial genes")
-    rna = rna[:, ~rna.var[params['multimodal']['totalvi']['mt_column']]]
-    
-# filter by Hvgs
-
-if params['multimodal']['totalvi']['filter_by_hvg']:
-    L.info("Filtering by HVGs")
-    rna = rna[:, rna.var.highly_variable]
-
-mdata.update()
-
 #make protein obsm pandas
 # need to find the raw counts in prot
 if X_is_raw(prot):
@@ -193,52 +183,98 @@ gc.collect()
 
 mdata.update()
 
-L.info("Setting up AnnData")
-scvi.model.TOTALVI.setup_anndata(
-    rna,
-    layer="counts",
-    protein_expression_obsm_key="protein_expression",
-    # categorical_covariate_keys = "bc_batch"
-    **kwargs
-)
-
-if params['multimodal']['totalvi']['model_args'] is None:
-    totalvi_model_args =  {}
-else:
-    totalvi_model_args =  {k: v for k, v in params['multimodal']['totalvi']['model_args'].items() if v is not None}
+# all the genes of the new cells are kept for an incremental run,
+# they are matched to the genes of the saved model
+rna_all = rna
+
+# filter out mitochondria
+if params['multimodal']['totalvi']['exclude_mt_genes']:
+    L.info("Filtering out mitochondrial genes")
+    rna = rna[:, ~rna.var[params['multimodal']['totalvi']['mt_column']]]
+    
+# filter by Hvgs
 
+if params['multimodal']['totalvi']['filter_by_hvg']:
+    L.info("Filtering by HVGs")
+    rna = rna[:, rna.var.highly_variable]
 
-if params['multimodal']['totalvi']['training_args'] is None:
-    totalvi_training_args = {}
-else:
-    totalvi_training_args =  {k: v for k, v in params['multimodal']['totalvi']['training_args'].items() if v is not None}
+mdata.update()
 
 
-if params['multimodal']['totalvi']['training_plan'] is None:
-    totalvi_training_plan = {}
+model_dir = os.path.join("batch_correction", "totalvi_model")
+previous_file = os.path.join("tmp", "totalvi_scaled_adata.h5mu")
+incremental = check_for_bool(params['multimodal']['totalvi'].get('incremental', False))
+if incremental and not (os.path.exists(model_dir) and os.path.exists(previous_file)):
+    L.warning("No saved model in '%s' or latent representation in '%s', training a new model" 
+              % (model_dir, previous_file))
+    incremental = False
+
+if incremental:
+    L.info("Reading the latent representation of the previous run from '%s'" % previous_file)
+    previous = mu.read_h5mu(previous_file, backed=True)
+    previous_latent = pd.DataFrame(previous.obsm["X_totalVI"], index=previous.obs_names)
+    del previous
+    L.info("Mapping the new cells with the model in '%s'" % model_dir)
+    latent, vae = incremental_latent(scvi.model.TOTALVI, rna_all, model_dir, previous_latent,
+                                     batch_key="bc_batch",
+                                     max_epochs=params['multimodal']['totalvi'].get('incremental_max_epochs') or 100)
+    # the denoised expression of all the cells is computed with the genes of the model
+    rna = rna.copy()
+    scvi.model.TOTALVI.prepare_query_anndata(rna, model_dir)
+    if vae is not None:
+        L.info("Saving the model extended to the new batches")
+        vae.save(model_dir, anndata=False, overwrite=True)
+    else:
+        vae = scvi.model.TOTALVI.load(model_dir, adata=rna)
 else:
-    totalvi_training_plan =  {k: v for k, v in params['multimodal']['totalvi']['training_plan'].items() if v is not None}
+    L.info("Setting up AnnData")
+    scvi.model.TOTALVI.setup_anndata(
+        rna,
+        layer="counts",
+        protein_expression_obsm_key="protein_expression",
+        # categorical_covariate_keys = "bc_batch"
+        **kwargs
+    )
+
+    if params['multimodal']['totalvi']['model_args'] is None:
+        totalvi_model_args =  {}
+    else:
+        totalvi_model_args =  {k: v for k, v in params['multimodal']['totalvi']['model_args'].items() if v is not None}
+
+
+    if params['multimodal']['totalvi']['training_args'] is None:
+        totalvi_training_args = {}
+    else:
+        totalvi_training_args =  {k: v for k, v in params['multimodal']['totalvi']['training_args'].items() if v is not None}
+
+
+    if params['multimodal']['totalvi']['training_plan'] is None:
+        totalvi_training_plan = {}
+    else:
+        totalvi_training_plan =  {k: v for k, v in params['multimodal']['totalvi']['training_plan'].items() if v is not None}
 
-print(totalvi_model_args)
-print(totalvi_training_args)
-print(totalvi_training_plan)
+    print(totalvi_model_args)
+    print(totalvi_training_args)
+    print(totalvi_training_plan)
 
-L.info("Defining model")
-vae = scvi.model.TOTALVI(rna, **totalvi_model_args)
-L.info("Running totalVI")
-vae.train(**totalvi_training_args, plan_kwargs=totalvi_training_plan)
+    L.info("Defining model")
+    vae = scvi.model.TOTALVI(rna, **totalvi_model_args)
+    L.info("Running totalVI")
+    vae.train(**totalvi_training_args, plan_kwargs=totalvi_training_plan)
 
-vae.save(os.path.join("batch_correction", "totalvi_model"), 
-                  anndata=False, overwrite=True )
+    vae.save(model_dir, 
+                      anndata=False, overwrite=True )
 
 
-L.info("Plotting ELBO")
-plt.plot(vae.history["elbo_train"], label="train")
-plt.plot(vae.history["elbo_validation"], label="validation")
-plt.title("Negative ELBO over training epochs")
-# plt.ylim(1200, 1400)
-plt.legend()
-plt.savefig(os.path.join(args.figdir, "totalvi_elbo_plot.png"))
+    L.info("Plotting ELBO")
+    plt.plot(vae.history["elbo_train"], label="train")
+    plt.plot(vae.history["elbo_validation"], label="validation")
+    plt.title("Negative ELBO over training epochs")
+    # plt.ylim(1200, 1400)
+    plt.legend()
+    plt.savefig(os.path.join(args.figdir, "totalvi_elbo_plot.png"))
+    latent = vae.get_latent_representation()
+del rna_all
 
 # scvi.model..view_anndata_setup(vae.adata)
 
@@ -253,13 +289,14 @@ L.info("""We support the use of mudata as a general framework for multimodal dat
             """)
 
 L.info("Extracting latent space and saving latent to X_totalVI")
-mdata.obsm["X_totalVI"] = vae.get_latent_representation()
+mdata.obsm["X_totalVI"] = latent
 
 if batch_categories is not None:
     L.debug(batch_categories)
     if type(batch_categories) is not list:
         batch_categories = [batch_categories]
     normX, protein = vae.get_normalized_expression(
+        adata=rna,
         n_samples=25,
         return_mean=True,
         transform_batch=batch_categories
@@ -271,6 +308,7 @@ if batch_categories is not None:
     mdata['prot'].obsm["totalvi_denoised_protein"] = protein.loc[mdata['prot'].obs_names,:]
     #
     df = vae.get_protein_foreground_probability(
+        adata=rna,
         n_samples=25,
         return_mean=True,
         transform_batch=batch_categories
@@ -295,7 +333,9 @@ run_neighbors_method_choice(mdata,
     n_pcs=n_pcs, 
     metric=args.neighbors_metric, 
     use_rep='X_totalVI',
-    nthreads=max([threads_available, 6]))
+    nthreads=int(args.n_threads),
+    knn_store=args.knn_store, modality="multimodal", bc_method="totalvi",
+    ann_index=ann_index_path("tmp/totalvi_scaled_adata.h5mu", 'X_totalVI', args.neighbors_metric))
 
 L.info("Computing UMAP")
 sc.tl.umap(mdata, min_dist=0.4)
@@ -1,4 +1,3 @@
-import multiprocessing 
 
 import scanpy as sc
 import pandas as pd
@@ -41,6 +40,10 @@ parser.add_argument('--low_memory',default=True,
                     help="set to True by default if cells in dataset >50k")
 
 
+parser.add_argument('--n_threads', default=1,
+                    help="num threads to use for neighbor computations")
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 
 L.info("Running with params: %s", args)
@@ -50,7 +53,6 @@ sc.settings.autoshow = False
 sc.settings.figdir = args.figdir
 
 params = pp.io.read_yaml("pipeline.yml")
-threads_available = multiprocessing.cpu_count()
 
 
 if params['multimodal']['WNN']['modalities'] is not None:
@@ -142,7 +144,8 @@ for kmod in dict_graph.keys():
                             metric=pkmod['metric'], 
                             #does this throw an error if no PCA for any single mod is stored?
                             use_rep=repuse,
-                            nthreads=max([threads_available, 6]))
+                            nthreads=int(args.n_threads),
+                            knn_store=args.knn_store, modality=kmod, bc_method="wnn")
         else:
             L.info("Using %s" %(dict_graph[kmod]["obsm"]))            
     else:
@@ -163,7 +166,8 @@ for kmod in dict_graph.keys():
             metric=pkmod['metric'], 
             #does this throw an error if no PCA for any single mod is stored?
             use_rep=repuse,
-            nthreads=max([threads_available, 6]))
+            nthreads=int(args.n_threads),
+            knn_store=args.knn_store, modality=kmod, bc_method="wnn")
 
 tmp.update()
 
@@ -1,13 +1,15 @@
 import argparse
 import logging
+import os
 import re
 import sys
 import warnings
 
+import h5py
 import muon as mu
 import pandas as pd
 
-from panpipes.funcs.processing import concat_mdatas
+from panpipes.funcs.processing import check_for_bool, concat_mdatas, concat_mdatas_on_disk
 
 pd.set_option("display.max_rows", None)
 
@@ -52,6 +54,11 @@ parser.add_argument(
 )
 parser.add_argument("--protein_var_table", default=None, help="")
 parser.add_argument("--protein_new_index_col", default=None, help="")
+parser.add_argument(
+    "--streaming",
+    default=False,
+    help="concatenate the samples on disk, reading them one at a time",
+)
 
 parser.set_defaults(verbose=True)
 args, opt = parser.parse_known_args()
@@ -70,95 +77,125 @@ sfile = args.submissionfile
 
 L.info("Reading in submission file from '%s'" % sfile)
 caf = pd.read_csv(sfile, sep="\t")
-# the modality argument is relevent only if use_muon is True.
-# mdatas = [read_anndata(i, use_muon, modality="all") for i in lf]
-mdatas = [mu.read(i) for i in lf]
-# [x.var_names_make_unique() for x in mdatas]
-
-
-if len(mdatas) == 1:
-    # if mdatas length is 0 then no concatenation required
-    mdata = mdatas[0]
-else:
-    # @Fabiola I don't understand whats supposed to happen here
-    # with the atac, should it just error out to say
-    # that atac shouldn't be concatenated?
-    temp = mdatas[0]
-    if "atac" in temp.mod.keys():
-        mdata = mdatas[0]
-        del temp
-    elif "prot" in temp.mod.keys() or "rna" in temp.mod.keys():
-        ## IF RNA and PROT is ok to concatenate ----------
-        L.info("Concatenating RNA and prot")
-        mdata = concat_mdatas(mdatas, batch_key="sample_id", join_type=args.join_type)
-
-# remove to avoid mem issues
-del mdatas
 
-### add metmdata from caf
-L.debug(mdata.obs.columns)
-L.debug(mdata.obs.head())
 
-L.info("Adding metadata")
-# add metmdata to each object
-metadatacols = args.metadatacols
-# metadatacols="mdata_cols"
-# check sample_id is in metadatacols as a minimum requirement
-if metadatacols is None:
-    pass
-elif metadatacols.lower() == "none":
-    pass
-else:
-    metadatacols = metadatacols.split(",")
-
-    if "sample_id" not in metadatacols:
-        metadatacols = ["sample_id"] + metadatacols
-
-    # check all metadatacols are in the caf
-    if all([x in caf.columns for x in metadatacols]):
-        # if mdata is actually a mudata it will be helpful
-        # (although annoying to store this in rna and protein as
-        # well since the batch columns etc will be here)
-        # hopefullt his whole bit will become unnesacry because of
-        # https://github.com/scverse/mudata/issues/2
-        for mod in mdata.mod.keys():
-            L.debug(mod)
-            L.debug(mdata[mod].obs.head())
-            assay = mdata[mod]
-            # make sure there is no index name because rep might have one as default
-            assay.obs.index.name = None
-            assay.obs = (
-                assay.obs.reset_index()
+def add_sample_metadata(mdata):
+    """
+    add the metadatacols of the submission file to the obs of each modality and the top level
+    """
+    L.debug(mdata.obs.columns)
+    L.debug(mdata.obs.head())
+
+    L.info("Adding metadata")
+    # add metmdata to each object
+    metadatacols = args.metadatacols
+    # metadatacols="mdata_cols"
+    # check sample_id is in metadatacols as a minimum requirement
+    if metadatacols is None:
+        pass
+    elif metadatacols.lower() == "none":
+        pass
+    else:
+        metadatacols = metadatacols.split(",")
+
+        if "sample_id" not in metadatacols:
+            metadatacols = ["sample_id"] + metadatacols
+
+        # check all metadatacols are in the caf
+        if all([x in caf.columns for x in metadatacols]):
+            # if mdata is actually a mudata it will be helpful
+            # (although annoying to store this in rna and protein as
+            # well since the batch columns etc will be here)
+            # hopefullt his whole bit will become unnesacry because of
+            # https://github.com/scverse/mudata/issues/2
+            for mod in mdata.mod.keys():
+                L.debug(mod)
+                L.debug(mdata[mod].obs.head())
+                assay = mdata[mod]
+                # make sure there is no index name because rep might have one as default
+                assay.obs.index.name = None
+                assay.obs = (
+                    assay.obs.reset_index()
+                    .merge(caf[metadatacols], on="sample_id", how="left")
+                    .set_index("index")
+                    .copy()
+                )
+                # remove the index name introduced with the set index.
+                assay.obs.index_name = None
+                L.debug(assay.obs.head())
+
+            mdata.update_obs()
+
+            # merge metadata
+            # obs = mdata.obs
+            # obs['cellbarcode'] = obs.index
+            mdata.obs = (
+                mdata.obs.reset_index()
                 .merge(caf[metadatacols], on="sample_id", how="left")
                 .set_index("index")
-                .copy()
             )
-            # remove the index name introduced with the set index.
-            assay.obs.index_name = None
-            L.debug(assay.obs.head())
-
-        mdata.update_obs()
-
-        # merge metadata
-        # obs = mdata.obs
-        # obs['cellbarcode'] = obs.index
-        mdata.obs = (
-            mdata.obs.reset_index()
-            .merge(caf[metadatacols], on="sample_id", how="left")
-            .set_index("index")
-        )
 
-        mdata.obs.index.name = None
+            mdata.obs.index.name = None
+
+            mdata.obs["cellbarcode"] = mdata.obs.index
+
+            mdata.update_obs()
+        else:
+            # which column is missing?
+            missingcols = " ".join([x for x in metadatacols if x not in caf.columns])
+            sys.exit(caf.columns)
+            L.error("Required columns missing form samples file: %s" % missingcols)
+            sys.exit("Required columns missing form samples file: %s" % missingcols)
+
 
-        mdata.obs["cellbarcode"] = mdata.obs.index
+# the modality argument is relevent only if use_muon is True.
+# mdatas = [read_anndata(i, use_muon, modality="all") for i in lf]
+if check_for_bool(args.streaming) and len(lf) > 1:
+    # concatenate on disk, reading the samples one at a time
+    with h5py.File(lf[0], "r", locking=False) as f:
+        first_mods = list(f["mod"].keys())
+    if "atac" in first_mods:
+        mdata = mu.read(lf[0])
+    elif "prot" in first_mods or "rna" in first_mods:
+        L.info("Concatenating RNA and prot on disk")
+        if args.barcode_mtd_df is None and args.protein_var_table is None:
+            # only obs is changed, so the sample metadata is added before the matrices
+            # are copied into the output and the concatenated object is never loaded
+            concat_mdatas_on_disk(lf, args.output_file, batch_key="sample_id", join_type=args.join_type,
+                                  update_metadata=add_sample_metadata)
+            L.info("Done")
+            sys.exit(0)
+        # the barcode metadata and the protein var table can subset cells and features,
+        # which needs the concatenated object in memory
+        concat_file = args.output_file + ".concat.tmp"
+        concat_mdatas_on_disk(lf, concat_file, batch_key="sample_id", join_type=args.join_type)
+        mdata = mu.read(concat_file)
+        os.remove(concat_file)
+else:
+    mdatas = [mu.read(i) for i in lf]
+    # [x.var_names_make_unique() for x in mdatas]
 
-        mdata.update_obs()
+    if len(mdatas) == 1:
+        # if mdatas length is 0 then no concatenation required
+        mdata = mdatas[0]
     else:
-        # which column is missing?
-        missingcols = " ".join([x for x in metadatacols if x not in caf.columns])
-        sys.exit(caf.columns)
-        L.error("Required columns missing form samples file: %s" % missingcols)
-        sys.exit("Required columns missing form samples file: %s" % missingcols)
+        # @Fabiola I don't understand whats supposed to happen here
+        # with the atac, should it just error out to say
+        # that atac shouldn't be concatenated?
+        temp = mdatas[0]
+        if "atac" in temp.mod.keys():
+            mdata = mdatas[0]
+            del temp
+        elif "prot" in temp.mod.keys() or "rna" in temp.mod.keys():
+            ## IF RNA and PROT is ok to concatenate ----------
+            L.info("Concatenating RNA and prot")
+            mdata = concat_mdatas(mdatas, batch_key="sample_id", join_type=args.join_type)
+
+    # remove to avoid mem issues
+    del mdatas
+
+### add metmdata from caf
+add_sample_metadata(mdata)
 
 
 # if 'rep' in mdata.mod.keys():
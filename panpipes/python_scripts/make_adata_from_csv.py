@@ -1,3 +1,8 @@
+import os
+# with --n_jobs the modalities of a sample are read by concurrent threads, often from one
+# 10x h5 (rna and prot), and HDF5 file locking fails for concurrent reads on NFS/Lustre.
+# scanpy opens these files itself, so locking is disabled before h5py is loaded
+os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
 import argparse
 import yaml
 # import scanpy as sc
@@ -76,6 +81,9 @@ parser.add_argument('--peak_annotation_file',
 parser.add_argument('--fragments_file',
                     default=None,
                     help='ATAC/Multiome specific input file from csv')                    
+parser.add_argument('--n_jobs',
+                    default=1, type=int,
+                    help='number of modalities to load concurrently')
 
 
 parser.set_defaults(verbose=True)
@@ -100,7 +108,7 @@ all_files = {nm: x  for (nm, x) in all_files.items() if nm in permf}
 # this will work for any combination of modalities or number of modalities in all_files.
 [check_filetype(x[0], x[1]) for x in all_files.values()]
 L.info("Creating MuData")
-mdata = load_mdata_from_multiple_files(all_files)
+mdata = load_mdata_from_multiple_files(all_files, n_jobs=args.n_jobs)
                 
 # now lets do some extra processing on the different modalities
 L.info("Preprocessing each modality")
@@ -4,7 +4,7 @@ CRG 2020-06-19
 """
 
 import scanpy as sc
-from muon import read, MuData
+from muon import MuData
 sc.settings.autoshow = False
 import pandas as pd
 import argparse
@@ -13,6 +13,7 @@ import matplotlib
 matplotlib.use('agg')
 import os 
 import re
+from panpipes.funcs.io import read_anndata
 
 import sys
 import logging
@@ -92,7 +93,10 @@ def plot_spatial(adata,figdir):
 
 
 L.info("Reading in MuData from '%s'" % args.infile)
-mdata = read(args.infile)
+# only the cluster columns and the embeddings are plotted, X stays on disk
+# an h5ad input is read as a single AnnData
+use_muon = os.path.splitext(args.infile)[1] != ".h5ad"
+mdata = read_anndata(args.infile, use_muon=use_muon, modality="all", lazy=True, obs=True, obsm=True)
 
 mods = args.modalities.split(',')
 # detemin initial figure directory based on object type
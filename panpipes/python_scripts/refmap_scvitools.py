@@ -1,4 +1,3 @@
-import multiprocessing
 from matplotlib import transforms 
 
 import anndata as ad
@@ -58,6 +57,8 @@ parser.add_argument('--neighbors_metric',default="euclidean",
                     help="neighbor metric, e.g. euclidean or cosine")
 parser.add_argument('--outfile',default=None,
                     help="file where to save umap")
+parser.add_argument('--n_threads', default=1,
+                    help="number of threads for the neighbors search")
 
 args, opt = parser.parse_known_args()
 sc.settings.figdir = "figures/"
@@ -67,8 +68,6 @@ args.impute_proteins = check_for_bool(args.impute_proteins)
 
 L.info("Running with params: %s", args)
 
-threads_available = multiprocessing.cpu_count()
-
 # load parameters
 params = read_yaml("pipeline.yml")
 query_data = os.path.basename(args.query_data)
@@ -363,7 +362,7 @@ run_neighbors_method_choice(adata_full,
             n_pcs=n_pcs, 
             metric=args.neighbors_metric, 
             use_rep=latent_choice,
-            nthreads=max([threads_available, 6]))
+            nthreads=int(args.n_threads))
 L.info("Running UMAP and Leiden")
 sc.tl.umap(adata_full, min_dist=0.4)
 sc.tl.leiden(adata_full, key_added="leiden_" + latent_choice)
@@ -24,6 +24,8 @@ parser.add_argument('--outfile', default='./anndata_wneighbors.h5ad',
 parser.add_argument('--neighbor_dict', default=None,
                     help="helps find the correct dimension reduction for sc.pp.neighbors(), default='X_pca'")
 parser.add_argument('--n_threads', default=1,help='number of threads available')
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to, e.g. the one of the integration workflow")
 
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
@@ -75,7 +77,9 @@ for mod in neighbor_dict.keys():
                         n_pcs=int(neighbor_dict[mod]['n_dim_red']),
                         metric=neighbor_dict[mod]['metric'],
                         nthreads=args.n_threads,
-                        use_rep=neighbor_dict[mod]['dim_red'])
+                        use_rep=neighbor_dict[mod]['dim_red'],
+                        knn_store=args.knn_store,
+                        modality=mod)
 
 
             run_neighbors_method_choice(adata,**opts)
@@ -4,6 +4,8 @@ import argparse
 import pandas as pd
 import os
 from anndata import AnnData
+from panpipes.funcs.io import read_anndata
+from panpipes.funcs.scmethods import run_clustering_sweep
 
 import sys
 import logging
@@ -28,55 +30,81 @@ parser.add_argument("--algorithm",
                     default="leiden", help="algortihm choice from louvain and leiden")
 parser.add_argument("--neighbors_key", 
                     default="neighbors", help="algortihm choice from louvain and leiden")
+parser.add_argument("--resolutions",
+                    default=None,
+                    help="comma separated resolutions, if set all of them are run on one graph (sweep mode) and --outfile is ignored")
+parser.add_argument("--output_dir",
+                    default=None,
+                    help="sweep mode: directory in which the alg<algorithm>_res<resolution>/clusters.txt.gz files are written")
+parser.add_argument("--n_threads",
+                    default=1,
+                    help="sweep mode: number of resolutions to cluster in parallel")
 
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
 # read data
+# only obs and the neighbors graph are needed, X stays on disk
 L.info("Reading in data from '%s'" % args.infile)
-mdata = mu.read(args.infile)
-if type(mdata) is AnnData:
-    adata = mdata
-elif args.modality is not None:
-    adata = mdata[args.modality]
-else:
-    adata = mdata
+modality = args.modality if args.modality is not None else "all"
+# an h5ad input is read as a single AnnData, whatever the modality
+use_muon = os.path.splitext(args.infile)[1] != ".h5ad"
+adata = read_anndata(args.infile, use_muon=use_muon, modality=modality,
+                     lazy=True, obs=True, uns=[args.neighbors_key])
 
 uns_key=args.neighbors_key
 # check sc.pp.neihgbours has been run
 if uns_key not in adata.uns.keys():
     # sys.exit("Error: sc.pp.neighbours has not been run on this object")
     L.warning("Running neighbors for modality %s with default parameters since no neighbors graph found in this data object" % args.modality)
+    adata = read_anndata(args.infile, use_muon=use_muon, modality=modality)
     sc.pp.neighbors(adata)
     uns_key="neighbors"
 
 
-# run command
-if args.algorithm == "louvain":
-    L.info("Running Louvain clustering for modality %s and resolution %s on %s", (args.modality, args.resolution, uns_key))
-    sc.tl.louvain(adata, resolution=float(args.resolution), key_added='clusters', neighbors_key=uns_key)
-elif args.algorithm == "leiden":
-    L.info("Running Leiden clustering for modality %s and resolution %s on %s", (args.modality, args.resolution, uns_key))
-    sc.tl.leiden(adata, resolution=float(args.resolution), key_added='clusters', neighbors_key=uns_key)
-else:
-    L.error("Could not find clustering algorithm '%s'. Please specify 'louvain' or 'leiden'" % args.algorithm)
-    sys.exit("Could not find clustering algorithm '%s'. Please specify 'louvain' or 'leiden'"  % args.algorithm)
+def write_clusters(clusters, outfile):
+    ## write out clusters as text file
+    L.info("Saving cluster column to csv file '%s'" % outfile)
+    clusters = pd.DataFrame(clusters)
+    clusters.to_csv(outfile, sep='\t')
 
-#mdata.update()
-## write out clusters as text file
-L.info("Saving cluster column to csv file '%s'" % args.outfile)
-clusters = pd.DataFrame(adata.obs['clusters'])
-clusters.to_csv(args.outfile, sep='\t')
+    L.info("Saving cell numbers per cluster to csv file")
 
-L.info("Saving cell numbers per cluster to csv file")
+    tmp = clusters['clusters'].value_counts().to_frame("cell_num").reset_index().rename(columns={"index":"cluster"})
+    tmp.to_csv(os.path.dirname(outfile) + "/cellnum_per_cluster.csv")
 
-tmp = clusters['clusters'].value_counts().to_frame("cell_num").reset_index().rename(columns={"index":"cluster"})
-tmp.to_csv(os.path.dirname(args.outfile) + "/cellnum_per_cluster.csv")
+    if "sample_id" in adata.obs.columns:
+        ccounts = pd.DataFrame(adata.obs[['sample_id']]).assign(clusters=clusters['clusters'])
+        tmp = ccounts.value_counts().to_frame("cell_num").reset_index()
+        tmp.to_csv(os.path.dirname(outfile) + "/cellnum_per_sample_id_per_cluster.csv")
 
-if "sample_id" in adata.obs.columns:
-    ccounts = pd.DataFrame(adata.obs[['sample_id', 'clusters']])
-    tmp = ccounts.value_counts().to_frame("cell_num").reset_index()
-    tmp.to_csv(os.path.dirname(args.outfile) + "/cellnum_per_sample_id_per_cluster.csv")
 
-L.info("Done")
+if args.algorithm not in ["louvain", "leiden"]:
+    L.error("Could not find clustering algorithm '%s'. Please specify 'louvain' or 'leiden'" % args.algorithm)
+    sys.exit("Could not find clustering algorithm '%s'. Please specify 'louvain' or 'leiden'"  % args.algorithm)
+
+if args.resolutions is not None:
+    # sweep mode: one graph, many resolutions
+    resolutions = [x.strip() for x in args.resolutions.split(",")]
+    L.info("Running %s clustering for modality %s and resolutions %s on %s" % (args.algorithm, args.modality, resolutions, uns_key))
+    all_clusters = run_clustering_sweep(adata, resolutions=resolutions,
+                                        algorithm=args.algorithm,
+                                        neighbors_key=uns_key,
+                                        n_jobs=int(args.n_threads))
+    for res, clusters in all_clusters.items():
+        outfile = os.path.join(args.output_dir, 'alg' + args.algorithm + '_res' + res, "clusters.txt.gz")
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        write_clusters(pd.Series(clusters, index=adata.obs_names, name="clusters"), outfile)
+else:
+    # run command
+    if args.algorithm == "louvain":
+        L.info("Running Louvain clustering for modality %s and resolution %s on %s", (args.modality, args.resolution, uns_key))
+        sc.tl.louvain(adata, resolution=float(args.resolution), key_added='clusters', neighbors_key=uns_key)
+    elif args.algorithm == "leiden":
+        L.info("Running Leiden clustering for modality %s and resolution %s on %s", (args.modality, args.resolution, uns_key))
+        sc.tl.leiden(adata, resolution=float(args.resolution), key_added='clusters', neighbors_key=uns_key)
+
+    #mdata.update()
+    write_clusters(adata.obs['clusters'], args.outfile)
 
+L.info("Done")
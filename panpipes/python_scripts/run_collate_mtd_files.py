@@ -7,6 +7,7 @@ import re
 import sys
 import logging
 import yaml
+from panpipes.funcs.io import read_anndata
 
 L = logging.getLogger()
 L.setLevel(logging.INFO)
@@ -30,7 +31,9 @@ args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
 L.info("Reading in data from '%s'" % args.input_mudata)
-cell_meta_df = mu.read(args.input_mudata).obs
+# an h5ad input is read as a single AnnData
+use_muon = os.path.splitext(args.input_mudata)[1] != ".h5ad"
+cell_meta_df = read_anndata(args.input_mudata, use_muon=use_muon, modality="all", lazy=True, obs=True).obs
 mtd_columns = cell_meta_df.columns.to_list()
 
 # get all the batch columns 
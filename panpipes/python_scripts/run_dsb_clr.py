@@ -42,7 +42,10 @@ parser.add_argument("--save_mtx",
                     help="")  
 parser.add_argument("--save_mudata_path",
                     default=None,
-                    help="")   
+                    help="")
+parser.add_argument("--n_jobs",
+                    default=1,
+                    help="number of processes to normalise the channels in parallel")   
               
 
 args, opt = parser.parse_known_args()
@@ -87,59 +90,31 @@ all_mdata["prot"].layers["raw_counts"] = all_mdata["prot"].X.copy()
 
 
 if args.channel_col is not None:
-    ## running per channel (parallelise in future)
-    channel_cols = list(pnp.processing.mu_get_obs( all_mdata, 
-        features=[args.channel_col],
-        modalities=["prot"]).iloc[:,0].unique())
-    mdata_per_sample = {si: all_mdata[all_mdata.obs[args.channel_col] == si] for si in channel_cols}
-    # this data is only necessary if running dsb
+    # running per channel, the channels are normalised in parallel over n_jobs processes
+    plot_features = list(all_mdata["prot"].var_names)
+    plot_features.sort()
+    plot_features = [x for x in plot_features if isotypes is None or x not in isotypes]
+
+    def plot_channel(si, method, prot):
+        pnp.plotting.ridgeplot(prot, features=plot_features, layer=method,  splitplot=6)
+        plt.savefig(os.path.join(args.figpath, str(si) + "_" + method + "_ridgeplot.png"))
+        if isotypes is not None:
+            pnp.plotting.ridgeplot(prot, features=isotypes, layer=method,  splitplot=1)
+            plt.savefig(os.path.join(args.figpath, str(si) + "_" + method + "_ridgeplot_isotypes.png"))
+        plt.close("all")
+        if save_mtx:
+            pnp.io.write_10x_counts(prot, os.path.join("prot_" + method, str(si)), layer="raw_counts")
+
+    pnp.scmethods.run_prot_normalise_per_channel(all_mdata,
+                                                 all_mdata_raw if 'dsb' in norm_methods else None,
+                                                 channel_col=args.channel_col,
+                                                 norm_methods=norm_methods,
+                                                 clr_margin=int(args.clr_margin),
+                                                 isotypes=isotypes,
+                                                 n_jobs=int(args.n_jobs),
+                                                 channel_callback=plot_channel)
     if 'dsb' in norm_methods:
-        mdata_raw_per_sample = {si: all_mdata_raw[all_mdata_raw.obs[args.channel_col] == si] for si in channel_cols}
-    for si in channel_cols:
-        # si = list(mdata_per_sample.keys())[0]
-        L.info(si)
-        mdata=mdata_per_sample[si]
-        plot_features = list(mdata["prot"].var_names)
-        plot_features.sort()
-        plot_features = [x for x in plot_features if x not in isotypes]
-        # first run clr
-        if 'clr' in norm_methods:
-            # make sure to start from raw counts
-            mdata["prot"].X = mdata["prot"].layers["raw_counts"]
-            pnp.scmethods.run_prot_normalise(mdata=mdata, mdata_raw=None,
-                    method="clr",
-                    clr_margin=int(args.clr_margin))
-            L.info("saving ridgeplot")
-            pnp.plotting.ridgeplot(mdata["prot"], features=plot_features, layer="clr",  splitplot=6)
-            plt.savefig(os.path.join(args.figpath, si + "_clr_ridgeplot.png"))
-            if isotypes is not None:
-                pnp.plotting.ridgeplot(mdata["prot"], features=isotypes, layer="clr",  splitplot=1)
-                plt.savefig(os.path.join(args.figpath, si + "_clr_ridgeplot_isotypes.png"))
-            # save out the data in what format?
-            if save_mtx:
-                pnp.io.write_10x_counts(mdata["prot"], os.path.join("prot_clr" , si ), layer="raw_counts")
-        # then run dsb
-        if 'dsb' in norm_methods:
-            mdata_raw = mdata_raw_per_sample[si]
-            mdata = mdata_per_sample[si]
-            # make sure to start from raw counts
-            mdata["prot"].X = mdata["prot"].layers["raw_counts"]
-            # plot hiustogram of bg
-            mdata_raw["rna"].obs["log10umi"] = np.array(np.log10(mdata_raw["rna"].X.sum(axis=1) + 1)).reshape(-1)
-            # mu.pl.histogram(mdata_raw["rna"], ["log10umi"], bins=50)
-            # plt.savefig(os.path.join(args.figpath, si + "_log10umi.png"))
-            # run dsb
-            pnp.scmethods.run_prot_normalise(mdata=mdata, 
-                                            mdata_raw=mdata_raw,
-                                            method="dsb", 
-                                            isotypes=isotypes)
-            pnp.plotting.ridgeplot(mdata["prot"], features=plot_features, layer="dsb",  splitplot=6)
-            plt.savefig(os.path.join(args.figpath, si + "_dsb_ridgeplot.png"))
-            if isotypes is not None:
-                pnp.plotting.ridgeplot(mdata["prot"], features=isotypes, layer="dsb",  splitplot=1)
-                plt.savefig(os.path.join(args.figpath, si + "_dsb_ridgeplot_isotypes.png"))
-            if save_mtx:
-                pnp.io.write_10x_counts(mdata["prot"], os.path.join("prot_dsb" , si), layer="raw_counts")
+        all_mdata['prot'].X = all_mdata['prot'].layers['dsb'].copy()
 else:
     # run on all the data (not on a channel basis)
     # first run clr
@@ -152,7 +127,7 @@ else:
         all_mdata["prot"].X = all_mdata["prot"].layers["raw_counts"]
         # run normalise
         pnp.scmethods.run_prot_normalise(mdata=all_mdata, 
-                mdata_raw=None,
+                mdata_bg=None,
                 method="clr",
                 clr_margin=int(args.clr_margin))
         pnp.plotting.ridgeplot(all_mdata["prot"], features=plot_features, layer="clr",  splitplot=6)
@@ -172,7 +147,7 @@ else:
         mu.pl.histogram(all_mdata_raw["rna"], ["log10umi"], bins=50)
         plt.savefig(os.path.join(args.figpath, "all_log10umi.png"))
         pnp.scmethods.run_prot_normalise(mdata=all_mdata, 
-                mdata_raw=all_mdata_raw, 
+                mdata_bg=all_mdata_raw, 
                 method="dsb",
                 isotypes=isotypes) 
         # apply quantile clipping # discussed in FAQs https://cran.r-project.org/web/packages/dsb/vignettes/dsb_normalizing_CITEseq_data.html
@@ -189,12 +164,13 @@ else:
         if save_mtx:
             pnp.io.write_10x_counts(all_mdata["prot"], os.path.join("prot_dsb"), layer="dsb")
 
-    # run pca on dsb normalised (if dsb was run otherwise clr is in X)
-    sc.tl.pca(all_mdata['prot'], n_comps=50, svd_solver='arpack', random_state=0) 
 
-    if args.save_mudata_path is not None:
-        all_mdata.update()
-        pnp.io.write_anndata(all_mdata, args.save_mudata_path, use_muon=True, modality='all')
+# run pca on dsb normalised (if dsb was run otherwise clr is in X)
+sc.tl.pca(all_mdata['prot'], n_comps=50, svd_solver='arpack', random_state=0) 
+
+if args.save_mudata_path is not None:
+    all_mdata.update()
+    pnp.io.write_anndata(all_mdata, args.save_mudata_path, use_muon=True, modality='all')
 
 
 
@@ -13,7 +13,7 @@ import yaml
 import os
 
 # import scpipelines.funcs as scp
-from panpipes.funcs.processing import intersect_obs_by_mod, remove_unused_categories
+from panpipes.funcs.processing import filter_mudata, remove_unused_categories
 from panpipes.funcs.io import write_obs, read_yaml, dictionary_stripper
 import collections.abc
 import sys
@@ -109,60 +109,16 @@ if args.keep_barcodes is not None:
 
 # L.debug(mdata.obs['sample_id'].value_counts())
 
-# filter more than
-if filter_dict['run']:
-    # this will go through the modalities one at a time,
-    # then the categories max, min and bool
-    for mod in mdata.mod.keys():
-        L.info("Filtering modality '%s'" % mod)
-        if mod in filter_dict.keys():
-            for marg in filter_dict[mod].keys():
-                if marg == "obs":
-                    if "max" in filter_dict[mod][marg].keys():
-                        for col, n in filter_dict[mod][marg]['max'].items():
-                            L.info("Filtering cells of modality '%s' by '%s' in obs to less than %s" % (mod, col, n))
-                            mu.pp.filter_obs(mdata.mod[mod], col, lambda x: x <= n)
-                            L.info("Remaining cells %d" % mdata[mod].n_obs)
-                    if "min" in filter_dict[mod][marg].keys():
-                        for col, n in filter_dict[mod][marg]['min'].items():
-                            L.info("Filtering cells of modality '%s' by '%s' in obs to more than %s" % (mod, col, n))
-                            mu.pp.filter_obs(mdata.mod[mod], col, lambda x: x >= n)
-                            L.info("Remaining cells %d" % mdata[mod].n_obs)
-                    if "bool" in filter_dict[mod][marg].keys():
-                        for col, n in filter_dict[mod][marg]['bool'].items():
-                            L.info("Filtering cells of modality '%s' by '%s' in obs marked %s" % (mod, col, n))
-                            mu.pp.filter_obs(mdata.mod[mod], col, lambda x: x == n)
-                            L.info("Remaining cells %d" % mdata[mod].n_obs)
-                if marg == "var":
-                    if "max" in filter_dict[mod][marg].keys():
-                        for col, n in filter_dict[mod][marg]['max'].items():
-                            L.info("Filtering features of modality '%s' by '%s' in .var to less than %s" % (mod, col, n))
-                            mu.pp.filter_var(mdata.mod[mod], col, lambda x: x <= n)
-                            L.info("Remaining features: %d" % mdata[mod].n_vars)
-
-                    if "min" in filter_dict[mod][marg].keys():
-                        for col, n in filter_dict[mod][marg]['min'].items():
-                            L.info("Filtering features of modality '%s' by '%s' in .var to more than %s" % (mod, col, n))
-                            mu.pp.filter_var(mdata.mod[mod], col, lambda x: x >= n)
-                            L.info("Remaining features: %d" % mdata[mod].n_vars)
-
-                    if "bool" in filter_dict[mod][marg].keys():
-                        for col, n in filter_dict[mod][marg]['bool'].items():
-                            L.info("Filtering features of modality '%s' by '%s' in .var marked %s" % (mod, col, n))
-                            mu.pp.filter_var(mdata.mod[mod], col, lambda x: x == n)
-                            L.info("Remaining features: %d" % mdata[mod].n_vars)
-                            
-
-mdata.update()
-
-# intersect specific modalities
-# we don't want to just use mu.pp.intersect_obs, 
-# because we don't want to necessarily filter by repertoire
+# the rules of each modality and the intersection are compiled into one mask per modality and axis,
+# each modality is subset once
 if args.intersect_mods is not None:
     intersect_mods = args.intersect_mods.split(',')
     intersect_mods= [a.strip() for a in intersect_mods]
     L.info("Intersecting barcodes of modalities %s" % args.intersect_mods)
-    intersect_obs_by_mod(mdata, mods = intersect_mods)
+else:
+    intersect_mods = None
+
+filter_mudata(mdata, filter_dict if filter_dict['run'] else {}, intersect_mods=intersect_mods)
 
 L.info("After filtering: "+ str(mdata.n_obs) + " cells and " + str(mdata.n_vars) + " features across all modalities")
 
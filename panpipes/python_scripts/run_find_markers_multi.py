@@ -45,6 +45,8 @@ parser.add_argument("--threshuse",  type=str, default='0.25',
                     help="testing limited to genes with this (log scale) difference in mean expression level.")
 parser.add_argument("--mincells", type=str, default='3',
                     help="minimum number of cells required (applies to cluster and to the other cells)")
+parser.add_argument("--n_threads", type=int, default=1,
+                    help="number of clusters to test in parallel when running pseudo seurat")
 
 
 args, opt = parser.parse_known_args()
@@ -104,7 +106,8 @@ def run_clustering(adata,
                    cluster_groups='all', 
                    layer=None, 
                    methoduse=None, 
-                   pseudo_seurat=False):
+                   pseudo_seurat=False,
+                   n_threads=1):
     if type(cluster_groups) is list:
         # make sure the clusters are strings else rank_gene_groups crashes
         cluster_groups = [str(x) for x in cluster_groups]
@@ -120,7 +123,8 @@ def run_clustering(adata,
                                         layer=layer,
                                         arg_minpct=0.1,
                                         arg_mindiffpct=-float("inf"), 
-                                        arg_logfcdiff=0.25)
+                                        arg_logfcdiff=0.25,
+                                        n_jobs=n_threads)
         markers = markers.reset_index().drop(columns='level_1').rename(columns={'level_0':'gene'})
     else:
         # find markers
@@ -144,7 +148,8 @@ def main(adata,
          layer=None,
          testuse=None,
          pseudo_seurat=False,
-         output_file_prefix="markers") :
+         output_file_prefix="markers",
+         n_threads=1) :
     # check the X slot actually contains data
     if adata.X.shape[1] == 0:
         L.error(".X does not contain any values")
@@ -169,7 +174,8 @@ def main(adata,
                                                    cluster_col="clusters",
                                         layer=layer, 
                                         methoduse=testuse, 
-                                        pseudo_seurat=pseudo_seurat)
+                                        pseudo_seurat=pseudo_seurat,
+                                        n_threads=n_threads)
     # make sure all files have consitent headers
     all_markers.columns = get_header()
     all_markers['mod'] = mod
@@ -222,7 +228,8 @@ main(adata,
     layer=args.layer,
     testuse=args.testuse,
     pseudo_seurat=args.pseudo_seurat,
-    output_file_prefix=args.output_file_prefix)
+    output_file_prefix=args.output_file_prefix,
+    n_threads=args.n_threads)
 
 
 L.info("Done")
@@ -34,6 +34,8 @@ parser.add_argument('--neighbors_k',
                     help="neighbors k")
 parser.add_argument('--neighbors_metric',
                     help="neighbor metric, e.g. euclidean or cosine")
+parser.add_argument('--knn_store', default=None,
+                    help="folder of saved kNN graphs to reuse and add to")
 args, opt = parser.parse_known_args()
 
 
@@ -54,7 +56,10 @@ opts = dict(method=args.neighbors_method,
             n_neighbors=int(args.neighbors_k),
             n_pcs=int(args.neighbors_n_pcs),
             metric=args.neighbors_metric,
-            nthreads=args.n_threads)
+            nthreads=args.n_threads,
+            knn_store=args.knn_store,
+            modality=args.modality,
+            bc_method=args.integration_method)
 
 dim_red_location = {
     "None": "X_pca",
@@ -1,10 +1,14 @@
 import argparse
+import glob
+import re
 import numpy as np
 import pandas as pd
-import harmonypy as hm
 import seaborn as sns
 import os
-from panpipes.funcs.io import read_yaml
+from panpipes.funcs.io import read_yaml, read_anndata
+from panpipes.funcs.processing import combine_batch_labels
+from panpipes.funcs.scmethods import compute_lisi, lisi_knn
+from panpipes.funcs.knn import embedding_fingerprint, load_knn, save_knn, load_ann_index, self_knn, ann_index_path
 import matplotlib.pyplot as plt
 
 import sys
@@ -21,6 +25,16 @@ parser.add_argument("--combined_umaps_df")
 parser.add_argument("--cell_meta_df")
 parser.add_argument("--integration_dict")
 parser.add_argument("--fig_dir")
+parser.add_argument("--n_threads", default=1, type=int,
+                    help="threads used to build the kNN graphs")
+parser.add_argument("--perplexity", default=30, type=int)
+parser.add_argument("--embeddings", default=None,
+                    help="comma separated obsm keys of the latent embeddings (e.g. X_harmony,X_scVI,X_pca) "
+                         "to compute LISI on, in addition to the UMAPs")
+parser.add_argument("--corrected_dir", default="tmp",
+                    help="folder with the batch corrected objects, *_scaled_adata*.h5ad/h5mu")
+parser.add_argument("--knn_store", default=None,
+                    help="folder of saved kNN graphs to reuse, graphs computed here are added to it")
 args = parser.parse_args()
 L.info("Running with params: %s", args)
 
@@ -55,33 +69,40 @@ for k in batch_dict.keys():
    #     v =[k + ":" +v1 if k!="multimodal" else v1 for v1 in v  ] #add the prepending modality
    #     batch_dict[k] = v
     if len(v) > 1:
-        mod_meta_df= cell_meta_df[v].dropna()
-        cell_meta_df[str(k)+ ":bc_batch"] = mod_meta_df.apply(lambda x: "|".join(str(x)), axis=1)
+        cell_meta_df[str(k)+ ":bc_batch"] = combine_batch_labels(cell_meta_df, v)
         batch_dict[k].append(k+ ":bc_batch")
     L.info("Batch keys %s" %(batch_dict[k]))
 
 
-for md in batch_dict.keys():
-    L.info("Running LISI on modality: %s" % md)
-    # get one df per method for this modality
-    splits = dict(list(umaps[umaps["mod"]==md].groupby("method")))
-    lisi_results = []
-    columns = batch_dict[md]
-    for k, xx in splits.items():
-        L.info("Computing LISI for correction %s" % k)
-        # compute LISI for each batch
-        umap_coords = xx.loc[:,["umap_1", "umap_2"]].to_numpy()
-        # check it"s in the correct order
-        batch_df = cell_meta_df.loc[xx.index,:]
-        res = hm.compute_lisi(umap_coords, batch_df, columns)
-        lisi_results.append(pd.DataFrame(res, index=batch_df.index, columns=columns))
-    # put LISI scores into a pandas df
-    lisi_df = pd.concat(lisi_results, keys=splits.keys()).reset_index().rename(columns={"level_0":"method", "level_1":"cellbarcode", "index":"cellbarcode"})
-    L.info("Saving LISI scores to csv file")
-    lisi_df.to_csv(os.path.join(args.fig_dir, md, "LISI_scores.csv"), index=False)
-    # # make a density  plot of LISI scores.
-    L.info("Plotting LISI density")
-    plot_df = lisi_df.melt(id_vars=['cellbarcode', 'method'], var_name="integration_variable", value_name="LISI score")
+
+def get_knn(X, md, method, rep, ann_index=None):
+    # kNN graph of the embedding, from the knn store if it has one with enough neighbors,
+    # or from the index saved by the batch correction if it was built on the same embedding
+    # with euclidean distances, those of LISI
+    k = 3 * args.perplexity
+    fingerprint = embedding_fingerprint(X)
+    res = load_knn(args.knn_store, fingerprint, k)
+    if res is not None:
+        return res
+    index = load_ann_index(ann_index, X) if ann_index is not None else None
+    if index is not None and index["metric"] == "euclidean":
+        L.info("Using the %s index in %s" % (index["backend"], ann_index))
+        nn_method = index["backend"]
+        res = self_knn(index, X, k, n_jobs=args.n_threads)
+    elif args.knn_store is not None:
+        nn_method = "exact" if X.shape[1] <= 10 else "ann"
+        res = lisi_knn(X, k, knn_method=nn_method, n_jobs=args.n_threads)
+    else:
+        return None
+    if args.knn_store is not None:
+        save_knn(args.knn_store, fingerprint, *res, nn_method=nn_method,
+                 modality=md, method=method, rep=rep, n_dims=X.shape[1])
+    return res
+
+
+def plot_lisi(lisi_df, columns, fname):
+    # make a density  plot of LISI scores.
+    plot_df = lisi_df.melt(id_vars=["cellbarcode", "method"], value_vars=columns, var_name="integration_variable", value_name="LISI score")
     plot_df["integration_variable"] = plot_df["integration_variable"].astype("category")
     plot_df = plot_df.rename(columns={"method": "Correction"})
     plot_df["Correction"] = plot_df["Correction"].astype('category')
@@ -101,9 +122,68 @@ for md in batch_dict.keys():
         sns.kdeplot(data=plot_df,
             x="LISI score", hue="Correction", ax=ax)
         ax.set_title("integrated by :" + columns[0])  
-    fig.savefig(os.path.join(args.fig_dir, md, "LISI_scores.png"))
+    fig.savefig(fname)
     plt.clf()
 
 
+for md in batch_dict.keys():
+    L.info("Running LISI on modality: %s" % md)
+    # get one df per method for this modality
+    splits = dict(list(umaps[umaps["mod"]==md].groupby("method")))
+    lisi_results = []
+    columns = batch_dict[md]
+    for k, xx in splits.items():
+        L.info("Computing LISI for correction %s" % k)
+        # compute LISI for each batch
+        umap_coords = xx.loc[:,["umap_1", "umap_2"]].to_numpy()
+        # check it"s in the correct order
+        batch_df = cell_meta_df.loc[xx.index,:]
+        res = compute_lisi(umap_coords, batch_df, columns, perplexity=args.perplexity,
+                           knn_method="exact", n_jobs=args.n_threads,
+                           knn_graph=get_knn(umap_coords, md, k, "X_umap"))
+        lisi_results.append(pd.DataFrame(res, index=batch_df.index, columns=columns))
+    # put LISI scores into a pandas df
+    lisi_df = pd.concat(lisi_results, keys=splits.keys()).reset_index().rename(columns={"level_0":"method", "level_1":"cellbarcode", "index":"cellbarcode"})
+    L.info("Saving LISI scores to csv file")
+    lisi_df.to_csv(os.path.join(args.fig_dir, md, "LISI_scores.csv"), index=False)
+    L.info("Plotting LISI density")
+    plot_lisi(lisi_df, columns, os.path.join(args.fig_dir, md, "LISI_scores.png"))
+
+
+if args.embeddings is not None:
+    # LISI on the latent embeddings stored in the batch corrected objects
+    embeddings = args.embeddings.split(",")
+    latent_results = {}
+    for fname in sorted(glob.glob(os.path.join(args.corrected_dir, "*_scaled_adata*.h5*"))):
+        fmatch = re.match(r"(.+)_scaled_adata(?:_(\w+))?\.(h5ad|h5mu)$", os.path.basename(fname))
+        if fmatch is None:
+            continue
+        method, md, ext = fmatch.groups()
+        method = "none" if method == "no_correction" else method
+        # the multimodal corrections store their embeddings in the global obsm of a MuData,
+        # scanorama only runs on rna
+        md = "multimodal" if ext == "h5mu" else (md or "rna")
+        if md not in batch_dict.keys():
+            continue
+        L.info("Reading in embeddings %s from '%s'" % (embeddings, fname))
+        adata = read_anndata(fname, use_muon=(ext == "h5mu"), lazy=True, obs=False, obsm=embeddings)
+        for emb in adata.obsm.keys():
+            L.info("Computing LISI for correction %s on %s" % (method, emb))
+            batch_df = cell_meta_df.loc[adata.obs_names, :]
+            X = np.asarray(adata.obsm[emb])
+            knn_graph = get_knn(X, md, method, emb, ann_index=ann_index_path(fname, emb, "euclidean"))
+            res = compute_lisi(X, batch_df, batch_dict[md], perplexity=args.perplexity,
+                               n_jobs=args.n_threads, knn_graph=knn_graph)
+            latent_results.setdefault(md, {})[(method, emb)] = pd.DataFrame(
+                res, index=batch_df.index, columns=batch_dict[md])
+    for md, results in latent_results.items():
+        columns = batch_dict[md]
+        lisi_df = pd.concat(results.values(), keys=results.keys()).reset_index()
+        lisi_df.columns = ["method", "embedding", "cellbarcode"] + columns
+        L.info("Saving LISI scores on the latent embeddings of %s to csv file" % md)
+        lisi_df.to_csv(os.path.join(args.fig_dir, md, "LISI_scores_latent.csv"), index=False)
+        plot_df = lisi_df.assign(method=lisi_df["method"] + ":" + lisi_df["embedding"]).drop(columns="embedding")
+        plot_lisi(plot_df, columns, os.path.join(args.fig_dir, md, "LISI_scores_latent.png"))
+
 
-L.info("Done")
\ No newline at end of file
+L.info("Done")
@@ -73,6 +73,15 @@ parser.add_argument("--n_comps",
 parser.add_argument("--solver",
                     default="arpack",
                     help="what pca solver to use")
+parser.add_argument("--lsi_n_oversamples",
+                    default=10,
+                    help="randomized LSI: number of oversampling vectors")
+parser.add_argument("--lsi_n_iter",
+                    default=4,
+                    help="randomized LSI: number of power iterations")
+parser.add_argument("--lsi_chunk_size",
+                    default=50000,
+                    help="randomized LSI: number of cells processed at a time")
 parser.add_argument("--dim_remove",
                     default=None,
                     help="which dimensionality red components to remove")
@@ -104,7 +113,8 @@ atac = mdata.mod['atac']
 
 # save raw counts
 L.info("Checking if raw data is available")
-if X_is_raw(atac):
+# X is checked again below, the result is cached in uns while X is unchanged
+if X_is_raw(atac, use_cache=True):
     L.info("Saving raw counts from .X to .layers['raw_counts']")
     atac.layers["raw_counts"] = atac.X.copy()
 elif "raw_counts" in atac.layers:
@@ -116,7 +126,10 @@ else:
 
 
 # NORMALIZE
-if X_is_raw(atac):
+is_raw = X_is_raw(atac, use_cache=True)
+# the cache is not saved with the object
+atac.uns.pop("X_is_raw", None)
+if is_raw:
     if args.binarize is True:
         L.info("Binarizing peak count matrix")
         ac.pp.binarize(atac)    
@@ -191,7 +204,11 @@ if filter_by_hvgs:
 
 if args.dimred == "LSI" and args.normalize == "TFIDF":
     L.info("Running LSI")
-    lsi(adata=atac, num_components=int(args.n_comps))
+    lsi(adata=atac, num_components=int(args.n_comps),
+        svd_solver="randomized" if args.solver == "randomized" else "arpack",
+        n_oversamples=int(args.lsi_n_oversamples),
+        n_iter=int(args.lsi_n_iter),
+        chunk_size=int(args.lsi_chunk_size))
 elif args.dimred == "LSI" and args.normalize == "log1p":
     L.info("Applying LSI on logged_counts is not recommended. Changing dimred to PCA")
     args.dimred = "PCA"
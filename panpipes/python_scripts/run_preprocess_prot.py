@@ -61,6 +61,9 @@ parser.add_argument("--n_pcs",
 parser.add_argument("--pca_solver",
                     default="arpack",
                     help="which PCA solver to use")
+parser.add_argument("--n_jobs",
+                    default=1,
+                    help="number of processes to normalise the channels in parallel, if channel_col is given")
 parser.add_argument("--color_by",
                     default="sample_id",
                     help="which columns to fetch from the protein .obs slot")
@@ -152,64 +155,42 @@ else:
 
 
 if args.channel_col is not None:
-    ## running per channel (parallelise in future)
-    channel_cols = list(pnp.processing.mu_get_obs( all_mdata, 
-        features=[args.channel_col],
-        modalities=["prot"]).iloc[:,0].unique())
-    #this line works only if the obs of the entire metadata is the same as the prot obs. which may not always be the case
-    if not args.channel_col in all_mdata.obs.columns:
-        print("adding channel col to mdata obs since it's only in the prot obs")
-        all_mdata.obs.loc[all_mdata["prot"].obs.index,args.channel_col] = all_mdata["prot"].obs[args.channel_col]
-    mdata_per_sample = {si: all_mdata[all_mdata.obs[args.channel_col] == si] for si in channel_cols}
-    # this data is only necessary if running dsb
+    # running per channel, the channels are normalised in parallel over n_jobs processes
+    plot_features = list(all_mdata["prot"].var_names)
+    plot_features.sort()
+    plot_features = [x for x in plot_features if isotypes is None or x not in isotypes]
+
+    def plot_channel(si, method, prot):
+        # called in the worker once a channel is normalised
+        L.info("saving %s ridgeplot for %s" % (method, si))
+        pnp.plotting.ridgeplot(prot, features=plot_features, layer=method,  splitplot=6)
+        plt.savefig(os.path.join(args.figpath, str(si) + "_" + method + "_ridgeplot.png"))
+        if isotypes is not None:
+            pnp.plotting.ridgeplot(prot, features=isotypes, layer=method,  splitplot=1)
+            plt.savefig(os.path.join(args.figpath, str(si) + "_" + method + "_ridgeplot_isotypes.png"))
+        plt.close("all")
+        if save_mtx:
+            pnp.io.write_10x_counts(prot, os.path.join("prot_" + method, str(si)), layer="raw_counts")
+
     if 'dsb' in norm_methods:
-        mdata_bg_per_sample = {si: all_mdata_bg[all_mdata_bg.obs[args.channel_col] == si] for si in channel_cols}
-    for si in channel_cols:
-        # si = list(mdata_per_sample.keys())[0]
-        L.info(si)
-        mdata=mdata_per_sample[si]
-        plot_features = list(mdata["prot"].var_names)
-        plot_features.sort()
-        plot_features = [x for x in plot_features if x not in isotypes]
-        # first run clr
-        if 'clr' in norm_methods:
-            # make sure to start from raw counts
-            mdata["prot"].X = mdata["prot"].layers["raw_counts"].copy()
-            pnp.scmethods.run_prot_normalise(mdata=mdata, mdata_bg=None,
-                    method="clr",
-                    clr_margin=int(args.clr_margin))
-            L.info("saving ridgeplot")
-            pnp.plotting.ridgeplot(mdata["prot"], features=plot_features, layer="clr",  splitplot=6)
-            plt.savefig(os.path.join(args.figpath, str(si) + "_clr_ridgeplot.png"))
-            if isotypes is not None:
-                pnp.plotting.ridgeplot(mdata["prot"], features=isotypes, layer="clr",  splitplot=1)
-                plt.savefig(os.path.join(args.figpath, str(si) + "_clr_ridgeplot_isotypes.png"))
-            # save out the data in what format?
-            if save_mtx:
-                pnp.io.write_10x_counts(mdata["prot"], os.path.join("prot_clr" , str(si) ), layer="raw_counts")
-        # then run dsb
-        if 'dsb' in norm_methods:
-            mdata_bg = mdata_bg_per_sample[si]
-            mdata = mdata_per_sample[si]
-            # make sure to start from raw counts
-            mdata["prot"].X = mdata["prot"].layers["raw_counts"].copy()
-            # plot hiustogram of bg
-            mdata_bg["rna"].obs["log10umi"] = np.array(np.log10(mdata_bg["rna"].X.sum(axis=1) + 1)).reshape(-1)
-            # mu.pl.histogram(mdata_bg["rna"], ["log10umi"], bins=50)
-            # plt.savefig(os.path.join(args.figpath, si + "_log10umi.png"))
-            # run dsb
-            # this stores a layer named after the method as well as overwriting X
-            pnp.scmethods.run_prot_normalise(mdata=mdata, 
-                                            mdata_bg=mdata_bg,
-                                            method="dsb", 
-                                            isotypes=isotypes)
-            pnp.plotting.ridgeplot(mdata["prot"], features=plot_features, layer="dsb",  splitplot=6)
-            plt.savefig(os.path.join(args.figpath, str(si) + "_dsb_ridgeplot.png"))
-            if isotypes is not None:
-                pnp.plotting.ridgeplot(mdata["prot"], features=isotypes, layer="dsb",  splitplot=1)
-                plt.savefig(os.path.join(args.figpath, str(si) + "_dsb_ridgeplot_isotypes.png"))
-            if save_mtx:
-                pnp.io.write_10x_counts(mdata["prot"], os.path.join("prot_dsb" , str(si)), layer="raw_counts")
+        if args.channel_col not in all_mdata_bg.obs.columns:
+            all_mdata_bg.obs[args.channel_col] = all_mdata_bg["prot"].obs[args.channel_col].reindex(all_mdata_bg.obs_names)
+    else:
+        all_mdata_bg = None
+    L.info("Normalizing data per %s with %s" % (args.channel_col, ",".join(norm_methods)))
+    pnp.scmethods.run_prot_normalise_per_channel(all_mdata, all_mdata_bg,
+                                                 channel_col=args.channel_col,
+                                                 norm_methods=norm_methods,
+                                                 clr_margin=int(args.clr_margin),
+                                                 isotypes=isotypes,
+                                                 n_jobs=int(args.n_jobs),
+                                                 channel_callback=plot_channel)
+    if 'dsb' in norm_methods and args.quantile_clipping:
+        L.info("Quantile clipping")
+        all_mdata['prot'].layers['dsb'] = pnp.scmethods.quantile_clipping(all_mdata['prot'], layer="dsb", inplace=False)
+    # as when running on all the data, X holds dsb if it was run
+    if 'dsb' in norm_methods:
+        all_mdata['prot'].X = all_mdata['prot'].layers['dsb'].copy()
 else:
     # run on all the data (not on a channel basis)
     # first run clr
@@ -265,44 +246,45 @@ else:
         # save out the data in what format?
         if save_mtx:
             pnp.io.write_10x_counts(all_mdata["prot"], os.path.join("prot_dsb"), layer="dsb")
+
+
+if args.store_as_x is not None:
+    all_mdata["prot"].X = all_mdata["prot"].layers[args.store_as_x]
+    
+# run pca on X 
+# this basically makes no sense if you have a small panel of antibodies.
+if args.run_pca:
+    L.info("Running PCA")
+
+    if all_mdata['prot'].var.shape[0] < int(args.n_pcs):
+        L.warning("You have less features (%s) than number of PCs (%t) you intend to calculate." % (all_mdata['prot'].var.shape[0], args.n_pcs))
+        n_pcs = all_mdata['prot'].var.shape[0] - 1
+        L.info("Setting number of PCS to %i" % int(n_pcs))
+    else:
+        n_pcs = int(args.n_pcs)
+    sc.tl.pca(all_mdata['prot'], n_comps=n_pcs, 
+                    svd_solver=args.pca_solver, 
+                    random_state=0) 
+
+    # do some plots!
+    L.info("Plotting PCA")
+    sc.pl.pca_variance_ratio(all_mdata['prot'], log=True, n_pcs=n_pcs, save=".png")
     
-    if args.store_as_x is not None:
-        all_mdata["prot"].X = all_mdata["prot"].layers[args.store_as_x]
-        
-    # run pca on X 
-    # this basically makes no sense if you have a small panel of antibodies.
-    if args.run_pca:
-        L.info("Running PCA")
-
-        if all_mdata['prot'].var.shape[0] < int(args.n_pcs):
-            L.warning("You have less features (%s) than number of PCs (%t) you intend to calculate." % (all_mdata['prot'].var.shape[0], args.n_pcs))
-            n_pcs = all_mdata['prot'].var.shape[0] - 1
-            L.info("Setting number of PCS to %i" % int(n_pcs))
-        else:
-            n_pcs = int(args.n_pcs)
-        sc.tl.pca(all_mdata['prot'], n_comps=n_pcs, 
-                        svd_solver=args.pca_solver, 
-                        random_state=0) 
-
-        # do some plots!
-        L.info("Plotting PCA")
-        sc.pl.pca_variance_ratio(all_mdata['prot'], log=True, n_pcs=n_pcs, save=".png")
-        
-        
-        col_variables = args.color_by.split(",")
-        
-        col_variables = [a.strip() for a in col_variables]
-        
-        col_use = [var for var in col_variables if var in all_mdata['prot'].obs.columns]
-
-        sc.pl.pca(all_mdata['prot'], color=col_use, save = "_vars.png")
-        sc.pl.pca_loadings(all_mdata['prot'], components="1,2,3,4,5,6", save = ".png")
-        sc.pl.pca_overview(all_mdata['prot'], save = ".png")
-
-    if args.save_mudata_path is not None:
-        all_mdata.update()
-        L.info("Saving updated MuData to '%s'" % args.save_mudata_path)
-        all_mdata.write(args.save_mudata_path)
+    
+    col_variables = args.color_by.split(",")
+    
+    col_variables = [a.strip() for a in col_variables]
+    
+    col_use = [var for var in col_variables if var in all_mdata['prot'].obs.columns]
+
+    sc.pl.pca(all_mdata['prot'], color=col_use, save = "_vars.png")
+    sc.pl.pca_loadings(all_mdata['prot'], components="1,2,3,4,5,6", save = ".png")
+    sc.pl.pca_overview(all_mdata['prot'], save = ".png")
+
+if args.save_mudata_path is not None:
+    all_mdata.update()
+    L.info("Saving updated MuData to '%s'" % args.save_mudata_path)
+    all_mdata.write(args.save_mudata_path)
 
 
 L.info("Done")
@@ -104,7 +104,8 @@ else:
 
 # save raw counts as a layer
 L.info("Checking if raw data is available")
-if X_is_raw(adata):
+# X is checked again below, the result is cached in uns while X is unchanged
+if X_is_raw(adata, use_cache=True):
     L.info("Saving raw counts from .X to .layers['raw_counts']")
     adata.layers['raw_counts'] = adata.X.copy()
 elif "raw_counts" in adata.layers :
@@ -118,7 +119,10 @@ else:
 # sc.pp.highly variable genes Expects logarithmized data, 
 # except when flavor='seurat_v3' in which count data is expected.
 # change the order accordingly
-if X_is_raw(adata):
+is_raw = X_is_raw(adata, use_cache=True)
+# the cache is not saved with the object
+adata.uns.pop("X_is_raw", None)
+if is_raw:
     L.info("Normalize, log and calculate HVGs")
     if args.flavor == "seurat_v3":
         if args.n_top_genes is None:
@@ -10,14 +10,27 @@ order of QC:
 import argparse
 import logging
 import os
+import shutil
 import sys
 import warnings
 
+import h5py
 import muon as mu
 import pandas as pd
 import scanpy as sc
+from anndata import AnnData
 
 from panpipes.funcs.io import write_obs
+from panpipes.funcs.scmethods import (
+    cell_cycle_phase,
+    qc_metrics_chunked,
+    score_genes_chunked,
+)
+
+try:
+    from anndata.io import read_elem, sparse_dataset, write_elem
+except ImportError:
+    from anndata.experimental import read_elem, sparse_dataset, write_elem
 
 L = logging.getLogger()
 L.setLevel(logging.INFO)
@@ -62,6 +75,12 @@ parser.add_argument(
     default=None,
     help="which list of genes to use to scanpy.tl.score_genes per cell?",
 )
+parser.add_argument(
+    "--chunk_size",
+    default=None,
+    help="if set, rna.X is not loaded but read from the input file in chunks of this many cells, "
+    "and only the QC columns of obs and var are written back",
+)
 
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
@@ -78,9 +97,23 @@ sc.set_figure_params(
 )
 
 
-L.info("Reading in MuData from '%s'" % args.input_anndata)
-mdata = mu.read(args.input_anndata)
-rna = mdata["rna"]
+if args.chunk_size is None:
+    L.info("Reading in MuData from '%s'" % args.input_anndata)
+    mdata = mu.read(args.input_anndata)
+    rna = mdata["rna"]
+    X = rna.X
+    chunk_size = None
+else:
+    # only obs and var are loaded, X stays on disk
+    chunk_size = int(args.chunk_size)
+    L.info(
+        "Reading in rna obs and var from '%s', X is read in chunks of %i cells"
+        % (args.input_anndata, chunk_size)
+    )
+    h5 = h5py.File(args.input_anndata, "r", locking=False)
+    rna = AnnData(obs=read_elem(h5["mod/rna/obs"]), var=read_elem(h5["mod/rna/var"]))
+    X = h5["mod/rna/X"]
+    X = sparse_dataset(X) if isinstance(X, h5py.Group) else X
 
 
 # load the scrublet scores into the anndata (if they have been run)
@@ -168,20 +201,38 @@ else:
 for kk in calc_proportions:
     xname = kk
     gene_list = cat_dic[kk]
-    rna.var[xname] = [
-        x in gene_list for x in rna.var_names
-    ]  # annotate the group of hb genes as 'hb'
+    rna.var[xname] = rna.var_names.isin(
+        gene_list
+    )  # annotate the group of hb genes as 'hb'
     qc_vars.append(xname)
 
 qc_info = ""
 if qc_vars != []:
     qc_info = " and calculating proportions for '%s'" % qc_vars
-L.info("Calculating QC metrics with scanpy.pp.calculate_qc_metrics()" + qc_info)
-sc.pp.calculate_qc_metrics(
-    rna, qc_vars=qc_vars, percent_top=None, log1p=True, inplace=True
-)
+if chunk_size is not None:
+    L.info("Calculating QC metrics in chunks" + qc_info)
+    obs_qc, var_qc = qc_metrics_chunked(
+        X,
+        rna.var_names,
+        qc_vars={kk: rna.var[kk].values for kk in qc_vars},
+        chunk_size=chunk_size,
+    )
+    for col in obs_qc.columns:
+        rna.obs[col] = obs_qc[col].values
+    for col in var_qc.columns:
+        rna.var[col] = var_qc[col].values
+    # all the gene scores are computed in one more pass over X
+    gene_sets = {}
+    if args.score_genes is not None:
+        for kk in score_genes:
+            gene_sets[kk + "_score"] = (cat_dic[kk], min(len(cat_dic[kk]), 50))
+else:
+    L.info("Calculating QC metrics with scanpy.pp.calculate_qc_metrics()" + qc_info)
+    sc.pp.calculate_qc_metrics(
+        rna, qc_vars=qc_vars, percent_top=None, log1p=True, inplace=True
+    )
 
-if args.score_genes is not None:
+if args.score_genes is not None and chunk_size is None:
     for kk in score_genes:
         L.info("Computing gene scores for '%s'" % kk)
         xname = kk
@@ -211,11 +262,42 @@ if args.ccgenes is not None:
         )
     sgenes = ccgenes[ccgenes["cc_phase"] == "s"]["gene_name"].tolist()
     g2mgenes = ccgenes[ccgenes["cc_phase"] == "g2m"]["gene_name"].tolist()
-    L.info("Calculating cell cycle scores")
-    sc.tl.score_genes_cell_cycle(rna, s_genes=sgenes, g2m_genes=g2mgenes)
-
-
-mdata.update()
+    if chunk_size is not None:
+        ctrl_size = min(len(sgenes), len(g2mgenes))
+        gene_sets["S_score"] = (sgenes, ctrl_size)
+        gene_sets["G2M_score"] = (g2mgenes, ctrl_size)
+    else:
+        L.info("Calculating cell cycle scores")
+        sc.tl.score_genes_cell_cycle(rna, s_genes=sgenes, g2m_genes=g2mgenes)
+
+if chunk_size is not None:
+    if len(gene_sets) > 0:
+        L.info("Computing gene scores for '%s'" % ", ".join(gene_sets.keys()))
+        scores = score_genes_chunked(
+            X,
+            rna.var_names,
+            gene_sets,
+            gene_means=rna.var["mean_counts"],
+            chunk_size=chunk_size,
+        )
+        scores.index = rna.obs_names
+        for col in scores.columns:
+            rna.obs[col] = scores[col].values
+        if args.ccgenes is not None:
+            rna.obs["phase"] = cell_cycle_phase(scores)
+    h5.close()
+    # the global obs holds the modality columns prefixed with the modality, as after mdata.update()
+    with h5py.File(args.input_anndata, "r", locking=False) as h5:
+        global_obs = read_elem(h5["obs"])
+    global_obs = global_obs.drop(
+        columns=[c for c in global_obs.columns if c.startswith("rna:")]
+    )
+    global_obs = pd.concat(
+        [global_obs, rna.obs.add_prefix("rna:").reindex(global_obs.index)], axis=1
+    )
+    mdata = AnnData(obs=global_obs)
+else:
+    mdata.update()
 
 L.info(
     "Saving updated obs in a metadata tsv file to ./"
@@ -224,6 +306,19 @@ L.info(
 )
 write_obs(mdata, output_prefix=args.sampleprefix, output_suffix="_cell_metadata.tsv")
 L.info("Saving updated MuData to '%s'" % args.outfile)
-mdata.write(args.outfile)
+if chunk_size is not None:
+    if os.path.abspath(args.outfile) != os.path.abspath(args.input_anndata):
+        shutil.copyfile(args.input_anndata, args.outfile)
+    # only obs and var are rewritten, X is left untouched
+    with h5py.File(args.outfile, "r+") as h5:
+        for key, df in [
+            ("obs", mdata.obs),
+            ("mod/rna/obs", rna.obs),
+            ("mod/rna/var", rna.var),
+        ]:
+            del h5[key]
+            write_elem(h5, key, df)
+else:
+    mdata.write(args.outfile)
 
 L.info("Done")
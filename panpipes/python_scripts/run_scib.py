@@ -8,6 +8,7 @@ from anndata import AnnData
 from scib_metrics.benchmark import Benchmarker, BioConservation, BatchCorrection
 from sklearn.preprocessing import MinMaxScaler
 from panpipes.funcs.io import read_yaml
+from panpipes.funcs.knn import embedding_fingerprint, load_knn, save_knn
 
 import sys
 import logging
@@ -30,6 +31,8 @@ parser.add_argument("--fig_dir")
 parser.add_argument("--rna_cell_type", default=None)
 parser.add_argument("--prot_cell_type", default=None)
 parser.add_argument("--atac_cell_type", default=None)
+parser.add_argument("--knn_store", default=None,
+                    help="folder of saved kNN graphs to reuse, graphs computed here are added to it")
 
 args = parser.parse_args()
 L.info(args)
@@ -40,6 +43,19 @@ batch_dict = {modality: batch_col[0] for modality, batch_col in batch_dict.items
 umaps = pd.read_csv(args.combined_umaps_df, sep="\t", index_col=0)
 cell_type_col = dict(rna=args.rna_cell_type, prot=args.prot_cell_type, atac=args.atac_cell_type)
 
+
+def stored_neighbors(X, k):
+    # scib-metrics neighbor computer reading the graphs of the knn store, e.g. those of run_lisi.py
+    from scib_metrics.nearest_neighbors import NeighborsResults, pynndescent
+    fingerprint = embedding_fingerprint(X)
+    res = load_knn(args.knn_store, fingerprint, k)
+    if res is None:
+        nn = pynndescent(X, n_neighbors=k, random_state=0, n_jobs=int(args.n_threads))
+        res = (nn.distances, nn.indices)
+        save_knn(args.knn_store, fingerprint, *res, nn_method="pynndescent", n_dims=X.shape[1])
+    return NeighborsResults(indices=res[1], distances=res[0])
+
+
 for modality in batch_dict.keys():
     L.info("Computing scib metrics for modality: %s" % modality)
     # get one UMAP DataFrame per integration method for this modality
@@ -87,6 +103,8 @@ for modality in batch_dict.keys():
         bio_conservation_metrics=bio_conservation_metrics,
         n_jobs=int(args.n_threads),
     )
+    if args.knn_store is not None:
+        bm.prepare(neighbor_computer=stored_neighbors)
     bm.benchmark()
 
     # Plotting is only possible if we have metrics for both batch correction and bio conservation
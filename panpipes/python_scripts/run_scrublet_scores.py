@@ -1,12 +1,15 @@
 '''
 run scrublet on single channel
-expects sample id and path to input data
+expects sample id and path to input data,
+or a samples_file (sample_id, inputpath) to score many channels in one job with a pool of n_jobs workers
 '''
 import scrublet as scr
 import pandas as pd
 import os
 import argparse
 import muon as mu
+from multiprocessing import Pool
+from threadpoolctl import threadpool_limits
 
 import sys
 import logging
@@ -59,32 +62,19 @@ parser.add_argument("--use_thr",
 parser.add_argument("--call_doublets_thr",
                     default=0.25,
                     help="if use_thr is True, this thr will be used to define doublets")
+parser.add_argument("--samples_file",
+                    default=None,
+                    help="tab separated file with columns sample_id and inputpath, to score all the samples in one job instead of --sample_id and --inputpath")
+parser.add_argument("--n_jobs",
+                    default=1,
+                    help="number of samples scored in parallel when using --samples_file")
+parser.add_argument("--n_threads",
+                    default=1,
+                    help="total number of threads, shared between the n_jobs workers for the PCA and the kNN")
 
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
-# loading data
-input = args.inputpath + "/rna"
-L.info("Reading in data from '%s'" % input)
-adata = mu.read(args.inputpath + "/rna")
-
-
-
-counts_matrix = adata.X
-L.info('Counts matrix shape: {} rows, {} columns'.format(counts_matrix.shape[0], counts_matrix.shape[1]))
-L.info('Number of genes in gene list: {}'.format(len(adata.var_names)))
-
-L.info("Initializing the scrublet object with expected_doublet_rate: %s" % args.expected_doublet_rate)
-
-scrub = scr.Scrublet(counts_matrix, expected_doublet_rate=float(args.expected_doublet_rate))
-L.info("Predicting doublets with params: \nmincells: %s \nmingenes: %s \nmin_gene_variabilty_pctl: %s\nn_prin_comps: %s\n" % (args.min_counts, args.min_cells, args.min_gene_variability_pctl, args.n_prin_comps))
-L.info("Predicting using:\n")
-
-doublet_scores, predicted_doublets = scrub.scrub_doublets(min_counts=int(args.min_counts),
-                                                          min_cells=int(args.min_cells),
-                                                          min_gene_variability_pctl=float(args.min_gene_variability_pctl),
-                                                          n_prin_comps=int(args.n_prin_comps))
-
 # cgat pipelines will probably parse a string
 if args.use_thr == "True":
     use_thr = True
@@ -92,36 +82,77 @@ else:
     use_thr = False
 
 
+def _limit_threads(n_threads):
+    # BLAS (PCA) and numba/openmp (kNN) threads of a worker
+    threadpool_limits(limits=n_threads)
 
-if use_thr:
-    L.info("Using provided or default threshold %s to call doublets, instead of predicted" % args.call_doublets_thr)
-    predicted_doublets = scrub.call_doublets(threshold=float(args.call_doublets_thr))
-else:
 
-    L.info("Attempting to use predicted threshold for doublet prediction")
-    try:
-        use_threshold=round(scrub.threshold_, 2)
-        L.info("Using predicted threshold %s" % use_threshold)
-    except AttributeError:
-        use_threshold=float(args.call_doublets_thr)
-        L.info("Scrublet couldn't predict a threshold falling back on provided or default threshold %s" % use_threshold)
+def score_sample(sample_id, inputpath):
+    # loading data
+    L.info("%s: reading in data from '%s'" % (sample_id, inputpath + "/rna"))
+    adata = mu.read(inputpath + "/rna")
 
-    predicted_doublets = scrub.call_doublets(threshold=float(use_threshold))
+    counts_matrix = adata.X
+    L.info('{}: counts matrix shape: {} rows, {} columns'.format(sample_id, counts_matrix.shape[0], counts_matrix.shape[1]))
+    L.info('{}: number of genes in gene list: {}'.format(sample_id, len(adata.var_names)))
 
-L.info("Saving plots to directory '%s'" % args.outdir)
-fig = scrub.plot_histogram()
-fig[0].savefig(args.outdir + '/' + args.sample_id + '_' + "doubletScore_histogram.png",
-               bbox_inches='tight', dpi=120)
+    L.info("%s: initializing the scrublet object with expected_doublet_rate: %s" % (sample_id, args.expected_doublet_rate))
 
-L.info("Saving cell names, doublet scores, and prediction to txt file in directory '%s'" % args.outdir)
+    scrub = scr.Scrublet(counts_matrix, expected_doublet_rate=float(args.expected_doublet_rate))
+    L.info("%s: predicting doublets with params: \nmincells: %s \nmingenes: %s \nmin_gene_variabilty_pctl: %s\nn_prin_comps: %s\n" % (sample_id, args.min_counts, args.min_cells, args.min_gene_variability_pctl, args.n_prin_comps))
 
-data = pd.DataFrame({'doublet_scores': doublet_scores,
-                     'predicted_doublets': predicted_doublets})
-data['barcode'] = adata.obs_names
-data.to_csv(os.path.join(args.outdir + "/" + args.sample_id + "_scrublet_scores.txt"),
-            sep="\t", index=False)
+    doublet_scores, predicted_doublets = scrub.scrub_doublets(min_counts=int(args.min_counts),
+                                                              min_cells=int(args.min_cells),
+                                                              min_gene_variability_pctl=float(args.min_gene_variability_pctl),
+                                                              n_prin_comps=int(args.n_prin_comps))
 
-L.info('Done')
+    if use_thr:
+        L.info("%s: using provided or default threshold %s to call doublets, instead of predicted" % (sample_id, args.call_doublets_thr))
+        predicted_doublets = scrub.call_doublets(threshold=float(args.call_doublets_thr))
+    else:
+        L.info("%s: attempting to use predicted threshold for doublet prediction" % sample_id)
+        try:
+            use_threshold=round(scrub.threshold_, 2)
+            L.info("%s: using predicted threshold %s" % (sample_id, use_threshold))
+        except AttributeError:
+            use_threshold=float(args.call_doublets_thr)
+            L.info("%s: scrublet couldn't predict a threshold falling back on provided or default threshold %s" % (sample_id, use_threshold))
+
+        predicted_doublets = scrub.call_doublets(threshold=float(use_threshold))
+
+    L.info("%s: saving plots to directory '%s'" % (sample_id, args.outdir))
+    fig = scrub.plot_histogram()
+    fig[0].savefig(args.outdir + '/' + sample_id + '_' + "doubletScore_histogram.png",
+                   bbox_inches='tight', dpi=120)
+    matplotlib.pyplot.close(fig[0])
+
+    L.info("%s: saving cell names, doublet scores, and prediction to txt file in directory '%s'" % (sample_id, args.outdir))
 
+    data = pd.DataFrame({'doublet_scores': doublet_scores,
+                         'predicted_doublets': predicted_doublets})
+    data['barcode'] = adata.obs_names
+    data.to_csv(os.path.join(args.outdir + "/" + sample_id + "_scrublet_scores.txt"),
+                sep="\t", index=False)
+    return sample_id
 
 
+if args.samples_file is not None:
+    samples = pd.read_csv(args.samples_file, sep="\t", dtype=str)
+    jobs = list(zip(samples["sample_id"], samples["inputpath"]))
+else:
+    jobs = [(args.sample_id, args.inputpath)]
+
+n_jobs = max(1, min(int(args.n_jobs), len(jobs)))
+threads_per_job = max(1, int(args.n_threads) // n_jobs)
+L.info("Scoring %i samples with %i workers of %i threads" % (len(jobs), n_jobs, threads_per_job))
+if n_jobs > 1:
+    # the workers are reused for all samples, the imports are only paid once per worker
+    with Pool(n_jobs, initializer=_limit_threads, initargs=(threads_per_job,)) as pool:
+        for sample_id in pool.starmap(score_sample, jobs, chunksize=1):
+            L.info("%s: done" % sample_id)
+else:
+    _limit_threads(threads_per_job)
+    for sample_id, inputpath in jobs:
+        score_sample(sample_id, inputpath)
+
+L.info('Done')
@@ -9,7 +9,10 @@ import pandas as pd
 import argparse
 import muon as mu
 from anndata import AnnData
+from panpipes.funcs.io import read_anndata
+from panpipes.funcs.scmethods import run_umap_sweep
 
+import os
 import sys
 import logging
 L = logging.getLogger()
@@ -34,20 +37,27 @@ parser.add_argument("--min_dist",
                     help="no. neighbours parameters for sc.pp.neighbors()")
 parser.add_argument("--neighbors_key", 
                     default="neighbors", help="name of the saved knn neighbors")
+parser.add_argument("--min_dists",
+                    default=None,
+                    help="comma separated min_dist values, if set all of them are run on one graph and initialisation (sweep mode) and --outfile is ignored")
+parser.add_argument("--output_dir",
+                    default=None,
+                    help="sweep mode: directory in which the md<min_dist>_umap.txt.gz files are written")
+parser.add_argument("--n_threads",
+                    default=1,
+                    help="sweep mode: number of min_dist values to run in parallel")
 
 args, opt = parser.parse_known_args()
 L.info("Running with params: %s", args)
 
 # read data
+# only the embeddings and the neighbors graph are needed, X stays on disk
 L.info("Reading in data from '%s'" % args.infile)
-mdata = mu.read(args.infile)
-if type(mdata) is AnnData:
-    adata = mdata
-elif args.modality is not None:
-    adata = mdata[args.modality]
-else:
-    adata = mdata
-    
+modality = args.modality if args.modality is not None else "all"
+# an h5ad input is read as a single AnnData, whatever the modality
+use_muon = os.path.splitext(args.infile)[1] != ".h5ad"
+adata = read_anndata(args.infile, use_muon=use_muon, modality=modality,
+                     lazy=True, obs=False, obsm=True, uns=[args.neighbors_key])
 
 # set seed
 # seed = int(200612)
@@ -57,32 +67,40 @@ uns_key=args.neighbors_key
 if uns_key not in adata.uns.keys():
     # sys.exit("Error: sc.pp.neighbours has not been run on this object")
     L.warning("Running neighbors for modality %s with default parameters since no neighbors graph found in this data object" % args.modality)
+    adata = read_anndata(args.infile, use_muon=use_muon, modality=modality)
     sc.pp.neighbors(adata)
     uns_key="neighbors"
 
-# code to run multiple umaps in one script, currently not used
-# manipulate min dist to list of floats
-# if type(args.min_dist) is str:
-#     min_dist = [float(md) for md in args.min_dist.split(',')]
-# elif type(args.min_dist) is float:
-#     min_dist = [args.min_dist]
+def write_umap(coords, outfile):
+    # extract umap coordinates for plotting (in R??)
+    umap_coords = pd.DataFrame(coords)
 
+    # add in the rownames 
+    umap_coords.index = adata.obs_names
 
-# what parameters?
-if args.modality is not None:
-    L.info("Running UMAP for modality %s on neighbors_key %s and mindist %s" % (args.modality,uns_key,args.min_dist))
-if uns_key =="wnn":
-    mu.tl.umap(adata, min_dist=float(args.min_dist), neighbors_key=uns_key)
-else:
-    sc.tl.umap(adata, min_dist=float(args.min_dist), neighbors_key=uns_key)
+    # save coordinates to file
+    # (note this saves values values up to 6 significant figures, because why save 20 for a plot
+    L.info("Saving UMAP coordinates to csv file '%s'" % outfile)
+    umap_coords.to_csv(outfile, sep = '\t')
 
-# extract umap coordinates for plotting (in R??)
-umap_coords = pd.DataFrame(adata.obsm['X_umap'])
 
-# add in the rownames 
-umap_coords.index = adata.obs_names
+if args.min_dists is not None:
+    # sweep mode: one graph and spectral initialisation, many min_dist values
+    min_dists = [x.strip() for x in args.min_dists.split(",")]
+    L.info("Running UMAP for modality %s on neighbors_key %s and mindists %s" % (args.modality, uns_key, min_dists))
+    all_coords = run_umap_sweep(adata, min_dists=min_dists,
+                                neighbors_key=uns_key,
+                                use_muon=uns_key == "wnn",
+                                n_jobs=int(args.n_threads))
+    for md, coords in all_coords.items():
+        write_umap(coords, os.path.join(args.output_dir, 'md' + md + "_umap.txt.gz"))
+else:
+    # what parameters?
+    if args.modality is not None:
+        L.info("Running UMAP for modality %s on neighbors_key %s and mindist %s" % (args.modality,uns_key,args.min_dist))
+    if uns_key =="wnn":
+        mu.tl.umap(adata, min_dist=float(args.min_dist), neighbors_key=uns_key)
+    else:
+        sc.tl.umap(adata, min_dist=float(args.min_dist), neighbors_key=uns_key)
 
-# save coordinates to file
-# (note this saves values values up to 6 significant figures, because why save 20 for a plot
-L.info("Saving UMAP coordinates to csv file '%s'" % args.outfile)
-umap_coords.to_csv(args.outfile, sep = '\t')
+    write_umap(adata.obsm['X_umap'], args.outfile)
@@ -0,0 +1,176 @@
+'''
+Resource telemetry of panpipes tasks
+====================================
+
+Every task statement launched with run_task is executed through::
+
+    python -m panpipes.telemetry record --db telemetry.db --workflow W --task T -- "<statement>"
+
+which runs the statement with bash, then stores its wall time, CPU time, peak RSS,
+block I/O and the size of the h5mu/h5ad files in the statement in an SQLite table,
+with the id of the pipeline run (RUN_ID) the task belongs to.
+The records of the latest run, or of the run given, or of all runs with "all",
+are summarised with::
+
+    panpipes <workflow> report-resources [run_id]
+'''
+
+import argparse
+import os
+import re
+import resource
+import shlex
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+TELEMETRY_DB = "telemetry.db"
+
+# one id per pipeline process, i.e. per run of a workflow
+RUN_ID = "%s_%s_%i" % (time.strftime("%Y%m%d-%H%M%S"), socket.gethostname(), os.getpid())
+
+_COLUMNS = ["workflow", "task", "hostname", "job_threads", "start_time", "wall_s", "cpu_s",
+            "max_rss_mb", "read_mb", "write_mb", "input_mb", "exit_code", "statement", "run_id"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS task_resources (
+    workflow TEXT, task TEXT, hostname TEXT, job_threads INTEGER,
+    start_time REAL, wall_s REAL, cpu_s REAL, max_rss_mb REAL,
+    read_mb REAL, write_mb REAL, input_mb REAL, exit_code INTEGER, statement TEXT,
+    run_id TEXT
+)
+"""
+
+
+def _input_size_mb(statement):
+    files = set(re.findall(r"[^\s'\"=]+\.h5(?:mu|ad)\b", statement))
+    return sum(os.path.getsize(f) for f in files if os.path.isfile(f)) / 1024**2
+
+
+def record(statement, db, workflow, task, job_threads=None, run_id=None):
+    """
+    run statement with bash and store its resource usage in db, returns the exit code
+    """
+    start = time.time()
+    exit_code = subprocess.call(["bash", "-c", statement])
+    wall = time.time() - start
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    row = (workflow, task, socket.gethostname(), job_threads,
+           start, wall, ru.ru_utime + ru.ru_stime,
+           # ru_maxrss is in KB on linux, the largest process of the task
+           ru.ru_maxrss / 1024,
+           # block I/O, counted in 512 byte blocks
+           ru.ru_inblock * 512 / 1024**2, ru.ru_oublock * 512 / 1024**2,
+           _input_size_mb(statement), exit_code, statement, run_id)
+    try:
+        with sqlite3.connect(db, timeout=60) as con:
+            con.execute(_SCHEMA)
+            # tables of older versions have no run_id
+            if "run_id" not in [c[1] for c in con.execute("PRAGMA table_info(task_resources)")]:
+                con.execute("ALTER TABLE task_resources ADD COLUMN run_id TEXT")
+            con.execute("INSERT INTO task_resources (%s) VALUES (%s)"
+                        % (",".join(_COLUMNS), ",".join("?" * len(row))), row)
+    except sqlite3.Error as e:
+        # telemetry must never fail a task
+        print("could not record telemetry in %s: %s" % (db, e), file=sys.stderr)
+    return exit_code
+
+
+def run_task(statement, caller_frame=None, **kwargs):
+    """
+    P.run with resource telemetry, recorded in telemetry.db of the working directory.
+
+    The statement is interpolated like P.run does, using PARAMS, the locals of the calling
+    task (caller_frame, by default the frame calling run_task) and kwargs, and wrapped in
+    "python -m panpipes.telemetry record". Telemetry is skipped if the pipeline.yml sets
+    telemetry: False or if the statement is not a single string.
+    """
+    from cgatcore import pipeline as P
+
+    frame = caller_frame if caller_frame is not None else sys._getframe(1)
+    task_name = frame.f_code.co_name
+    caller_locals = {k: v for k, v in frame.f_locals.items() if k not in ["self", "statement"]}
+    # P.run interpolates with the locals of its caller, which is now this function
+    run_kwargs = {**caller_locals, **kwargs}
+    params = P.get_params()
+    if params.get("telemetry", True) is False or not isinstance(statement, str):
+        return P.run(statement, **run_kwargs)
+    statement = " ".join(re.sub("\t+", " ", statement % {**params, **run_kwargs}).split("\n")).strip()
+    wrapped = "python -m panpipes.telemetry record --db %s --workflow %s --task %s --run_id %s" % (
+        shlex.quote(os.path.abspath(TELEMETRY_DB)),
+        frame.f_globals.get("__name__", "pipeline").replace("pipeline_", ""),
+        task_name, RUN_ID)
+    if "job_threads" in kwargs:
+        wrapped += " --job_threads %i" % int(kwargs["job_threads"])
+    wrapped += " -- " + shlex.quote(statement)
+    # the statement is already interpolated, protect it from the second interpolation in P.run
+    return P.run(wrapped.replace("%", "%%"), **run_kwargs)
+
+
+def report(db=TELEMETRY_DB, workflow=None, run_id="latest"):
+    """
+    summary of the recorded resources per task: number of runs, median and max wall time,
+    CPU efficiency (CPU time / wall time / threads), peak RSS, I/O and input size.
+    run_id selects the records of one pipeline run, "latest" the run of workflow that
+    started last, "all" (or None) keeps the records of all runs
+    """
+    import pandas as pd
+
+    if not os.path.exists(db):
+        raise FileNotFoundError("no telemetry found in %s" % db)
+    with sqlite3.connect(db) as con:
+        df = pd.read_sql_query("SELECT * FROM task_resources", con)
+    if "run_id" not in df.columns:
+        df["run_id"] = None
+    if workflow is not None:
+        df = df[df["workflow"] == workflow]
+    if run_id == "latest" and len(df) > 0:
+        run_id = df["run_id"].loc[df["start_time"].idxmax()]
+        # records of older versions have no run id, they are reported together
+        df = df[df["run_id"].isna()] if pd.isna(run_id) else df[df["run_id"] == run_id]
+    elif run_id not in [None, "all", "latest"]:
+        df = df[df["run_id"] == run_id]
+    df["cpu_efficiency"] = df["cpu_s"] / df["wall_s"] / df["job_threads"].fillna(1).clip(lower=1)
+    summary = df.groupby(["workflow", "task"]).agg(
+        runs=("wall_s", "size"),
+        failed=("exit_code", lambda x: (x != 0).sum()),
+        job_threads=("job_threads", "max"),
+        wall_s_median=("wall_s", "median"),
+        wall_s_max=("wall_s", "max"),
+        cpu_efficiency=("cpu_efficiency", "median"),
+        max_rss_gb=("max_rss_mb", lambda x: x.max() / 1024),
+        read_gb=("read_mb", lambda x: x.max() / 1024),
+        write_gb=("write_mb", lambda x: x.max() / 1024),
+        input_gb=("input_mb", lambda x: x.max() / 1024),
+    )
+    return summary.sort_values("wall_s_max", ascending=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m panpipes.telemetry")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rec = subparsers.add_parser("record", help="run a task statement and record its resources")
+    rec.add_argument("--db", default=TELEMETRY_DB)
+    rec.add_argument("--workflow", default=None)
+    rec.add_argument("--task", default=None)
+    rec.add_argument("--job_threads", default=None, type=int)
+    rec.add_argument("--run_id", default=None)
+    rec.add_argument("statement")
+    rep = subparsers.add_parser("report", help="summarise the recorded resources")
+    rep.add_argument("--db", default=TELEMETRY_DB)
+    rep.add_argument("--workflow", default=None)
+    rep.add_argument("--run_id", default="latest",
+                     help="id of the pipeline run, latest (default) or all")
+    args = parser.parse_args(argv)
+    if args.command == "record":
+        return record(args.statement, args.db, args.workflow, args.task, args.job_threads, args.run_id)
+    import pandas as pd
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(report(args.db, args.workflow, args.run_id).round(2).to_string())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import os
+import pytest
+from panpipes.funcs.cache import cache_key, restore_from_cache, store_in_cache
+
+
+@pytest.fixture()
+def task_files(tmp_path):
+    infile = tmp_path / "in.h5mu"
+    infile.write_text("input")
+    outfiles = [str(tmp_path / "out.csv"), str(tmp_path / "tmp" / "out.h5ad")]
+    yield str(infile), outfiles, str(tmp_path / "cache")
+
+
+def test_cache_key(task_files):
+    infile, _, cache_dir = task_files
+    key = cache_key("run.py --in %s" % infile, [infile], cache_dir, params={'theta': 2})
+    # whitespace in the command does not matter, parameters and inputs do
+    assert key == cache_key("run.py  --in %s\n" % infile, [infile], cache_dir, params={'theta': 2})
+    assert key != cache_key("run.py --in %s" % infile, [infile], cache_dir, params={'theta': 1})
+    with open(infile, "w") as f:
+        f.write("changed input")
+    assert key != cache_key("run.py --in %s" % infile, [infile], cache_dir, params={'theta': 2})
+    # and so does the content of the script
+    script = os.path.join(os.path.dirname(infile), "run.py")
+    with open(script, "w") as f:
+        f.write("print(1)")
+    key = cache_key("python %s --in %s" % (script, infile), [infile], cache_dir)
+    with open(script, "w") as f:
+        f.write("print(2)")
+    assert key != cache_key("python %s --in %s" % (script, infile), [infile], cache_dir)
+
+
+def test_store_and_restore(task_files):
+    infile, outfiles, cache_dir = task_files
+    key = cache_key("run.py", [infile], cache_dir)
+    assert not restore_from_cache(key, outfiles, cache_dir)
+    # missing outputs are not cached
+    with open(outfiles[0], "w") as f:
+        f.write("umap")
+    assert not store_in_cache(key, outfiles, cache_dir)
+    os.makedirs(os.path.dirname(outfiles[1]))
+    with open(outfiles[1], "w") as f:
+        f.write("adata")
+    assert store_in_cache(key, outfiles, cache_dir)
+    for out in outfiles:
+        os.remove(out)
+    assert restore_from_cache(key, outfiles, cache_dir)
+    with open(outfiles[1]) as f:
+        assert f.read() == "adata"
+    # the restored outputs are copies, rewriting them in place leaves the cache unchanged
+    with open(outfiles[1], "r+") as f:
+        f.write("ADATA")
+    assert restore_from_cache(key, outfiles, cache_dir)
+    with open(outfiles[1]) as f:
+        assert f.read() == "adata"
+
+
+def test_evict_cache(task_files):
+    infile, outfiles, cache_dir = task_files
+    os.makedirs(os.path.dirname(outfiles[1]))
+    for ii in range(3):
+        for out in outfiles:
+            with open(out, "w") as f:
+                f.write("x" * 100)
+        store_in_cache("key%i" % ii, outfiles, cache_dir, max_size_gb=450 / 1024**3)
+        os.utime(os.path.join(cache_dir, "entries", "key%i" % ii, "manifest.json"), (ii, ii))
+    # two entries of 200 bytes fit in 450 bytes, the least recently used one is evicted
+    assert sorted(os.listdir(os.path.join(cache_dir, "entries"))) == ["key1", "key2"]
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from panpipes.funcs.harmony import harmony_state_path, load_harmony_state, run_harmony, same_basis, save_harmony_state
+
+
+@pytest.fixture()
+def batches():
+    rng = np.random.default_rng(0)
+    n, d = 1500, 10
+    centers = rng.normal(size=(5, d)) * 3
+    batch = rng.integers(0, 3, n)
+    Z = centers[rng.integers(0, 5, n)] + rng.normal(size=(n, d)) \
+        + np.array([0, 4, -4])[batch][:, None] * rng.normal(size=d)[None, :]
+    meta = pd.DataFrame({"batch": pd.Categorical(batch.astype(str))}, index=["cell%i" % i for i in range(n)])
+    yield Z, meta
+
+
+def test_run_harmony(batches):
+    hm = pytest.importorskip("harmonypy")
+    Z, meta = batches
+    ho = hm.run_harmony(Z, meta, ["batch"], sigma=0.1, theta=1.0, max_iter_harmony=10,
+                        max_iter_kmeans=20, epsilon_cluster=1e-5, epsilon_harmony=1e-4, verbose=False)
+    expected = np.asarray(ho.Z_corr)
+    expected = expected if expected.shape[0] == Z.shape[0] else expected.T
+    Z_corr, state = run_harmony(Z, meta, ["batch"])
+    assert Z_corr.shape == Z.shape and state["R"].shape == (Z.shape[0], state["Y"].shape[0])
+    assert np.allclose(state["R"].sum(axis=1), 1, atol=1e-4)
+    assert np.corrcoef(expected.ravel(), Z_corr.ravel())[0, 1] > 0.9999
+    # mini-batches converge to a similar correction
+    Z_mb, _ = run_harmony(Z, meta, ["batch"], batch_size=200)
+    assert np.corrcoef(Z_mb.ravel(), Z_corr.ravel())[0, 1] > 0.99
+
+
+def test_harmony_warm_start(batches, tmp_path):
+    Z, meta = batches
+    Z_corr, state = run_harmony(Z, meta, ["batch"])
+    fname = harmony_state_path(str(tmp_path / "harmony_scaled_adata_rna.h5ad"))
+    assert fname.endswith("harmony_scaled_adata_rna.harmony_state.npz")
+    save_harmony_state(fname, state["Y"], state["R"], meta.index, Z=Z)
+    saved = load_harmony_state(fname)
+    assert list(saved["obs_names"]) == list(meta.index)
+    # the state is only used on the same basis, here with the cells in another order
+    order = np.random.default_rng(1).permutation(len(Z))
+    assert same_basis(saved, Z[order], meta.index[order])
+    assert not same_basis(saved, Z * np.r_[-1, np.ones(Z.shape[1] - 1)], meta.index)
+    assert load_harmony_state(str(tmp_path / "missing.npz")) is None
+    # the saved state is a fixed point, a warm start stops after a few iterations
+    Z_warm, warm = run_harmony(Z, meta, ["batch"], init_state=saved)
+    assert len(warm["objective"]) < len(state["objective"])
+    assert np.corrcoef(Z_warm.ravel(), Z_corr.ravel())[0, 1] > 0.99
+    # cells missing from the state are assigned to the saved centroids
+    Z_new, new = run_harmony(Z, meta.rename(index=lambda x: x + "_new" if x.endswith("7") else x),
+                             ["batch"], init_state=saved)
+    assert np.isfinite(Z_new).all() and np.allclose(new["R"].sum(axis=1), 1, atol=1e-4)
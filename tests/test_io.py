@@ -0,0 +1,100 @@
+import pytest
+import panpipes.funcs as pnp
+from anndata import AnnData
+from muon import MuData
+from scipy import sparse
+import pandas as pd
+import numpy as np
+
+
+@pytest.fixture()
+def mdata_file(tmp_path):
+    nn = 6
+    rna = AnnData(sparse.random(nn, 10, density=0.5, format="csr"),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(nn)],
+                         data={'sample_id': ['a', 'a', 'b', 'b', 'c', 'c']}),
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(10)]))
+    rna.obsm['X_pca'] = np.random.random((nn, 3))
+    rna.obsp['connectivities'] = sparse.random(nn, nn, density=0.5, format="csr")
+    rna.obsp['distances'] = sparse.random(nn, nn, density=0.5, format="csr")
+    rna.uns['neighbors'] = {'connectivities_key': 'connectivities',
+                            'distances_key': 'distances',
+                            'params': {'n_neighbors': 3, 'method': 'umap'}}
+    prot = AnnData(np.arange(0, 24, 1).reshape(-1, 4).astype(float),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(nn)]),
+        var=pd.DataFrame(index=[f"prot{i}" for i in range(4)]))
+    fname = str(tmp_path / "test.h5mu")
+    MuData({"rna": rna, "prot": prot}).write(fname)
+    yield fname
+
+
+def test_read_anndata_lazy_modality(mdata_file):
+    adata = pnp.io.read_anndata(mdata_file, use_muon=True, modality="rna",
+                                lazy=True, obs=['sample_id'], uns=['neighbors'])
+    assert adata.X is None
+    assert adata.shape == (6, 10)
+    assert adata.obs.columns.tolist() == ['sample_id']
+    assert list(adata.obsm.keys()) == []
+    # the neighbors entry brings its graphs along
+    assert sorted(adata.obsp.keys()) == ['connectivities', 'distances']
+    full = pnp.io.read_anndata(mdata_file, use_muon=True, modality="rna")
+    assert np.array_equal(adata.obsp['connectivities'].toarray(), full.obsp['connectivities'].toarray())
+
+
+def test_read_anndata_lazy_all(mdata_file):
+    mdata = pnp.io.read_anndata(mdata_file, use_muon=True, modality="all",
+                                lazy=True, obs=True, obsm=True)
+    assert isinstance(mdata, MuData)
+    assert sorted(mdata.mod.keys()) == ['prot', 'rna']
+    assert mdata['rna'].X is None
+    assert 'X_pca' in mdata['rna'].obsm.keys()
+    assert 'rna:sample_id' in mdata.obs.columns
+
+
+def test_read_anndata_lazy_all_order(mdata_file):
+    import h5py
+    from anndata.io import write_elem
+    # global slots stored in another cell order than the modalities
+    order = [5, 3, 1, 0, 2, 4]
+    with h5py.File(mdata_file, "r+") as f:
+        for slot, elem in [("obs", pd.DataFrame(index=[f"cell{i}" for i in order])),
+                           ("obsm", {"X_umap": np.array(order, dtype=float)[:, None].repeat(2, axis=1)})]:
+            del f[slot]
+            write_elem(f, slot, elem)
+    mdata = pnp.io.read_anndata(mdata_file, use_muon=True, modality="all",
+                                lazy=True, obs=True, obsm=True)
+    expected = [float(c.replace("cell", "")) for c in mdata.obs_names]
+    assert np.array_equal(mdata.obsm["X_umap"][:, 0], expected)
+
+
+def test_read_anndata_lazy_h5ad(mdata_file, tmp_path):
+    # an h5ad is read as a single AnnData whatever the modality, as the scripts do for .h5ad inputs
+    fname = str(tmp_path / "test.h5ad")
+    pnp.io.read_anndata(mdata_file, use_muon=True, modality="rna").write_h5ad(fname)
+    adata = pnp.io.read_anndata(fname, use_muon=False, modality="all",
+                                lazy=True, obs=True, obsm=True, uns=['neighbors'])
+    assert isinstance(adata, AnnData) and adata.X is None
+    assert adata.obs.columns.tolist() == ['sample_id']
+    assert list(adata.obsm.keys()) == ['X_pca']
+    assert sorted(adata.obsp.keys()) == ['connectivities', 'distances']
+
+
+@pytest.mark.parametrize("fmt", ["csr", "csc", "dense"])
+def test_write_10x_counts(tmp_path, fmt):
+    counts = sparse.random(30, 8, density=0.3, format="csr", random_state=0)
+    counts.data = np.ceil(counts.data * 10)
+    X = counts.toarray() if fmt == "dense" else counts.asformat(fmt)
+    adata = AnnData(X,
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(30)]),
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(8)],
+                         data={'gene_ids': [f"ENSG{i}" for i in range(8)],
+                               'feature_types': 'Gene Expression'}))
+    outdir = str(tmp_path / "counts")
+    pnp.io.write_10x_counts(adata, outdir)
+    pnp.io.write_mtx_gz(X, str(tmp_path / "threaded.mtx.gz"), n_threads=2, chunk_size=7)
+    from scipy.io import mmread
+    for fname in [outdir + "/matrix.mtx.gz", str(tmp_path / "threaded.mtx.gz")]:
+        mtx = mmread(fname)
+        assert mtx.shape == (8, 30)
+        assert np.issubdtype(mtx.dtype, np.integer)
+        assert np.array_equal(mtx.toarray(), counts.toarray().T)
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from panpipes.funcs.knn import (build_ann_index, embedding_fingerprint, get_ann_index, graph_to_knn,
+                                load_ann_index, load_knn, save_ann_index, save_knn, self_knn)
+from panpipes.funcs.scmethods import run_neighbors_method_choice
+
+
+@pytest.fixture()
+def adata():
+    rng = np.random.default_rng(0)
+    adata = AnnData(rng.normal(size=(200, 20)).astype(np.float32),
+                    obs=pd.DataFrame(index=[f"cell{i}" for i in range(200)]))
+    adata.obsm["X_pca"] = rng.normal(size=(200, 10))
+    yield adata
+
+
+def test_save_load_knn(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(50, 5))
+    fp = embedding_fingerprint(X)
+    assert fp == embedding_fingerprint(X.copy())
+    assert fp != embedding_fingerprint(X[:, :4])
+    distances = np.sort(rng.random((50, 10)), axis=1)
+    indices = rng.integers(0, 50, (50, 10))
+    store = str(tmp_path / "knn")
+    assert load_knn(store, fp, 5) is None
+    save_knn(store, fp, distances, indices, nn_method="exact", modality="rna", method="none", rep="X_pca")
+    # a smaller k is taken from the first columns, a larger k is not available
+    d, i = load_knn(store, fp, 5)
+    assert np.array_equal(d, distances[:, :5]) and np.array_equal(i, indices[:, :5])
+    assert load_knn(store, fp, 11) is None
+    assert load_knn(store, fp, 5, metric="cosine") is None
+    assert load_knn(store, fp, 5, nn_method="hnsw") is None
+
+
+def test_run_neighbors_knn_store(adata, tmp_path):
+    store = str(tmp_path / "knn")
+    opts = dict(method="scanpy", n_pcs=10, metric="euclidean", use_rep="X_pca")
+    run_neighbors_method_choice(adata, n_neighbors=15, knn_store=store, modality="rna", **opts)
+    expected = adata.copy()
+    res = graph_to_knn(adata.obsp["distances"])
+    assert res[0].shape == (200, 15) and (res[1][:, 0] == np.arange(200)).all()
+    # the graph is rebuilt from the store
+    del adata.obsp["distances"], adata.obsp["connectivities"], adata.uns["neighbors"]
+    run_neighbors_method_choice(adata, n_neighbors=15, knn_store=store, **opts)
+    assert adata.uns["neighbors"]["params"]["n_neighbors"] == 15
+    assert np.allclose(adata.obsp["distances"].toarray(), expected.obsp["distances"].toarray())
+    assert np.allclose(adata.obsp["connectivities"].toarray(), expected.obsp["connectivities"].toarray())
+    # a smaller k is derived from the stored graph
+    small = adata.copy()
+    run_neighbors_method_choice(small, n_neighbors=10, knn_store=store, **opts)
+    sc_small = adata.copy()
+    run_neighbors_method_choice(sc_small, n_neighbors=10, **opts)
+    assert np.allclose(small.obsp["connectivities"].toarray(), sc_small.obsp["connectivities"].toarray())
+
+
+def test_exact_index(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(300, 8))
+    index = build_ann_index(X, backend="exact")
+    distances, indices = self_knn(index, X, 10)
+    full = np.sqrt(((X[:, None, :] - X[None, :, :]) ** 2).sum(-1))
+    expected = np.argsort(full, axis=1)[:, :10]
+    assert (indices[:, 0] == np.arange(300)).all() and (distances[:, 0] == 0).all()
+    assert np.array_equal(indices, expected)
+    assert np.allclose(distances, np.take_along_axis(full, expected, axis=1), atol=1e-5)
+    # the index is saved and only reused on the same embedding
+    folder = str(tmp_path / "X_pca_euclidean.ann")
+    save_ann_index(index, folder)
+    assert load_ann_index(folder, X[:, :7]) is None
+    loaded = get_ann_index(X, folder, backend="exact")
+    assert loaded["fingerprint"] == index["fingerprint"]
+    assert np.array_equal(self_knn(loaded, X, 10)[1], indices)
+
+
+def test_run_neighbors_exact(adata):
+    opts = dict(n_neighbors=15, n_pcs=10, metric="euclidean", use_rep="X_pca")
+    expected = adata.copy()
+    run_neighbors_method_choice(expected, method="scanpy", **opts)
+    run_neighbors_method_choice(adata, method="exact", **opts)
+    assert np.allclose(adata.obsp["distances"].toarray(), expected.obsp["distances"].toarray(), atol=1e-5)
+    with pytest.raises(ValueError):
+        run_neighbors_method_choice(adata, method="unknown", **opts)
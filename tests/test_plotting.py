@@ -0,0 +1,32 @@
+import panpipes.funcs as pnp
+from anndata import AnnData
+import pandas as pd
+import numpy as np
+
+
+def test_kde_densities():
+    rng = np.random.default_rng(0)
+    X = np.column_stack([rng.normal(0, 1, 500), rng.normal(3, 0.5, 500), np.ones(500)])
+    adata = AnnData(X, obs=pd.DataFrame(index=[f"cell{i}" for i in range(500)]),
+                    var=pd.DataFrame(index=['prot0', 'prot1', 'prot2']))
+    kde = pnp.plotting.kde_densities(adata, bandwidth=0.2)
+    for i in range(2):
+        xx = kde["x"][i]
+        assert np.isclose(xx[0], X[:, i].min()) and np.isclose(xx[-1], X[:, i].max())
+        # exact gaussian kde
+        exact = np.exp(-0.5 * ((xx[:, None] - X[None, :, i]) / 0.2) ** 2).mean(axis=1) / (0.2 * np.sqrt(2 * np.pi))
+        assert np.allclose(kde["density"][i], exact, atol=1e-2 * exact.max())
+    # the constant feature peaks at its value
+    assert np.isclose(kde["x"][2][np.argmax(kde["density"][2])], 1, atol=0.01)
+    # cached per layer and bandwidth, recomputed when the layer changes
+    assert list(adata.uns["kde"].keys()) == ["X_0.2"]
+    assert pnp.plotting.kde_densities(adata, bandwidth=0.2) is adata.uns["kde"]["X_0.2"]
+    adata.X = adata.X * 2
+    assert pnp.plotting.kde_densities(adata, bandwidth=0.2) is not kde
+    # centred values with the same sum, and renamed features, are not taken from the cache
+    adata.X = adata.X - adata.X.mean(axis=1, keepdims=True)
+    centred = pnp.plotting.kde_densities(adata, bandwidth=0.2)
+    adata.X = adata.X * 3
+    assert pnp.plotting.kde_densities(adata, bandwidth=0.2) is not centred
+    adata.var_names = ['CD3', 'CD4', 'CD8']
+    assert list(pnp.plotting.kde_densities(adata, bandwidth=0.2)["features"]) == ['CD3', 'CD4', 'CD8']
@@ -120,6 +120,42 @@ def test_concat_adatas(anndata):
         pnp.pp.concat_adatas(ad1, batch_key="sample_id", 
         batch_categories=['a'])
 
+@pytest.mark.parametrize("join_type", ["inner", "outer"])
+def test_concat_mdatas_on_disk(tmp_path, join_type):
+    from scipy import sparse
+    import muon as mu
+    files = []
+    mdatas = []
+    for ii, sid in enumerate(['a', 'b', 'c']):
+        nvar = 10 - ii
+        rna = AnnData(sparse.random(5, nvar, density=0.5, format="csr", random_state=ii),
+            obs=pd.DataFrame(index=[f"cell{i}" for i in range(5)], data={'sample_id': sid}),
+            var=pd.DataFrame(index=[f"gene{i}" for i in range(nvar)]))
+        prot = AnnData(np.arange(0, 20, 1).reshape(-1, 4).astype(float) + ii,
+            obs=pd.DataFrame(index=[f"cell{i}" for i in range(5)], data={'sample_id': sid}),
+            var=pd.DataFrame(index=[f"prot{i}" for i in range(4)]))
+        fname = str(tmp_path / f"{sid}.h5mu")
+        MuData({"rna": rna, "prot": prot}).write(fname)
+        files.append(fname)
+        mdatas.append(mu.read(fname))
+    expected = pnp.pp.concat_mdatas(mdatas, batch_key="sample_id", join_type=join_type)
+    out_file = str(tmp_path / "concat.h5mu")
+    def add_tissue(mdata):
+        mdata['rna'].obs['tissue'] = mdata['rna'].obs['sample_id'].map({'a': 't1', 'b': 't2', 'c': 't3'})
+    pnp.pp.concat_mdatas_on_disk(files, out_file, batch_key="sample_id", join_type=join_type,
+                                 update_metadata=add_tissue)
+    mdata = mu.read(out_file)
+    assert mdata['rna'].obs['tissue'].astype(str).tolist() == ['t1'] * 5 + ['t2'] * 5 + ['t3'] * 5
+    assert mdata.obs['sample_id'].tolist() == expected.obs.loc[mdata.obs_names, 'sample_id'].tolist()
+    for mod in ["rna", "prot"]:
+        assert mdata[mod].obs_names.tolist() == expected[mod].obs_names.tolist()
+        assert mdata[mod].var_names.tolist() == expected[mod].var_names.tolist()
+        assert mdata[mod].obs['sample_id'].tolist() == expected[mod].obs['sample_id'].tolist()
+        X = mdata[mod].X.toarray() if sparse.issparse(mdata[mod].X) else mdata[mod].X
+        X_exp = expected[mod].X.toarray() if sparse.issparse(expected[mod].X) else expected[mod].X
+        assert np.allclose(X, X_exp)
+
+
 def test_merge_with_adata_obs(anndata, anndata_with_obs):
     new_obs = pd.DataFrame(data={'sample_id': ['a', 'b', 'c'],
                              'batch': [1, 2, 3]})
@@ -188,3 +224,38 @@ def test_update_var_index(anndata):
     assert all(anndata.var.index == new_index)
 
 
+
+
+def test_filter_mudata():
+    rna = AnnData(np.ones((6, 4)),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(6)],
+                         data={'n_genes': [10, 200, 300, 400, 500, np.nan],
+                               'pct_mt': [1, 2, 30, 4, 5, 6],
+                               'keep': [True, True, True, True, False, True]}),
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(4)],
+                         data={'n_cells': [0, 5, 6, 7]}))
+    prot = AnnData(np.ones((5, 2)),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(1, 6)]),
+        var=pd.DataFrame(index=['p1', 'p2']))
+    mdata = MuData({'rna': rna, 'prot': prot})
+    filter_dict = {'run': True,
+                   'rna': {'obs': {'min': {'n_genes': 100}, 'max': {'pct_mt': 20}, 'bool': {'keep': True}},
+                           'var': {'min': {'n_cells': 5}}}}
+    obs_mask, var_mask = pnp.pp.filter_masks(mdata['rna'], filter_dict['rna'])
+    assert obs_mask.tolist() == [False, True, False, True, False, False]
+    assert var_mask.tolist() == [False, True, True, True]
+    pnp.pp.filter_mudata(mdata, filter_dict, intersect_mods=['rna', 'prot'])
+    assert mdata['rna'].obs_names.tolist() == ['cell1', 'cell3']
+    assert mdata['rna'].var_names.tolist() == ['gene1', 'gene2', 'gene3']
+    assert mdata['prot'].obs_names.tolist() == ['cell1', 'cell3']
+    assert mdata.n_obs == 2
+
+
+def test_combine_batch_labels():
+    df = pd.DataFrame({'sample': ['s1', 's2', 's1', np.nan, 's2'],
+                       'tissue': ['a', 'a', 'b', 'b', 'a']})
+    labels = pnp.pp.combine_batch_labels(df, ['sample', 'tissue'])
+    assert labels.categories.tolist() == ['s1|a', 's1|b', 's2|a']
+    assert labels.astype(object).tolist()[:3] == ['s1|a', 's2|a', 's1|b']
+    assert pd.isna(labels[3])
+    assert labels[4] == 's2|a'
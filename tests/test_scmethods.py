@@ -0,0 +1,285 @@
+import pytest
+import panpipes.funcs as pnp
+import scanpy as sc
+from anndata import AnnData
+from scipy import sparse
+import pandas as pd
+import numpy as np
+
+
+@pytest.fixture()
+def adata_knn():
+    rng = np.random.default_rng(0)
+    adata = AnnData(np.vstack([rng.normal(loc, 1, (50, 10)) for loc in [0, 5, 10]]).astype(np.float32),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(150)]),
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(10)]))
+    sc.pp.neighbors(adata, n_neighbors=10, use_rep="X")
+    yield adata
+
+
+def test_run_clustering_sweep(adata_knn):
+    out = pnp.scmethods.run_clustering_sweep(adata_knn, resolutions=["0.2", "1"], algorithm="leiden")
+    assert list(out.keys()) == ["0.2", "1"]
+    for res, clusters in out.items():
+        sc.tl.leiden(adata_knn, resolution=float(res), key_added="clusters")
+        assert list(clusters) == adata_knn.obs["clusters"].tolist()
+    with pytest.raises(ValueError):
+        pnp.scmethods.run_clustering_sweep(adata_knn, resolutions=["1"], algorithm="cheese")
+
+
+def test_run_umap_sweep(adata_knn):
+    out = pnp.scmethods.run_umap_sweep(adata_knn, min_dists=["0.1", "0.5"])
+    assert list(out.keys()) == ["0.1", "0.5"]
+    for coords in out.values():
+        assert coords.shape == (adata_knn.n_obs, 2)
+    assert not np.allclose(out["0.1"], out["0.5"])
+
+
+@pytest.fixture()
+def adata_clusters():
+    rng = np.random.default_rng(0)
+    X = sparse.random(60, 20, density=0.3, format="csr", random_state=0)
+    X.data = np.log1p(rng.poisson(5, X.nnz).astype(np.float64))
+    adata = AnnData(X,
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(60)],
+                         data={'clusters': pd.Categorical(np.repeat(['0', '1', '2'], 20))}),
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(20)]))
+    yield adata
+
+
+def test_pseudo_seurat_stats(adata_clusters):
+    adata_clusters.obs['idents'] = np.where(adata_clusters.obs['clusters'] == '1', '1', '0')
+    stats = pnp.scmethods.pseudo_seurat(adata_clusters, arg_minpct=0.1, arg_logfcdiff=0.1)
+    X = adata_clusters.X.toarray()
+    in_cluster = (adata_clusters.obs['idents'] == '1').values
+    assert np.allclose(stats['cluster_pct'], (X[in_cluster] > 0).mean(axis=0))
+    assert np.allclose(stats['other_pct'], (X[~in_cluster] > 0).mean(axis=0))
+    assert np.allclose(stats['cluster_mean'], np.log(np.expm1(X[in_cluster]).mean(axis=0) + 1))
+    assert np.allclose(stats['other_mean'], np.log(np.expm1(X[~in_cluster]).mean(axis=0) + 1))
+    assert stats['gene'].tolist() == adata_clusters.var_names.tolist()
+
+
+def test_find_all_markers_pseudo_seurat(adata_clusters):
+    markers, filter_stats = pnp.scmethods.find_all_markers_pseudo_seurat(
+        adata_clusters, groups='all', groupby='clusters', method='wilcoxon',
+        arg_minpct=0.1, arg_logfcdiff=0.1, n_jobs=2)
+    assert filter_stats.index.get_level_values(0).unique().tolist() == ['0', '1', '2']
+    # the AnnData is not modified
+    assert 'idents' not in adata_clusters.obs.columns
+    for cv in ['0', '1', '2']:
+        adata_clusters.obs['idents'] = np.where(adata_clusters.obs['clusters'] == cv, '1', '0')
+        stats = pnp.scmethods.pseudo_seurat(adata_clusters, arg_minpct=0.1, arg_logfcdiff=0.1)
+        assert np.allclose(filter_stats.loc[cv, 'diff_mean'], stats['diff_mean'])
+        assert sorted(markers.loc[cv, 'names']) == sorted(stats['gene'][stats['background']])
+
+
+def test_identify_isotype_outliers():
+    rng = np.random.default_rng(0)
+    prot = AnnData(sparse.csr_matrix(rng.poisson(3, (300, 6)).astype(np.float32)),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(300)],
+                         data={'sample_id': pd.Categorical(rng.choice(['a', 'b', 'c'], 300))}),
+        var=pd.DataFrame(index=['CD3', 'CD4', 'CD8', 'iso1', 'iso2', 'iso3']))
+    isotypes = ['iso1', 'iso2', 'iso3']
+    counts = pd.DataFrame(prot[:, isotypes].X.toarray(), index=prot.obs_names, columns=isotypes)
+    # ungrouped
+    pnp.scmethods.identify_isotype_outliers(prot, isotypes, quantile_val=0.8, n_isotypes_pass=1)
+    n_out = (counts > counts.quantile(0.8)).sum(axis=1)
+    assert prot.obs['n_isotype_in_90_percentile'].astype(int).tolist() == n_out.tolist()
+    assert prot.obs['isotype_exclude_outliers'].tolist() == (n_out > 1).tolist()
+    # grouped, with a cell without a group
+    prot.obs.loc['cell0', 'sample_id'] = np.nan
+    out = pnp.scmethods.identify_isotype_outliers(prot, isotypes, quantile_val=0.8, n_isotypes_pass=1,
+                                                  groupby='sample_id', inplace=False)
+    thres = counts.groupby(prot.obs['sample_id'], observed=True).quantile(0.8)
+    n_out = pd.Series(0, index=prot.obs_names)
+    for cell in prot.obs_names[1:]:
+        n_out[cell] = (counts.loc[cell] > thres.loc[prot.obs.loc[cell, 'sample_id']]).sum()
+    assert out.obs['n_isotype_in_90_percentile'].astype(int).tolist() == n_out.tolist()
+    assert 'n_isotype_in_90_percentile' in prot.obs.columns
+    with pytest.raises(KeyError, match="iso4"):
+        pnp.scmethods.identify_isotype_outliers(prot, ['iso1', 'iso4'])
+
+
+def test_run_prot_normalise_per_channel():
+    import muon as mu
+    from muon import MuData
+    rng = np.random.default_rng(0)
+    prot = AnnData(rng.poisson(20, (90, 5)).astype(np.float32),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(90)],
+                         data={'channel': rng.choice(['a', 'b', 'c'], 90)}),
+        var=pd.DataFrame(index=[f"prot{i}" for i in range(5)]))
+    prot.layers['raw_counts'] = prot.X.copy()
+    mdata = MuData({"prot": prot})
+    pnp.scmethods.run_prot_normalise_per_channel(mdata, None, channel_col='channel',
+                                                 norm_methods=['clr'], n_jobs=2)
+    clr = mdata['prot'].layers['clr']
+    clr = clr.toarray() if sparse.issparse(clr) else clr
+    for si in ['a', 'b', 'c']:
+        ref = prot[prot.obs['channel'] == si].copy()
+        ref.X = ref.layers['raw_counts'].copy()
+        mu.prot.pp.clr(ref, inplace=True, axis=0)
+        ref_X = ref.X.toarray() if sparse.issparse(ref.X) else ref.X
+        assert np.allclose(clr[(prot.obs['channel'] == si).values], ref_X)
+    assert np.allclose(mdata['prot'].X.toarray() if sparse.issparse(mdata['prot'].X) else mdata['prot'].X, clr)
+
+
+def test_lsi_randomized(tmp_path):
+    rng = np.random.default_rng(0)
+    # low rank signal plus noise, so the top components are well separated
+    X = rng.poisson(np.exp(rng.normal(size=(200, 3)) @ rng.normal(size=(3, 80)) * 0.5)).astype(np.float64)
+    adata = AnnData(sparse.csr_matrix(X),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(200)]),
+        var=pd.DataFrame(index=[f"peak{i}" for i in range(80)],
+                         data={'highly_variable': np.arange(80) % 4 != 0}))
+    pnp.scmethods.lsi(adata, num_components=5, svd_solver="randomized", chunk_size=64)
+    hvf = adata.var['highly_variable'].values
+    s = np.linalg.svd(X[:, hvf], compute_uv=False)
+    assert np.allclose(adata.uns['lsi']['stdev'], s[:5] / np.sqrt(199), rtol=1e-3)
+    assert adata.obsm['X_lsi'].shape == (200, 5)
+    assert np.all(adata.varm['LSI'][~hvf] == 0)
+    assert np.allclose(np.abs(adata.obsm['X_lsi'].std(axis=0)), 1)
+    # streamed from disk
+    fname = str(tmp_path / "atac.h5ad")
+    adata.write(fname)
+    backed = adata.copy()
+    pnp.scmethods.lsi(backed, num_components=5, svd_solver="randomized", chunk_size=64,
+                      backed_X=(fname, "X"))
+    assert np.allclose(backed.obsm['X_lsi'], adata.obsm['X_lsi'])
+    # extract_lsi and calc_tech_corr still work
+    backed.obs['total_counts'] = X.sum(axis=1)
+    corr = pnp.scmethods.calc_tech_corr(pnp.scmethods.extract_lsi(backed), tech_covariates=['total_counts'], ncomps=5)
+    assert corr.shape == (5, 3)
+
+
+@pytest.mark.parametrize("fmt", ["csr", "csc", "dense", "backed"])
+def test_findTopFeatures_pseudo_signac(tmp_path, fmt):
+    rng = np.random.default_rng(0)
+    counts = sparse.random(100, 40, density=0.2, format="csr", random_state=0)
+    counts.data = rng.poisson(3, counts.nnz).astype(np.float32)
+    raw = counts.toarray()
+    adata = AnnData(counts.toarray() if fmt == "dense" else counts.asformat("csr" if fmt == "backed" else fmt),
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(100)]),
+        var=pd.DataFrame(index=[f"peak{i}" for i in range(40)]))
+    adata.layers['raw_counts'] = adata.X.copy()
+    backed_X = None
+    if fmt == "backed":
+        adata.write(str(tmp_path / "atac.h5ad"))
+        backed_X = (str(tmp_path / "atac.h5ad"), "layers/raw_counts")
+    pnp.scmethods.findTopFeatures_pseudo_signac(adata, "q20", backed_X=backed_X, chunk_size=30)
+    assert np.allclose(adata.var['total_counts'], raw.sum(axis=0))
+    assert np.array_equal(adata.var['n_cells_by_counts'], (raw != 0).sum(axis=0))
+    # the ecdf of the total counts
+    ecdf = (raw.sum(axis=0)[None, :] <= raw.sum(axis=0)[:, None]).mean(axis=1)
+    unique = ~pd.Series(raw.sum(axis=0)).duplicated(keep=False).values
+    assert np.allclose(adata.var['percentile'][unique], ecdf[unique])
+    assert adata.var['highly_variable'].sum() == 32
+    pnp.scmethods.findTopFeatures_pseudo_signac(adata, "c20")
+    assert adata.var['highly_variable'].tolist() == ((raw != 0).sum(axis=0) > 20).tolist()
+
+
+def test_qc_metrics_chunked(tmp_path):
+    rng = np.random.default_rng(0)
+    counts = sparse.random(120, 60, density=0.2, format="csr", random_state=0)
+    counts.data = rng.poisson(3, counts.nnz).astype(np.float32) + 1
+    adata = AnnData(counts,
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(120)]),
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(60)]))
+    adata.var['mt'] = np.arange(60) < 5
+    fname = str(tmp_path / "rna.h5ad")
+    adata.write(fname)
+    import h5py
+    from anndata.experimental import sparse_dataset
+    with h5py.File(fname, "r") as f:
+        obs, var = pnp.scmethods.qc_metrics_chunked(sparse_dataset(f["X"]), adata.var_names,
+                                                    qc_vars={'mt': adata.var['mt'].values}, chunk_size=50)
+    sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], percent_top=None, log1p=True, inplace=True)
+    for col in obs.columns:
+        assert np.allclose(obs[col], adata.obs[col]), col
+    for col in var.columns:
+        assert np.allclose(var[col], adata.var[col]), col
+    # scores of several gene sets in one pass
+    gene_sets = {'a_score': (['gene1', 'gene7', 'gene30'], 3), 'b_score': (['gene2', 'gene40'], 2)}
+    scores = pnp.scmethods.score_genes_chunked(adata.X, adata.var_names, gene_sets,
+                                               gene_means=var['mean_counts'], chunk_size=50)
+    X = adata.X.toarray()
+    for name, (genes, ctrl_size) in gene_sets.items():
+        control = pnp.scmethods._score_control_genes(genes, var['mean_counts'], ctrl_size=ctrl_size)
+        expected = X[:, adata.var_names.get_indexer(genes)].mean(axis=1) - \
+            X[:, adata.var_names.get_indexer(control)].mean(axis=1)
+        assert np.allclose(scores[name], expected)
+
+
+def test_X_is_raw():
+    rng = np.random.default_rng(0)
+    counts = sparse.random(50, 20, density=0.3, format="csr", random_state=0)
+    counts.data = rng.poisson(3, counts.nnz).astype(np.float32) + 1
+    adata = AnnData(counts.copy())
+    assert pnp.scmethods.X_is_raw(adata)
+    assert 'X_is_raw' not in adata.uns
+    # a single non integer is found
+    adata.X.data[7] = 0.5
+    assert not pnp.scmethods.X_is_raw(adata)
+    # normalised data, dense
+    adata = AnnData(np.log1p(counts.toarray()))
+    assert not pnp.scmethods.X_is_raw(adata, use_cache=True)
+    assert not adata.uns['X_is_raw']['raw']
+    # the cached result is only used while X is unchanged
+    adata.X = counts.toarray()
+    assert pnp.scmethods.X_is_raw(adata, use_cache=True)
+    assert adata.uns['X_is_raw']['raw']
+    assert pnp.scmethods.X_is_raw(AnnData(counts.astype(np.int32)))
+
+
+def test_get_top_expressed_features(adata_clusters):
+    from scanpy.pp import normalize_total
+    adata_clusters.obs.loc['cell0', 'clusters'] = np.nan
+    top = pnp.scmethods.get_top_expressed_features(adata_clusters, n_top=3, group_by='clusters')
+    expected = set()
+    for cv in ['0', '1', '2']:
+        sub = adata_clusters[adata_clusters.obs['clusters'] == cv]
+        mean_percent = normalize_total(sub, target_sum=100, inplace=False)['X'].toarray().mean(axis=0)
+        expected.update(sub.var_names[np.argsort(mean_percent)[::-1][:3]])
+    assert sorted(top) == sorted(expected)
+    norm = normalize_total(adata_clusters, target_sum=100, inplace=False)['X'].toarray().mean(axis=0)
+    assert pnp.scmethods.get_top_expressed_features(adata_clusters, n_top=4) == \
+        adata_clusters.var_names[np.argsort(norm)[::-1][:4]].tolist()
+
+
+def test_compute_lisi():
+    hm = pytest.importorskip("harmonypy")
+    rng = np.random.default_rng(0)
+    X = np.vstack([rng.normal(0, 1, (150, 2)), rng.normal(5, 1, (150, 2))])
+    metadata = pd.DataFrame({'batch': rng.choice(['a', 'b', 'c'], 300),
+                             'sample': np.repeat(['s1', 's2'], 150)})
+    metadata.loc[3, 'batch'] = np.nan
+    expected = hm.compute_lisi(X, metadata, ['batch', 'sample'])
+    res = pnp.scmethods.compute_lisi(X, metadata, ['batch', 'sample'], knn_method="exact", chunk_size=64)
+    assert res.shape == (300, 2)
+    assert np.allclose(res, expected)
+
+
+def test_incremental_latent(tmp_path):
+    scvi = pytest.importorskip("scvi")
+    rng = np.random.default_rng(0)
+    adata = AnnData(sparse.csr_matrix(rng.poisson(1, (300, 50)).astype(np.float32)),
+                    obs=pd.DataFrame({"bc_batch": np.repeat(["s1", "s2", "s3"], 100)},
+                                     index=["cell%i" % i for i in range(300)]))
+    adata.layers["raw_counts"] = adata.X.copy()
+    ref = adata[:200].copy()
+    scvi.model.SCVI.setup_anndata(ref, layer="raw_counts", batch_key="bc_batch")
+    vae = scvi.model.SCVI(ref, n_latent=5)
+    vae.train(max_epochs=2)
+    model_dir = str(tmp_path / "scvi_model")
+    vae.save(model_dir, anndata=False)
+    previous = pd.DataFrame(vae.get_latent_representation(), index=ref.obs_names)
+    # the cells of the previous run keep their latent, the new batch is mapped by surgery
+    latent, vae_q = pnp.scmethods.incremental_latent(scvi.model.SCVI, adata, model_dir, previous, max_epochs=2)
+    assert latent.shape == (300, 5) and np.isfinite(latent).all()
+    assert np.array_equal(latent[:200], previous.to_numpy())
+    assert vae_q.adata.n_obs == 100
+    latent, vae_q = pnp.scmethods.incremental_latent(scvi.model.SCVI, adata[:200], model_dir, previous)
+    assert vae_q is None and np.array_equal(latent, previous.to_numpy())
+    # new cells of known batches are mapped without training
+    latent, vae_q = pnp.scmethods.incremental_latent(scvi.model.SCVI, adata[:200], model_dir, previous[::2])
+    assert np.isfinite(latent).all() and np.array_equal(latent[::2], previous.to_numpy()[::2])
+    assert np.allclose(latent[1::2], previous.to_numpy()[1::2], atol=1e-4)
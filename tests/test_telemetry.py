@@ -0,0 +1,32 @@
+import sqlite3
+from panpipes.telemetry import record, report, _SCHEMA
+
+
+def test_record_and_report(tmp_path):
+    db = str(tmp_path / "telemetry.db")
+    infile = tmp_path / "in.h5mu"
+    infile.write_bytes(b"0" * 1024 * 1024)
+    assert record("cat %s > /dev/null" % infile, db, "clustering", "run_umap", job_threads=2, run_id="run1") == 0
+    assert record("exit 3", db, "clustering", "run_umap", job_threads=2, run_id="run1") == 3
+    record("true", db, "ingest", "load_mudatas", run_id="run1")
+    with sqlite3.connect(db) as con:
+        rows = con.execute("SELECT task, input_mb, exit_code FROM task_resources").fetchall()
+    assert rows[0] == ("run_umap", 1.0, 0)
+    summary = report(db, workflow="clustering")
+    assert summary.index.tolist() == [("clustering", "run_umap")]
+    assert summary.loc[("clustering", "run_umap"), "runs"] == 2
+    assert summary.loc[("clustering", "run_umap"), "failed"] == 1
+    # a rerun is reported on its own, unless all runs are asked for
+    record("true", db, "clustering", "run_umap", job_threads=2, run_id="run2")
+    assert report(db, workflow="clustering").loc[("clustering", "run_umap"), "runs"] == 1
+    assert report(db, workflow="clustering", run_id="run1").loc[("clustering", "run_umap"), "failed"] == 1
+    assert report(db, workflow="clustering", run_id="all").loc[("clustering", "run_umap"), "runs"] == 3
+
+
+def test_record_old_table(tmp_path):
+    # tables written before the run id was recorded get the column added
+    db = str(tmp_path / "telemetry.db")
+    with sqlite3.connect(db) as con:
+        con.execute(_SCHEMA.replace(",\n    run_id TEXT", ""))
+    record("true", db, "clustering", "run_umap", run_id="run1")
+    assert report(db, workflow="clustering").loc[("clustering", "run_umap"), "runs"] == 1